@@ -1,7 +1,9 @@
 #include <torch/extension.h>
+#include "cholesky_factor.cuh"
 
 // GPU solver: cusparse
 torch::Tensor solve_cusparse(const torch::Tensor& Ap, const torch::Tensor& Aj, const torch::Tensor& Ax, const torch::Tensor& b, float tol);
+torch::Tensor reorder_symamd(const torch::Tensor& Ap, const torch::Tensor& Aj);
 void init_cusolver_handle();
 
 std::pair<torch::Tensor, int> solve_pcg_diag(
@@ -12,6 +14,11 @@ std::pair<torch::Tensor, int> solve_pcg_diag(
 // Let's dispatch device outside, due to possibly different interfaces.
 PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
     m.def("solve_cusparse", &solve_cusparse, "Solve sparse matrix using CU-Sparse LU.");
+    py::class_<CholeskyFactor, std::shared_ptr<CholeskyFactor>>(m, "CholeskyFactor")
+        .def(py::init<const torch::Tensor&, const torch::Tensor&, const torch::Tensor&, float>(),
+             "Factorize sparse matrix once using CU-Solver Cholesky (no reordering).")
+        .def("solve", &CholeskyFactor::solve, "Solve (R, n) right-hand sides with the factorization.");
+    m.def("reorder_symamd", &reorder_symamd, "Fill-reducing ordering of a symmetric sparse matrix (host).");
     m.def("solve_pcg_diag", &solve_pcg_diag, "Solve sparse matrix using PCG.");
     m.def("init_cusolver", &init_cusolver_handle, "Must be called before calling cusolver.");
 }
@@ -0,0 +1,26 @@
+#pragma once
+
+#include <torch/extension.h>
+#include <cusparse.h>
+#include <cusolverSp.h>
+#include <cusolverSp_LOWLEVEL_PREVIEW.h>
+
+// Cholesky factorization of a CSR matrix, computed once on construction and kept on the device, so that it could be
+//  applied to the right-hand sides of later solves. Unlike cusolverSpScsrlsvchol there is no internal reordering,
+//  apply reorder_symamd beforehand.
+class CholeskyFactor {
+public:
+    CholeskyFactor(const torch::Tensor& Ap, const torch::Tensor& Aj, const torch::Tensor& Ax, float tol);
+    ~CholeskyFactor();
+    CholeskyFactor(const CholeskyFactor&) = delete;
+    CholeskyFactor& operator=(const CholeskyFactor&) = delete;
+
+    // b is (R, n), returns the (R, n) solutions.
+    torch::Tensor solve(const torch::Tensor& b) const;
+
+private:
+    int n;
+    cusparseMatDescr_t descr = nullptr;
+    csrcholInfo_t info = nullptr;
+    torch::Tensor workspace;
+};
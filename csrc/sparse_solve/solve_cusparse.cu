@@ -2,8 +2,10 @@
 #include <ATen/cuda/CUDAContext.h>
 #include <cusparse.h>
 #include <cusolverSp.h>
+#include <cusolverSp_LOWLEVEL_PREVIEW.h>
 #include <time.h>
 #include "err_check.cuh"
+#include "cholesky_factor.cuh"
 
 cusolverSpHandle_t solver_handle = nullptr;
 
@@ -40,3 +42,76 @@ torch::Tensor solve_cusparse(const torch::Tensor& Ap, const torch::Tensor& Aj, c
 
     return x;
 }
+
+// Fill-reducing symmetric approximate minimum degree ordering, computed on the host.
+//  The matrix P A P^T with (P A P^T)[k, l] = A[p[k], p[l]] has a sparser Cholesky factor.
+torch::Tensor reorder_symamd(const torch::Tensor& Ap, const torch::Tensor& Aj) {
+    CHECK_CONTIGUOUS(Ap); CHECK_IS_INT(Ap); TORCH_CHECK(!Ap.is_cuda(), "Ap must be a CPU tensor");
+    CHECK_CONTIGUOUS(Aj); CHECK_IS_INT(Aj); TORCH_CHECK(!Aj.is_cuda(), "Aj must be a CPU tensor");
+
+    cusparseMatDescr_t descr;
+    cusparseSafeCall(cusparseCreateMatDescr(&descr));
+    cusparseSetMatType(descr, CUSPARSE_MATRIX_TYPE_GENERAL);
+    cusparseSetMatIndexBase(descr, CUSPARSE_INDEX_BASE_ZERO);
+
+    int n = Ap.size(0) - 1;
+    int nnz = Aj.size(0);
+    torch::Tensor p = torch::empty({n}, torch::dtype(torch::kInt32));
+    cusolveSafeCall(cusolverSpXcsrsymamdHost(solver_handle, n, nnz, descr,
+                                             Ap.data_ptr<int>(), Aj.data_ptr<int>(), p.data_ptr<int>()));
+
+    cusparseSafeCall(cusparseDestroyMatDescr(descr));
+    return p;
+}
+
+CholeskyFactor::CholeskyFactor(const torch::Tensor& Ap, const torch::Tensor& Aj, const torch::Tensor& Ax,
+                               float tol) {
+    CHECK_CONTIGUOUS(Ap); CHECK_CUDA(Ap); CHECK_IS_INT(Ap);
+    CHECK_CONTIGUOUS(Aj); CHECK_CUDA(Aj); CHECK_IS_INT(Aj);
+    CHECK_CONTIGUOUS(Ax); CHECK_CUDA(Ax); CHECK_IS_FLOAT(Ax);
+
+    n = Ap.size(0) - 1;
+    int nnz = Ax.size(0);
+
+    cusparseSafeCall(cusparseCreateMatDescr(&descr));
+    cusparseSetMatType(descr, CUSPARSE_MATRIX_TYPE_GENERAL);
+    cusparseSetMatIndexBase(descr, CUSPARSE_INDEX_BASE_ZERO);
+
+    cudaStreamSynchronize(at::cuda::getCurrentCUDAStream());
+
+    cusolveSafeCall(cusolverSpCreateCsrcholInfo(&info));
+    cusolveSafeCall(cusolverSpXcsrcholAnalysis(solver_handle, n, nnz, descr,
+                                               Ap.data_ptr<int>(), Aj.data_ptr<int>(), info));
+
+    size_t internal_bytes, workspace_bytes;
+    cusolveSafeCall(cusolverSpScsrcholBufferInfo(solver_handle, n, nnz, descr, Ax.data_ptr<float>(),
+                                                 Ap.data_ptr<int>(), Aj.data_ptr<int>(), info,
+                                                 &internal_bytes, &workspace_bytes));
+    workspace = torch::empty({(int64_t) workspace_bytes}, torch::dtype(torch::kUInt8).device(Ax.device()));
+
+    cusolveSafeCall(cusolverSpScsrcholFactor(solver_handle, n, nnz, descr, Ax.data_ptr<float>(),
+                                             Ap.data_ptr<int>(), Aj.data_ptr<int>(), info, workspace.data_ptr()));
+    int singularity;
+    cusolveSafeCall(cusolverSpScsrcholZeroPivot(solver_handle, info, tol, &singularity));
+}
+
+CholeskyFactor::~CholeskyFactor() {
+    if (info != nullptr) cusolverSpDestroyCsrcholInfo(info);
+    if (descr != nullptr) cusparseDestroyMatDescr(descr);
+}
+
+torch::Tensor CholeskyFactor::solve(const torch::Tensor& b) const {
+    CHECK_CONTIGUOUS(b); CHECK_CUDA(b); CHECK_IS_FLOAT(b);
+    TORCH_CHECK(b.dim() == 2 && b.size(1) == n, "b must be (R, n)");
+
+    int n_rhs = b.size(0);
+    torch::Tensor x = torch::empty({n_rhs, n}, torch::dtype(torch::kFloat32).device(b.device()));
+
+    cudaStreamSynchronize(at::cuda::getCurrentCUDAStream());
+
+    for (int r = 0; r < n_rhs; ++r) {
+        cusolveSafeCall(cusolverSpScsrcholSolve(solver_handle, n, b.data_ptr<float>() + (int64_t) r * n,
+                                                x.data_ptr<float>() + (int64_t) r * n, info, workspace.data_ptr()));
+    }
+    return x;
+}
@@ -1,5 +1,6 @@
 import collections
 import multiprocessing
+from pathlib import Path
 
 import json
 import torch
@@ -73,6 +74,55 @@ class RandomSafeDataset(Dataset):
                 return self.__getitem__(rng.randint(0, len(self) - 1))
 
 
+class HashTreeCache:
+    """
+    On-disk cache of HashTree snapshots (e.g. the GT trees), indexed by shape name.
+        A snapshot is only served if it is built from the same points as the query, which is checked on a fingerprint
+    kept in the snapshot header before anything is loaded. Snapshots are never overwritten, so random transforms
+    (noise, sub-sampling before BoundScale) just lead to a rebuild. 'tag' should identify the build options.
+    """
+    def __init__(self, base_path, tag: str = ""):
+        self.base_path = Path(base_path)
+        self.base_path.mkdir(parents=True, exist_ok=True)
+        self.tag = tag
+
+    def _get_path(self, key: str) -> Path:
+        return self.base_path / f"{self.tag}-{key.replace('/', '__')}.tree"
+
+    @staticmethod
+    def fingerprint(xyz: torch.Tensor) -> str:
+        """
+        :return: str identifying the points, i.e. their shape, dtype and a hash of the raw data.
+        """
+        import hashlib
+        digest = hashlib.blake2b(xyz.detach().contiguous().cpu().numpy().tobytes(), digest_size=16).hexdigest()
+        return f"{list(xyz.size())}-{xyz.dtype}-{digest}"
+
+    def load(self, key: str, xyz: torch.Tensor):
+        """
+        :return: HashTree, or None if the tree is not cached or is built from different points.
+        """
+        from torch_spsr.core.hashtree import HashTree
+
+        tree_path = self._get_path(key)
+        if not tree_path.exists():
+            return None
+        if HashTree.load_meta(tree_path).get("xyz_fingerprint", None) != self.fingerprint(xyz):
+            return None
+        hash_tree = HashTree.load(tree_path, device=xyz.device)
+        hash_tree.xyz = xyz
+        return hash_tree
+
+    def store(self, key: str, hash_tree):
+        """
+        Store the tree if the key is not cached yet, existing snapshots are kept.
+        """
+        tree_path = self._get_path(key)
+        if tree_path.exists():
+            return
+        hash_tree.save(tree_path, extra_meta={"xyz_fingerprint": self.fingerprint(hash_tree.xyz)})
+
+
 def list_collate(batch):
     """
     This just do not stack batch dimension.
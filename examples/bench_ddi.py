@@ -0,0 +1,57 @@
+import time
+import torch
+
+from torch_spsr.bases.additive import DDIFunc
+
+
+def timeit(func, n_repeat: int, device: torch.device):
+    func()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start_time = time.perf_counter()
+    for _ in range(n_repeat):
+        res = func()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start_time) / n_repeat, res
+
+
+def random_inputs(n_pairs: int, n_components: int, n_pos: int, dtype=torch.float, device='cpu'):
+    source_expanded = torch.randn(n_pairs, 3 * n_components, dtype=dtype, device=device, requires_grad=True)
+    target_expanded = torch.randn(n_pairs, 3 * n_components, dtype=dtype, device=device, requires_grad=True)
+    rel_pos = torch.randint(0, n_pos, (n_pairs, 3), device=device)
+    f_f_i = torch.randn(n_components, n_components, n_pos, dtype=dtype, device=device)
+    df_df_i = torch.randn(n_components, n_components, n_pos, dtype=dtype, device=device)
+    return source_expanded, target_expanded, rel_pos, f_f_i, df_df_i
+
+
+def forward_backward(inputs):
+    p_mats, q_mats = DDIFunc.apply(*inputs)
+    return torch.autograd.grad((p_mats * q_mats).sum(), inputs[:2])
+
+
+if __name__ == '__main__':
+    # Check the CPU implementation of DDIFunc (gradcheck in double precision, and agreement with the CUDA kernels
+    #   if a GPU is available), then measure the forward + backward throughput in pairs per second.
+    n_components, n_pos = 7, 20
+
+    torch.manual_seed(0)
+    check_inputs = random_inputs(64, n_components, n_pos, dtype=torch.double)
+    print("CPU gradcheck:", torch.autograd.gradcheck(DDIFunc.apply, check_inputs))
+
+    if torch.cuda.is_available():
+        cpu_inputs = random_inputs(4096, n_components, n_pos)
+        cuda_inputs = [t.detach().cuda().requires_grad_(t.requires_grad) for t in cpu_inputs]
+        for name, cpu_res, cuda_res in zip(["p_mats", "q_mats"], DDIFunc.apply(*cpu_inputs),
+                                           DDIFunc.apply(*cuda_inputs)):
+            print(f"CPU vs CUDA {name}: max abs diff = {(cpu_res - cuda_res.cpu()).abs().max().item():.3e}")
+        for name, cpu_res, cuda_res in zip(["grad_s", "grad_t"], forward_backward(cpu_inputs),
+                                           forward_backward(cuda_inputs)):
+            print(f"CPU vs CUDA {name}: max abs diff = {(cpu_res - cuda_res.cpu()).abs().max().item():.3e}")
+
+    devices = [torch.device('cpu')] + ([torch.device('cuda')] if torch.cuda.is_available() else [])
+    for device in devices:
+        n_pairs = 1000000
+        inputs = random_inputs(n_pairs, n_components, n_pos, device=device)
+        run_time, _ = timeit(lambda: forward_backward(inputs), 5, device)
+        print(f"[{device.type}] forward + backward: {n_pairs / run_time / 1e6:.2f}M pairs/s")
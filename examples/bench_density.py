@@ -0,0 +1,53 @@
+import time
+import torch
+import numpy as np
+from pathlib import Path
+
+from torch_spsr.core.hashtree import HashTree
+
+
+def timeit(func, n_repeat: int, device: torch.device):
+    func()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start_time = time.perf_counter()
+    for _ in range(n_repeat):
+        res = func()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start_time) / n_repeat, res
+
+
+def adaptive_depth(xyz_density: torch.Tensor, log_base: float = 4.0, min_density: float = 32.0):
+    # Same rule as SparseFeatureHierarchy.build_hierarchy_adaptive (without clamping to the tree depth).
+    return -(torch.log(xyz_density / min_density) / np.log(log_base)).floor().int().clamp_(max=0)
+
+
+if __name__ == '__main__':
+    # Compare the density estimators of HashTree.compute_xyz_density on the horse example: run time of each, and the
+    #   deviation of the approximate ones from the Bezier KDE, both in value and in the adaptive level they select.
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    horse_npts = np.fromfile(Path(__file__).parent / "horse.bnpts").reshape(-1, 6)
+    horse_xyz = torch.from_numpy(horse_npts[:, :3]).float().to(device)
+    hash_tree = HashTree(horse_xyz, voxel_size=0.002, depth=4)
+    print(f"Device = {device}, #points = {horse_xyz.size(0)}")
+
+    densities = {}
+    for density_depth in [1, 2]:
+        for estimator in HashTree.DENSITY_ESTIMATORS:
+            run_time, densities[estimator] = timeit(
+                lambda: hash_tree.compute_xyz_density(density_depth, estimator), 10, device)
+            print(f"[depth {density_depth}, {estimator}] time = {run_time * 1000:.2f}ms")
+
+        ref_density = densities["bezier"]
+        for estimator in HashTree.DENSITY_ESTIMATORS:
+            if estimator == "bezier":
+                continue
+            rel_err = ((densities[estimator] - ref_density).abs() / ref_density).cpu().numpy()
+            log_corr = np.corrcoef(torch.log(densities[estimator]).cpu().numpy(),
+                                   torch.log(ref_density).cpu().numpy())[0, 1]
+            same_depth = (adaptive_depth(densities[estimator]) == adaptive_depth(ref_density)).float().mean()
+            print(f"[depth {density_depth}, {estimator} vs bezier] relative error: "
+                  f"mean = {rel_err.mean():.4f}, median = {np.median(rel_err):.4f}, "
+                  f"p95 = {np.percentile(rel_err, 95):.4f}; log-correlation = {log_corr:.4f}; "
+                  f"same adaptive level = {same_depth.item() * 100:.2f}%")
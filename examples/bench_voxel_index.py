@@ -0,0 +1,58 @@
+import time
+import torch
+import numpy as np
+from pathlib import Path
+
+from torch_spsr.ext import CuckooHashTable
+from torch_spsr.core.hashtree import HashTree
+from torch_spsr.core._hash_backend import MortonSortedTable
+
+
+def timeit(func, n_repeat: int, device: torch.device):
+    func()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start_time = time.perf_counter()
+    for _ in range(n_repeat):
+        res = func()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start_time) / n_repeat, res
+
+
+def memory_of(build_func, device: torch.device):
+    """
+    Device memory allocated through PyTorch by the built index (CUDA only).
+    """
+    if device.type != 'cuda':
+        return None, build_func()
+    torch.cuda.synchronize()
+    mem_before = torch.cuda.memory_allocated()
+    index = build_func()
+    torch.cuda.synchronize()
+    return torch.cuda.memory_allocated() - mem_before, index
+
+
+if __name__ == '__main__':
+    # Compare CuckooHashTable and MortonSortedTable (the two index types of SparseFeatureHierarchy) on the finest
+    #   level of a tree built from the horse example: build time, memory and throughput of 3x3x3 neighbour queries.
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    horse_npts = np.fromfile(Path(__file__).parent / "horse.bnpts").reshape(-1, 6)
+    horse_xyz = torch.from_numpy(horse_npts[:, :3]).float().to(device)
+
+    hash_tree = HashTree(horse_xyz, voxel_size=0.002, depth=4)
+    hash_tree.build_encoder_hierarchy_adaptive(min_density=32.0)
+    coords = hash_tree.get_coords(hash_tree.ENCODER, 0)
+    kernel = hash_tree.get_range_kernel(3)
+    print(f"Device = {device}, #voxels = {coords.size(0)}, #queries = {coords.size(0) * kernel.size(0)}")
+
+    for index_name, index_cls in [("cuckoo", CuckooHashTable), ("sorted", MortonSortedTable)]:
+        index_mem, index = memory_of(lambda: index_cls(data=coords), device)
+        if index_mem is None and isinstance(index, MortonSortedTable):
+            index_mem = index.nbytes
+        build_time, _ = timeit(lambda: index_cls(data=coords), 10, device)
+        query_time, query_res = timeit(lambda: index.query(coords, kernel), 20, device)
+        n_found = torch.sum(query_res != -1).item()
+        print(f"[{index_name}] build = {build_time * 1000:.3f}ms, "
+              f"query = {coords.size(0) * kernel.size(0) / query_time / 1e6:.2f}M/s, "
+              f"memory = {index_mem / 1024 if index_mem is not None else float('nan'):.1f}KB, found = {n_found}")
@@ -1,5 +1,5 @@
 pip install torch==1.12.1+cu116 --extra-index-url https://download.pytorch.org/whl/cu116
 pip install torch-scatter -f https://data.pyg.org/whl/torch-1.12.1+cu116.html
 pip install open3d==0.16.0 --index-url https://pypi.org/simple/
-pip install omegaconf
+pip install omegaconf scipy
 python setup.py install
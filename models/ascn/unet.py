@@ -22,13 +22,36 @@ class Activation(nn.Module):
 
 
 class GroupNorm(nn.GroupNorm):
+    def __init__(self, num_groups: int, num_channels: int, branch: int = None, **kwargs):
+        super().__init__(num_groups, num_channels, **kwargs)
+        # Needed to tell the instances apart in a packed batch.
+        self.branch = branch
+
     def forward(self, hash_tree: HashTree, feat: torch.Tensor, feat_depth: int):
+        if hash_tree.batch_size > 1:
+            return self._forward_batched(hash_tree, feat, feat_depth), feat_depth
         num_channels = feat.size(1)
         feat = feat.transpose(0, 1).reshape(1, num_channels, -1)
         feat = super().forward(feat)
         feat = feat.reshape(num_channels, -1).transpose(0, 1)
         return feat, feat_depth
 
+    def _forward_batched(self, hash_tree: HashTree, feat: torch.Tensor, feat_depth: int):
+        # Statistics are taken per instance and group, as if each instance was normalized on its own.
+        assert self.branch is not None, "Branch must be known to normalize a packed batch."
+        batch_ids = hash_tree.get_voxel_batch_ids(self.branch, feat_depth)
+        assert batch_ids.size(0) == feat.size(0)
+        group_feat = feat.reshape(feat.size(0), self.num_groups, -1)
+        group_mean = torch_scatter.scatter_mean(
+            group_feat.mean(dim=2), batch_ids, dim=0, dim_size=hash_tree.batch_size)[batch_ids]
+        group_feat = group_feat - group_mean.unsqueeze(-1)
+        group_var = torch_scatter.scatter_mean(
+            group_feat.square().mean(dim=2), batch_ids, dim=0, dim_size=hash_tree.batch_size)[batch_ids]
+        feat = (group_feat / torch.sqrt(group_var.unsqueeze(-1) + self.eps)).reshape(feat.size(0), -1)
+        if self.affine:
+            feat = feat * self.weight + self.bias
+        return feat
+
 
 class NearestUpsampling(nn.Module):
     def __init__(self, target_branch: int = HashTree.DECODER):
@@ -212,19 +235,18 @@ class Conv3d(nn.Module):
             else:
                 output_depth = feat_depth - 1 if self.transposed else feat_depth + 1
 
-            # Obtain and convert nmap to kmap.
+            # Obtain kmap (cached in the tree, shared by all layers with the same depths and kernel size).
             if self.transposed:
-                src_ids, tgt_ids, _, nbsizes = hash_tree.get_neighbours(
-                    feat_depth, output_depth, self.kernel_size, self.branch, conv_based=True)
+                nbmaps, nbsizes = hash_tree.get_conv_kernel_map(
+                    feat_depth, output_depth, self.kernel_size, self.branch)
                 sizes = (hash_tree.get_coords_size(self.branch, output_depth),
                          hash_tree.get_coords_size(self.branch, feat_depth))
             else:
-                src_ids, tgt_ids, _, nbsizes = hash_tree.get_neighbours(
-                    output_depth, feat_depth, self.kernel_size, self.branch, conv_based=True)
+                nbmaps, nbsizes = hash_tree.get_conv_kernel_map(
+                    output_depth, feat_depth, self.kernel_size, self.branch)
                 sizes = (hash_tree.get_coords_size(self.branch, feat_depth),
                          hash_tree.get_coords_size(self.branch, output_depth))
 
-            nbmaps = torch.stack([tgt_ids, src_ids], dim=1)
             output_feats = ConvolutionFunction.apply(
                 feat, self.kernel, nbmaps, nbsizes, sizes, self.transposed, True
             )
@@ -267,7 +289,8 @@ class SparseConvBlock(SparseSequential):
                 assert num_channels % num_groups == 0, \
                     f'Expected number of channels in input to be divisible by num_groups. ' \
                     f'num_channels={num_channels}, num_groups={num_groups}'
-                self.add_module('GroupNorm', GroupNorm(num_groups=num_groups, num_channels=num_channels))
+                self.add_module('GroupNorm', GroupNorm(num_groups=num_groups, num_channels=num_channels,
+                                                       branch=branch))
             else:
                 raise NotImplementedError
 
@@ -4,6 +4,7 @@ import pandas as pd
 import torch
 import torch.nn.functional as F
 import torch_scatter
+from omegaconf import OmegaConf
 from pycg import exp, vis
 
 from mesh_evaluator import MeshEvaluator
@@ -11,8 +12,8 @@ from models.ascn.decoder import MultiscaleDecoder
 from models.ascn.encoder import LocalPoolPointnet
 from torch_spsr.bases import get_basis
 from torch_spsr.core.hashtree import HashTree
-from torch_spsr.core.reconstructor import Reconstructor
-from dataset.base import DatasetSpec as DS, list_collate
+from torch_spsr.core.reconstructor import Reconstructor, SolutionCache
+from dataset.base import DatasetSpec as DS, list_collate, HashTreeCache, deterministic_hash
 from models.sparse_backbone import SparseStructureNet
 
 from models.base_model import BaseModel
@@ -57,14 +58,51 @@ class Model(BaseModel):
                 out_dim=1, **self.hparams.weighted.decoder
             )
 
+        # Solutions of visited shapes, used to warm-start the solver.
+        self.solution_cache = SolutionCache() if self.hparams.solver_warm_start else None
+
+        # Snapshots of GT trees, keyed by the options that affect how they are built.
+        self.gt_tree_cache = None
+        if self.hparams.gt_tree_cache is not None:
+            tree_options = OmegaConf.to_container(OmegaConf.create({
+                k: self.hparams.get(k) for k in
+                ["voxel_size", "tree_depth", "tree_expand", "tree_morton_order", "tree_index_type",
+                 "tree_density_estimator", "adaptive_policy", "adaptive_depth"]}))
+            self.gt_tree_cache = HashTreeCache(self.hparams.gt_tree_cache, tag=str(deterministic_hash(tree_options)))
+
         # We might want to use a pre-trained network.
         if self.hparams.load_pretrained is not None and self.hparams.load_pretrained != "none":
             self.load_state_dict(torch.load(self.hparams.load_pretrained)['state_dict'],
                                  strict=self.hparams.load_pretrained_strict)
             exp.logger.info("Loaded check point state from", self.hparams.load_pretrained)
 
-    def build_hashtree(self, input_xyz, is_gt=False, input_normal=None):
-        hash_tree = HashTree(input_xyz, voxel_size=self.hparams.voxel_size, depth=self.hparams.tree_depth)
+    def get_batch_spacing(self, batch, out: dict):
+        """
+        Spacing that packs the input and GT points of all instances of the batch into one frame (refer to
+            HashTree.from_batch), so that the predicted and GT trees could be compared voxel by voxel.
+        :return: None if the batch holds a single instance.
+        """
+        if len(batch[DS.INPUT_PC]) == 1:
+            return None
+        if 'batch_spacing' not in out.keys():
+            out['batch_spacing'] = HashTree.get_batch_spacing(
+                batch[DS.INPUT_PC] + batch[DS.GT_DENSE_PC], self.hparams.voxel_size, self.hparams.tree_depth)
+        return out['batch_spacing']
+
+    def build_hashtree(self, input_xyz: list, is_gt=False, input_normal: list = None, batch_spacing: float = None):
+        """
+        :param input_xyz: list of (N_b, 3) points of each instance, several instances are packed into one tree.
+        :param input_normal: list of (N_b, 3) normals of each instance, needed by the normal adaptive policy.
+        :param batch_spacing: spacing of the packed instances, see get_batch_spacing.
+        """
+        tree_kwargs = dict(voxel_size=self.hparams.voxel_size, depth=self.hparams.tree_depth,
+                           morton_order=self.hparams.tree_morton_order, index_type=self.hparams.tree_index_type)
+        if len(input_xyz) == 1:
+            hash_tree = HashTree(input_xyz[0], **tree_kwargs)
+        else:
+            hash_tree = HashTree.from_batch(input_xyz, batch_spacing=batch_spacing, **tree_kwargs)
+        if input_normal is not None:
+            input_normal = torch.cat(input_normal, dim=0)
         if self.hparams.tree_expand > 0:
             hash_tree.build_encoder_hierarchy_dense(expand_range=self.hparams.tree_expand, uniform_density=True)
         else:
@@ -72,25 +110,37 @@ class Model(BaseModel):
                 if self.hparams.adaptive_policy.method == "density":
                     hash_tree.build_encoder_hierarchy_adaptive(
                         density_depth=1, min_density=self.hparams.adaptive_policy.min_density,
-                        limit_adaptive_depth=self.hparams.adaptive_depth)
+                        limit_adaptive_depth=self.hparams.adaptive_depth, chunk_size=self.hparams.tree_chunk_size,
+                        density_estimator=self.hparams.tree_density_estimator)
                 elif self.hparams.adaptive_policy.method == "normal":
                     hash_tree.build_hierarchy_subdivide(
                         subdivide_policy=get_normal_variation_policy(self.hparams.adaptive_policy.tau, take_abs=True),
                         density_depth=1, expand=True,
-                        limit_adaptive_depth=self.hparams.adaptive_depth, normal=input_normal)
+                        limit_adaptive_depth=self.hparams.adaptive_depth, normal=input_normal,
+                        density_estimator=self.hparams.tree_density_estimator)
                 else:
                     raise NotImplementedError
             else:
-                hash_tree.build_encoder_hierarchy_adaptive(density_depth=1, uniform_density=True)
+                hash_tree.build_encoder_hierarchy_adaptive(density_depth=1, uniform_density=True,
+                                                           chunk_size=self.hparams.tree_chunk_size)
         return hash_tree
 
+    def get_shape_key(self, batch):
+        """
+        :return: key of the shape (or the tuple of shapes packed in the batch) for the solution cache.
+        """
+        shape_names = batch[DS.SHAPE_NAME]
+        return shape_names[0] if len(shape_names) == 1 else tuple(shape_names)
+
     def forward(self, batch, out: dict):
-        input_xyz = batch[DS.INPUT_PC][0]
-        assert input_xyz.ndim == 2, "Can only forward single batch."
+        hash_tree = self.build_hashtree(batch[DS.INPUT_PC], batch_spacing=self.get_batch_spacing(batch, out))
+        input_xyz = hash_tree.xyz
+        # Attention in the bottleneck is not local, it would mix the instances of a packed batch.
+        assert hash_tree.batch_size == 1 or self.hparams.network.unet.enhance_level <= 1, \
+            "Feature enhancement does not support batches of several instances."
 
-        hash_tree = self.build_hashtree(input_xyz)
         unet_feat = self.encoder(
-            None if not self.hparams.use_input_normal else batch[DS.TARGET_NORMAL][0],
+            None if not self.hparams.use_input_normal else torch.cat(batch[DS.TARGET_NORMAL], dim=0),
             hash_tree
         )
         structure_features, normal_features, basis_features, w_features, _ = self.unet(
@@ -98,8 +148,8 @@ class Model(BaseModel):
         out.update({'tree': hash_tree})
 
         tree_size = hash_tree.get_coords_size(hash_tree.DECODER, 0)
-        if tree_size > 50000 and self.trainer.training:
-            exp.logger.warning(f"Skipping {batch[DS.SHAPE_NAME][0]} due to large tree size ({tree_size}).")
+        if tree_size > 50000 * hash_tree.batch_size and self.trainer.training:
+            exp.logger.warning(f"Skipping {', '.join(batch[DS.SHAPE_NAME])} due to large tree size ({tree_size}).")
             return None
 
         if self.hparams.weighted.enabled:
@@ -116,6 +166,9 @@ class Model(BaseModel):
             for feat_depth, normal_data in normal_features.items() if feat_depth < self.hparams.adaptive_depth}
 
         reconstructor = Reconstructor(hash_tree, self.basis, basis_features)
+        initial_guess = None
+        if self.solution_cache is not None:
+            initial_guess = self.solution_cache.fetch(self.get_shape_key(batch), hash_tree, reconstructor.branch)
         reconstructor.solve_multigrid(
             start_depth=hash_tree.depth - 1,
             end_depth=0,
@@ -125,7 +178,12 @@ class Model(BaseModel):
             screen_delta=self.hparams.screening.delta * (2 * point_w[:, 0] if point_w is not None else 1),
             solver=self.hparams.solver,
             verbose=False,
+            initial_guess=initial_guess,
+            symmetric_storage=self.hparams.solver_symmetric_storage,
         )
+        if self.solution_cache is not None:
+            self.solution_cache.store(self.get_shape_key(batch), hash_tree, reconstructor.branch,
+                                      reconstructor.solutions)
 
         reconstructor.set_fixed_level_set(self.hparams.screening.delta)
         out.update({'structure_features': structure_features, 'basis_features': basis_features,
@@ -144,8 +202,17 @@ class Model(BaseModel):
     def compute_gt_hashtree(self, batch, out):
         if 'gt_tree' in out.keys():
             return out['gt_tree']
-        gt_tree = self.build_hashtree(
-            batch[DS.GT_DENSE_PC][0], is_gt=True, input_normal=batch[DS.GT_DENSE_NORMAL][0])
+        # Snapshots are kept per shape, packed batches are rebuilt.
+        use_cache = self.gt_tree_cache is not None and len(batch[DS.GT_DENSE_PC]) == 1
+        gt_tree = None
+        if use_cache:
+            gt_tree = self.gt_tree_cache.load(batch[DS.SHAPE_NAME][0], batch[DS.GT_DENSE_PC][0])
+        if gt_tree is None:
+            gt_tree = self.build_hashtree(
+                batch[DS.GT_DENSE_PC], is_gt=True, input_normal=batch[DS.GT_DENSE_NORMAL],
+                batch_spacing=self.get_batch_spacing(batch, out))
+            if use_cache:
+                self.gt_tree_cache.store(batch[DS.SHAPE_NAME][0], gt_tree)
         out['gt_tree'] = gt_tree
         return gt_tree
 
@@ -160,10 +227,12 @@ class Model(BaseModel):
         gt_density = gt_hashtree.xyz_density
 
         normal_data = {}
-        ref_xyz, ref_normal = batch[DS.GT_DENSE_PC][0], batch[DS.GT_DENSE_NORMAL][0] / gt_density[:, None]
+        ref_xyz = pd_hashtree.pack_xyz(batch[DS.GT_DENSE_PC])
+        ref_normal = torch.cat(batch[DS.GT_DENSE_NORMAL], dim=0) / gt_density[:, None]
         for d in range(self.hparams.adaptive_depth):
             normal_data_depth, failed_mask = pd_hashtree.splat_data(
-                ref_xyz, pd_hashtree.DECODER, d, ref_normal, return_nf_mask=True, check_corr=False)
+                ref_xyz, pd_hashtree.DECODER, d, ref_normal, return_nf_mask=True, check_corr=False,
+                chunk_size=self.hparams.tree_chunk_size)
             normal_data[d] = normal_data_depth / (pd_hashtree.get_stride(pd_hashtree.ENCODER, d) ** 3)
             if global_scale != 1.0:
                 normal_data[d] = normal_data[d] * global_scale
@@ -187,20 +256,35 @@ class Model(BaseModel):
         else:
             return mesh
 
-    def compute_loss(self, batch, out, compute_metric: bool):
-        loss_dict = exp.TorchLossMeter()
-        metric_dict = exp.TorchLossMeter()
-
-        # Learn structure
+    @staticmethod
+    def instance_mean(loss: torch.Tensor, hash_tree: HashTree, get_batch_ids):
+        """
+        Mean of per-element losses, in a packed batch every instance weighs the same (as if forwarded alone).
+        :param loss: (N, ) loss of each element (voxel or point)
+        :param get_batch_ids: callable returning the (N, ) instance ids of the elements, only called for batches.
+        """
+        if hash_tree.batch_size == 1:
+            return loss.mean()
+        batch_ids = get_batch_ids()
+        instance_loss = torch_scatter.scatter_mean(loss, batch_ids, dim=0, dim_size=hash_tree.batch_size)
+        return instance_loss[torch.bincount(batch_ids, minlength=hash_tree.batch_size) > 0].mean()
+
+    def compute_voxel_loss(self, batch, out, loss_dict, metric_dict, compute_metric: bool):
+        """
+        Losses supervised on the voxels of the predicted tree: structure and grid-level normal.
+        """
+        pd_tree = out['tree']
         hash_tree_gt = self.compute_gt_hashtree(batch, out)
         for feat_depth, struct_feat in out['structure_features'].items():
-            base_coords = out['tree'].get_coords(HashTree.DECODER_TMP, feat_depth)
+            base_coords = pd_tree.get_coords(HashTree.DECODER_TMP, feat_depth)
             gt_status = hash_tree_gt.evaluate_voxel_status(hash_tree_gt.ENCODER, base_coords, feat_depth)
-            loss_dict.add_loss(f"struct-{feat_depth}", F.cross_entropy(struct_feat, gt_status),
+            get_batch_ids = lambda: pd_tree.get_voxel_batch_ids(HashTree.DECODER_TMP, feat_depth)
+            loss_dict.add_loss(f"struct-{feat_depth}", self.instance_mean(
+                F.cross_entropy(struct_feat, gt_status, reduction='none'), pd_tree, get_batch_ids),
                                self.hparams.supervision.structure_weight)
             if compute_metric:
-                metric_dict.add_loss(f"struct-acc-{feat_depth}",
-                                     torch.mean((struct_feat.argmax(dim=1) == gt_status).float()))
+                metric_dict.add_loss(f"struct-acc-{feat_depth}", self.instance_mean(
+                    (struct_feat.argmax(dim=1) == gt_status).float(), pd_tree, get_batch_ids))
 
         # Supervise normal on grid level.
         if self.hparams.supervision.vox_normal.weight > 0.0:
@@ -209,13 +293,25 @@ class Model(BaseModel):
             depth_levels = set(gt_vox_normal.keys()).intersection(set(pd_vox_normal.keys()))
             for d in depth_levels:
                 gt_normal, pd_normal = gt_vox_normal[d], pd_vox_normal[d]
-                loss_dict.add_loss(f"vn-{d}", torch.abs(gt_normal - pd_normal).mean(),
+                loss_dict.add_loss(f"vn-{d}", self.instance_mean(
+                    torch.abs(gt_normal - pd_normal).mean(dim=1), pd_tree,
+                    lambda: pd_tree.get_voxel_batch_ids(HashTree.DECODER, d)),
                                    self.hparams.supervision.vox_normal.weight)
 
+    def compute_loss(self, batch, out, compute_metric: bool):
+        loss_dict = exp.TorchLossMeter()
+        metric_dict = exp.TorchLossMeter()
+
+        # Learn structure and grid-level normal
+        self.compute_voxel_loss(batch, out, loss_dict, metric_dict, compute_metric)
+
         reconstructor = out['reconstructor']
+        pd_tree = out['tree']
 
         # Learn geometry
-        ref_xyz, ref_normal = batch[DS.GT_DENSE_PC][0], batch[DS.GT_DENSE_NORMAL][0]
+        ref_xyz = pd_tree.pack_xyz(batch[DS.GT_DENSE_PC])
+        ref_normal = torch.cat(batch[DS.GT_DENSE_NORMAL], dim=0)
+        get_batch_ids = lambda: HashTree.get_list_batch_ids(batch[DS.GT_DENSE_PC])
 
         if self.hparams.supervision.surface_weight > 0.0:
             with exp.pt_profile_named("evaluate_chi"):
@@ -223,10 +319,11 @@ class Model(BaseModel):
             with exp.pt_profile_named("evaluate_raw_chi"):
                 pd_normal = reconstructor.evaluate_raw_chi(ref_xyz, compute_grad=True)
             pd_normal = -pd_normal / (torch.linalg.norm(pd_normal, dim=-1, keepdim=True) + 1.0e-6)
-            loss_dict.add_loss('chi', torch.abs(pd_chi).mean() / self.hparams.screening.delta,
-                               self.hparams.supervision.surface_weight)
+            loss_dict.add_loss('chi', self.instance_mean(torch.abs(pd_chi), pd_tree, get_batch_ids) /
+                               self.hparams.screening.delta, self.hparams.supervision.surface_weight)
             if self.hparams.supervision.grad_mult > 0.0:
-                loss_dict.add_loss('grad-chi', 1.0 - torch.sum(pd_normal * ref_normal, dim=-1).mean(),
+                loss_dict.add_loss('grad-chi', 1.0 - self.instance_mean(
+                    torch.sum(pd_normal * ref_normal, dim=-1), pd_tree, get_batch_ids),
                                    self.hparams.supervision.surface_weight * self.hparams.supervision.grad_mult)
 
         return loss_dict, metric_dict
@@ -275,6 +372,7 @@ class Model(BaseModel):
         return loss_sum
 
     def test_step(self, batch, batch_idx):
+        assert len(batch[DS.INPUT_PC]) == 1, "Test one shape at a time."
         self.log('source', batch[DS.SHAPE_NAME][0], on_epoch=False)
 
         input_pc = batch[DS.INPUT_PC][0]
@@ -1,5 +1,4 @@
 import torch
-import torch.nn.functional as F
 from pycg import exp
 from dataset.base import DatasetSpec as DS
 from models.full_net import Model as BaseModel
@@ -10,12 +9,11 @@ class Model(BaseModel):
         super().__init__(hparams)
 
     def forward(self, batch, out: dict):
-        input_xyz = batch[DS.INPUT_PC][0]
-        assert input_xyz.ndim == 2, "Can only forward single batch."
-
-        hash_tree = self.build_hashtree(input_xyz)
+        hash_tree = self.build_hashtree(batch[DS.INPUT_PC], batch_spacing=self.get_batch_spacing(batch, out))
+        assert hash_tree.batch_size == 1 or self.hparams.network.unet.enhance_level <= 1, \
+            "Feature enhancement does not support batches of several instances."
         unet_feat = self.encoder(
-            None if not self.hparams.use_input_normal else batch[DS.TARGET_NORMAL][0],
+            None if not self.hparams.use_input_normal else torch.cat(batch[DS.TARGET_NORMAL], dim=0),
             hash_tree
         )
         structure_features, normal_features, basis_features, w_features, _ = self.unet(
@@ -34,25 +32,7 @@ class Model(BaseModel):
         loss_dict = exp.TorchLossMeter()
         metric_dict = exp.TorchLossMeter()
 
-        # Learn structure
-        hash_tree_gt = self.compute_gt_hashtree(batch, out)
-        for feat_depth, struct_feat in out['structure_features'].items():
-            base_coords = out['tree'].get_coords(hash_tree_gt.DECODER_TMP, feat_depth)
-            gt_status = hash_tree_gt.evaluate_voxel_status(hash_tree_gt.ENCODER, base_coords, feat_depth)
-            loss_dict.add_loss(f"struct-{feat_depth}", F.cross_entropy(struct_feat, gt_status),
-                               self.hparams.supervision.structure_weight)
-            if compute_metric:
-                metric_dict.add_loss(f"struct-acc-{feat_depth}",
-                                     torch.mean((struct_feat.argmax(dim=1) == gt_status).float()))
-
-        # Supervise normal on grid level.
-        if self.hparams.supervision.vox_normal.weight > 0.0:
-            gt_vox_normal = self.compute_gt_normal_data(batch, out, 1.0)
-            pd_vox_normal = out['normal_data']
-            depth_levels = set(gt_vox_normal.keys()).intersection(set(pd_vox_normal.keys()))
-            for d in depth_levels:
-                gt_normal, pd_normal = gt_vox_normal[d], pd_vox_normal[d]
-                loss_dict.add_loss(f"vn-{d}", torch.abs(gt_normal - pd_normal).mean(),
-                                   self.hparams.supervision.vox_normal.weight)
+        # Learn structure and grid-level normal
+        self.compute_voxel_loss(batch, out, loss_dict, metric_dict, compute_metric)
 
         return loss_dict, metric_dict
@@ -59,7 +59,9 @@ setup(
     author_email='huangjh.work@outlook.com',
     keywords=['pytorch', 'spsr', '3d', 'reconstruction'],
     python_requires='>=3.7',
-    install_requires=[],
+    install_requires=['scipy'],
+    # CHOLMOD for the CPU direct solver, SuperLU from scipy is used without it.
+    extras_require={'cholmod': ['scikit-sparse']},
     ext_modules=get_extensions(),
     cmdclass={
         'build_ext':
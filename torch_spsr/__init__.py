@@ -1,12 +1,13 @@
 import torch
-from typing import Tuple
+from typing import Tuple, List
 
 __version__ = '1.0.0'
 __version_info__ = (1, 0, 0)
 
 
 def reconstruct(xyz: torch.Tensor, normal: torch.Tensor, voxel_size: float, depth: int = 4,
-                min_density: float = 32.0, screen_alpha: float = 4.0) -> Tuple[torch.Tensor, torch.Tensor]:
+                min_density: float = 32.0, screen_alpha: float = 4.0,
+                chunk_size: int = None) -> Tuple[torch.Tensor, torch.Tensor]:
     """
     A utility function, that reconstructs a triangle mesh given input points and normals.
     :param xyz: (N, 3) float32 cuda tensor
@@ -15,21 +16,62 @@ def reconstruct(xyz: torch.Tensor, normal: torch.Tensor, voxel_size: float, dept
     :param depth: int, total depth of the tree
     :param min_density: float, density for determine point layering
     :param screen_alpha: float, weight of the screening term
+    :param chunk_size: int, if set, tree building and normal splatting process at most this many (point, voxel)
+        pairs at once, which bounds their memory on very large point clouds.
     :return: vertices (V, 3) torch.Tensor, triangles (T, 3) torch.Tensor
     """
     from torch_spsr.core.hashtree import HashTree
-    from torch_spsr.core.reconstructor import Reconstructor
 
+    _check_input(xyz, normal)
+    hash_tree = HashTree(xyz, voxel_size=voxel_size, depth=depth)
+    return _reconstruct_tree(hash_tree, xyz, normal, min_density, screen_alpha, chunk_size)
+
+
+def reconstruct_batch(xyz: List[torch.Tensor], normal: List[torch.Tensor], voxel_size: float, depth: int = 4,
+                      min_density: float = 32.0, screen_alpha: float = 4.0,
+                      chunk_size: int = None) -> List[Tuple[torch.Tensor, torch.Tensor]]:
+    """
+    Same as reconstruct, but for several instances at once: they are packed into one tree (HashTree.from_batch)
+    and solved as a single (block-diagonal) system.
+    :param xyz: list of (N_b, 3) float32 cuda tensor
+    :param normal: list of (N_b, 3) float32 cuda tensor
+    :return: list of (vertices (V_b, 3) torch.Tensor, triangles (T_b, 3) torch.Tensor)
+    """
+    from torch_spsr.core.hashtree import HashTree
+
+    assert len(xyz) == len(normal), "Each instance should have positions and normals!"
+    for instance_xyz, instance_normal in zip(xyz, normal):
+        _check_input(instance_xyz, instance_normal)
+    hash_tree = HashTree.from_batch(xyz, voxel_size=voxel_size, depth=depth)
+    vertices, triangles = _reconstruct_tree(
+        hash_tree, hash_tree.xyz, torch.cat(normal, dim=0), min_density, screen_alpha, chunk_size)
+
+    # Split the packed mesh into instances.
+    vertices, vert_batch_ids = hash_tree.unpack_xyz(vertices)
+    tri_batch_ids = vert_batch_ids[triangles[:, 0].long()]
+    meshes = []
+    for b in range(hash_tree.batch_size):
+        vert_mask = vert_batch_ids == b
+        vert_remap = torch.cumsum(vert_mask, dim=0) - 1
+        meshes.append((vertices[vert_mask], vert_remap[triangles[tri_batch_ids == b].long()].to(triangles.dtype)))
+    return meshes
+
+
+def _check_input(xyz: torch.Tensor, normal: torch.Tensor):
     assert xyz.size(0) == normal.size(0) and xyz.size(1) == normal.size(1) == 3, \
         "Input positions and normals should have same size (N, 3)!"
-    assert xyz.is_cuda and normal.is_cuda, "Input should be on the device!"
+    # Only the linear solvers have a CPU path, the screening term and mesh extraction are CUDA kernels.
+    assert xyz.is_cuda and normal.is_cuda, "Input should be on the device, reconstruction is CUDA-only!"
     assert xyz.dtype == normal.dtype == torch.float32, "Input should have dtype == float32"
 
+
+def _reconstruct_tree(hash_tree, xyz: torch.Tensor, normal: torch.Tensor, min_density: float,
+                      screen_alpha: float, chunk_size: int):
+    from torch_spsr.core.reconstructor import Reconstructor
     from torch_spsr.bases.bezier_tensor import BezierTensorBasis
 
     # Build the tree based on given positions
-    hash_tree = HashTree(xyz, voxel_size=voxel_size, depth=depth)
-    hash_tree.build_encoder_hierarchy_adaptive(min_density=min_density)
+    hash_tree.build_encoder_hierarchy_adaptive(min_density=min_density, chunk_size=chunk_size)
     hash_tree.reflect_decoder_coords()
 
     # Splat point normals onto the tree
@@ -40,7 +82,8 @@ def reconstruct(xyz: torch.Tensor, normal: torch.Tensor, voxel_size: float, dept
         if not torch.any(depth_mask):
             continue
         normal_data_depth = hash_tree.splat_data(
-            xyz[depth_mask], hash_tree.DECODER, d, normal[depth_mask] * sample_weight[depth_mask, None])
+            xyz[depth_mask], hash_tree.DECODER, d, normal[depth_mask] * sample_weight[depth_mask, None],
+            chunk_size=chunk_size)
         normal_data[d] = normal_data_depth / (hash_tree.get_stride(hash_tree.DECODER, d) ** 3)
 
     # Perform reconstruction
@@ -1,4 +1,6 @@
 import os
+import tempfile
+import contextlib
 from pathlib import Path
 
 import tqdm
@@ -7,11 +9,12 @@ import torch_scatter
 from typing import List, Union, Tuple, Dict
 from torch_spsr.bases.additive_components import *
 from torch_spsr.bases.abc import BaseBasis
-from torch_spsr.ext import integration
+from torch_spsr.ext import integration, ddi_forward_cpu, ddi_backward_cpu
 
 import itertools
 import functools
 from multiprocessing import Pool
+from numpy.polynomial import Polynomial
 
 
 def _integrate_ff(multiple_dx, func_i, func_j, x):
@@ -52,86 +55,342 @@ def _integrate_f_inv(multiple_ra, func_i, x):
     return multiple, ra, sp.integrate(func_i, (x, lb, ub)), sp.integrate(d_func_i, (x, lb, ub))
 
 
+def _transform_pieces(pieces, scale=1.0, shift=0.0):
+    """
+    Pieces of f(scale * x + shift) given the pieces of f, scale should be positive.
+    """
+    arg = Polynomial([shift, scale])
+    return [((lb - shift) / scale, (ub - shift) / scale, poly(arg)) for lb, ub, poly in pieces]
+
+
+def _differentiate_pieces(pieces):
+    return [(lb, ub, poly.deriv()) for lb, ub, poly in pieces]
+
+
+def _integrate_pieces(pieces, lb, ub):
+    """
+    Integrate the piecewise polynomial over [lb, ub] in closed form.
+    """
+    if lb > ub:
+        return -_integrate_pieces(pieces, ub, lb)
+    res = 0.0
+    for p_lb, p_ub, poly in pieces:
+        lo, hi = max(p_lb, lb), min(p_ub, ub)
+        if lo < hi:
+            anti_poly = poly.integ()
+            res += anti_poly(hi) - anti_poly(lo)
+    return res
+
+
+def _integrate_ff_poly(multiple_dx, pieces_i, pieces_j):
+    """
+    Same as _integrate_ff, for piecewise polynomial functions.
+    """
+    multiple, dx = multiple_dx
+    stride = 2 ** multiple
+    # Integrate in the local frame of func_i (u = x + dx): expanding func_i(x + dx) instead loses precision.
+    pieces_j = _transform_pieces(pieces_j, scale=1.0 / stride, shift=-dx / stride)
+    d_pieces_ij = multiply_pieces(_differentiate_pieces(pieces_i), _differentiate_pieces(pieces_j))
+    return multiple, dx, _integrate_pieces(multiply_pieces(pieces_i, pieces_j), -100. + dx, 100. + dx), \
+           _integrate_pieces(d_pieces_ij, -100. + dx, 100. + dx)
+
+
+def _integrate_f_poly(multiple_ra, pieces_i):
+    """
+    Same as _integrate_f, for piecewise polynomial functions.
+    """
+    multiple, ra = multiple_ra
+    stride = 2 ** multiple
+    pieces_i = _transform_pieces(pieces_i, scale=1.0 / stride)
+    return multiple, ra, _integrate_pieces(pieces_i, ra, ra + 1), \
+           _integrate_pieces(_differentiate_pieces(pieces_i), ra, ra + 1)
+
+
+def _integrate_f_inv_poly(multiple_ra, pieces_i):
+    """
+    Same as _integrate_f_inv, for piecewise polynomial functions.
+    """
+    multiple, ra = multiple_ra
+    stride = 2 ** multiple
+    lb, ub = max(ra, -1.5), min(ra + stride, 1.5)
+    return multiple, ra, _integrate_pieces(pieces_i, lb, ub), \
+           _integrate_pieces(_differentiate_pieces(pieces_i), lb, ub)
+
+
+def _run_integral_job(job):
+    integrate_func, args = job
+    return integrate_func(args)
+
+
+def _get_integral_jobs(comps, n_multiples):
+    """
+    List the integrals needed by one cached table.
+    :param comps: (ca, cb) for the ff table of a component pair, or (ca, ) for the f table of a component
+    :param n_multiples: int
+    :return: list of (group, (integrate_func, args)), and whether they are all computed in closed form.
+    """
+    pieces = [comp.piecewise_polynomial() for comp in comps]
+    closed_form = all(p is not None for p in pieces)
+    x = sp.Symbol('x')
+    if len(comps) == 2:
+        if closed_form:
+            ff_func = functools.partial(_integrate_ff_poly, pieces_i=pieces[0], pieces_j=pieces[1])
+        else:
+            ff_func = functools.partial(_integrate_ff, func_i=comps[0].symbolic(x), func_j=comps[1].symbolic(x), x=x)
+        return [("ff", (ff_func, (m, dx))) for m in range(n_multiples)
+                for dx in np.arange(-1.5 * (2 ** m) - 0.5, 1.5 * (2 ** m) + 1.5)], closed_form
+
+    if closed_form:
+        f_func = functools.partial(_integrate_f_poly, pieces_i=pieces[0])
+        f_inv_func = functools.partial(_integrate_f_inv_poly, pieces_i=pieces[0])
+    else:
+        f_func = functools.partial(_integrate_f, func_i=comps[0].symbolic(x), x=x)
+        f_inv_func = functools.partial(_integrate_f_inv, func_i=comps[0].symbolic(x), x=x)
+    return [("f", (f_func, (m, ra))) for m in range(n_multiples)
+            for ra in np.arange(-1.5 * (2 ** m), 1.5 * (2 ** m))] + \
+           [("f_inv", (f_inv_func, (m, ra))) for m in range(1, n_multiples)
+            for ra in np.arange(-(2 ** m) - 0.5, 1.5)], closed_form
+
+
+def _save_integral_table(path, results, n_multiples):
+    """
+    Arrange the integral values as the cached table format and save it atomically.
+    :param path: Path of the npz file
+    :param results: dict from group to the list of (multiple, x, val, d_val), in the order of the jobs.
+    :param n_multiples: int
+    """
+    if "ff" in results:
+        f_f_values = [[] for _ in range(n_multiples)]
+        df_df_values = [[] for _ in range(n_multiples)]
+        for multiple, dx, val, d_val in results["ff"]:
+            f_f_values[multiple].append(float(val))
+            df_df_values[multiple].append(float(d_val))
+        tables = {"f_f": f_f_values, "df_df": df_df_values}
+    else:
+        f_values = [[] for _ in range(n_multiples)]
+        df_values = [[] for _ in range(n_multiples)]
+        for multiple, ra, val, d_val in results["f"]:
+            f_values[multiple].insert(0, float(val))
+            df_values[multiple].insert(0, float(d_val))
+        f_inv_values = [[] for _ in range(n_multiples - 1)]
+        df_inv_values = [[] for _ in range(n_multiples - 1)]
+        for multiple, ra, val, d_val in results["f_inv"]:
+            f_inv_values[multiple - 1].insert(0, float(val))
+            df_inv_values[multiple - 1].insert(0, float(d_val))
+        tables = {"f": f_values, "df": df_values, "f_inv": f_inv_values, "df_inv": df_inv_values}
+
+    # Each table has one list per multiple with different lengths, stored as object arrays.
+    arrays = {}
+    for name, values in tables.items():
+        arrays[name] = np.empty(len(values), dtype=object)
+        for mi, mult_values in enumerate(values):
+            arrays[name][mi] = mult_values
+
+    # Write to a temporary file next to the target and rename, so that readers never see a partial file.
+    tmp_fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=path.name + ".", suffix=".tmp")
+    try:
+        with os.fdopen(tmp_fd, "wb") as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+@contextlib.contextmanager
+def _lock_integral_tables(paths):
+    """
+    Hold exclusive locks of the cached tables, so that concurrent processes do not compute or write the same table.
+        Locks are acquired in sorted order to avoid deadlocks, and the lock files are removed on release.
+    Without fcntl (non-POSIX platforms) nothing is locked, tables are still written atomically.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+
+    lock_files = []
+    try:
+        for path in sorted(paths):
+            lock_path = path.with_name(path.name + ".lock")
+            while True:
+                lock_file = open(lock_path, "w")
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                # The previous holder might have removed the file while we were waiting: retry on the new one.
+                try:
+                    lock_stat, path_stat = os.fstat(lock_file.fileno()), os.stat(lock_path)
+                    if (lock_stat.st_dev, lock_stat.st_ino) == (path_stat.st_dev, path_stat.st_ino):
+                        break
+                except FileNotFoundError:
+                    pass
+                lock_file.close()
+            lock_files.append((lock_path, lock_file))
+        yield
+    finally:
+        for lock_path, lock_file in lock_files:
+            # Unlink while still holding the lock, so that waiters notice and retry.
+            try:
+                os.remove(lock_path)
+            except OSError:
+                pass
+            lock_file.close()
+
+
+def _get_n_processes():
+    """
+    Number of cores available to this process.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
 class DDIFunc(torch.autograd.Function):
     """
     Differentiable function that computes nabla_B_k^T nabla_B_l
     """
     @staticmethod
     def forward(ctx, source_expanded, target_expanded, rel_pos, f_f_i, df_df_i):
-        p_mats, q_mats = integration.ddi_forward(source_expanded, target_expanded, rel_pos, f_f_i, df_df_i)
+        ddi_forward = integration.ddi_forward if source_expanded.is_cuda else ddi_forward_cpu
+        p_mats, q_mats = ddi_forward(source_expanded, target_expanded, rel_pos, f_f_i, df_df_i)
         ctx.save_for_backward(rel_pos, source_expanded, target_expanded, f_f_i, df_df_i)
         return p_mats, q_mats
 
     @staticmethod
     def backward(ctx, grad_p, grad_q):
         rel_pos, source_expanded, target_expanded, f_f_i, df_df_i = ctx.saved_tensors
-        grad_s, grad_t = integration.ddi_backward(source_expanded, target_expanded, rel_pos, f_f_i, df_df_i, grad_p, grad_q)
+        ddi_backward = integration.ddi_backward if source_expanded.is_cuda else ddi_backward_cpu
+        grad_s, grad_t = ddi_backward(source_expanded, target_expanded, rel_pos, f_f_i, df_df_i, grad_p, grad_q)
         return grad_s, grad_t, None, None, None
 
 
+def _evaluate_components(components, xyz, compute_derivative=False):
+    """
+    Evaluate all the components in one pass.
+    :param components: list of AdditiveComponent (C of them, could be empty)
+    :param xyz: torch.Tensor (N, 3)
+    :param compute_derivative: bool, whether to also evaluate the derivatives
+    :return: torch.Tensor (N, C, 3) component values, (and the same-sized derivatives if compute_derivative)
+    """
+    if len(components) == 0:
+        empty = xyz.new_zeros(xyz.size(0), 0, 3)
+        return (empty, empty) if compute_derivative else empty
+    if not compute_derivative:
+        return torch.stack([comp.evaluate(xyz) for comp in components], dim=1)
+    vals, derivs = zip(*[comp.evaluate_with_derivative(xyz) for comp in components])
+    return torch.stack(vals, dim=1), torch.stack(derivs, dim=1)
+
+
+def _evaluate_monomials(xyz, n_poly, compute_derivative=False):
+    """
+    Build the monomial table x^p (p = 0 ~ n_poly-1) with cumulative products instead of pow.
+    :param xyz: torch.Tensor (N, 3)
+    :param n_poly: int, number of monomials
+    :param compute_derivative: bool, whether to also build the derivatives p * x^(p-1)
+    :return: torch.Tensor (N, n_poly, 3) monomials, (and the same-sized derivatives if compute_derivative)
+    """
+    mono_vals = torch.cat([torch.ones_like(xyz)[:, None],
+                           xyz[:, None, :].expand(-1, max(n_poly - 1, 0), -1).cumprod(dim=1)], dim=1)[:, :n_poly]
+    if not compute_derivative:
+        return mono_vals
+    powers = torch.arange(1, n_poly, dtype=xyz.dtype, device=xyz.device)
+    mono_derivs = torch.cat([torch.zeros_like(xyz)[:, None],
+                             mono_vals[:, :-1] * powers[None, :, None]], dim=1)[:, :n_poly]
+    return mono_vals, mono_derivs
+
+
+def _evaluate_horner(poly_coeffs, xyz, compute_derivative=False):
+    """
+    Evaluate the polynomial sum_p c_p x^p (and its derivative) with Horner's scheme.
+    :param poly_coeffs: torch.Tensor (N, P, 3), coefficients c_p in ascending power order
+    :param xyz: torch.Tensor (N, 3)
+    :param compute_derivative: bool, whether to also evaluate the derivative
+    :return: torch.Tensor (N, 3) polynomial value, (and derivative if compute_derivative)
+    """
+    val = torch.zeros_like(xyz)
+    deriv = torch.zeros_like(xyz)
+    for p in range(poly_coeffs.size(1) - 1, -1, -1):
+        if compute_derivative:
+            deriv = torch.addcmul(val, deriv, xyz)
+        val = torch.addcmul(poly_coeffs[:, p], val, xyz)
+    return (val, deriv) if compute_derivative else val
+
+
 class EvalFunc(torch.autograd.Function):
     """
     Differentiable function that evaluate the additive basis function
+        The last n_poly components are Power(0) ~ Power(n_poly-1), evaluated together as a polynomial.
     """
     @staticmethod
-    def forward(ctx, xyz, coeffs, feat_ids, components):
-        funcs = 0
+    def forward(ctx, xyz, coeffs, feat_ids, components, n_poly=0):
+        n_comp = len(components) - n_poly
         with torch.no_grad():
-            for ci, comp in enumerate(components):
-                funcs += comp.evaluate(xyz) * coeffs[feat_ids, ci * 3: ci * 3 + 3]
+            feat_coeffs = coeffs[feat_ids].view(xyz.size(0), len(components), 3)
+            comp_vals = _evaluate_components(components[:n_comp], xyz)
+            funcs = (comp_vals * feat_coeffs[:, :n_comp]).sum(dim=1) + \
+                    _evaluate_horner(feat_coeffs[:, n_comp:], xyz)
 
-        ctx.save_for_backward(xyz, feat_ids)
-        ctx.components = components
+        # Component values are kept for backward only if the coefficients need gradient.
+        ctx.save_for_backward(xyz, feat_ids, comp_vals if ctx.needs_input_grad[1] else None)
         ctx.coeff_size = coeffs.size(0)
+        ctx.n_poly = n_poly
 
         return funcs
 
     @staticmethod
     def backward(ctx, grad_funcs):
-        xyz, feat_ids = ctx.saved_tensors
-        components = ctx.components
+        xyz, feat_ids, comp_vals = ctx.saved_tensors
+        if comp_vals is None:
+            return None, None, None, None, None
 
-        grad_coeffs = []
         with torch.no_grad():
-            for ci, comp in enumerate(components):
-                cur_func = comp.evaluate(xyz)
-                grad_coeffs.append(torch_scatter.scatter_sum(grad_funcs * cur_func,
-                                                             feat_ids, dim=0, dim_size=ctx.coeff_size))
-        return None, torch.cat(grad_coeffs, dim=1), None, None
+            mono_vals = _evaluate_monomials(xyz, ctx.n_poly)
+            grad_vals = grad_funcs[:, None, :] * torch.cat([comp_vals, mono_vals], dim=1)
+            grad_coeffs = torch_scatter.scatter_sum(grad_vals.view(grad_vals.size(0), -1),
+                                                    feat_ids, dim=0, dim_size=ctx.coeff_size)
+        return None, grad_coeffs, None, None, None
 
 
 class EvalDerivFunc(torch.autograd.Function):
     """
     Differentiable function that evaluate the derivative of the additive basis function
+        The last n_poly components are Power(0) ~ Power(n_poly-1), evaluated together as a polynomial.
     """
     @staticmethod
-    def forward(ctx, xyz, coeffs, feat_ids, components, stride):
-        funcs = 0
-        dfuncs = 0
+    def forward(ctx, xyz, coeffs, feat_ids, components, stride, n_poly=0):
+        n_comp = len(components) - n_poly
         with torch.no_grad():
-            for ci, comp in enumerate(components):
-                funcs += comp.evaluate(xyz) * coeffs[feat_ids, ci * 3: ci * 3 + 3]
-                dfuncs += comp.evaluate_derivative(xyz) * coeffs[feat_ids, ci * 3: ci * 3 + 3] / stride
-
-        ctx.save_for_backward(xyz, feat_ids)
-        ctx.components = components
+            feat_coeffs = coeffs[feat_ids].view(xyz.size(0), len(components), 3)
+            comp_vals, comp_derivs = _evaluate_components(components[:n_comp], xyz, compute_derivative=True)
+            comp_derivs /= stride
+            poly_funcs, poly_dfuncs = _evaluate_horner(feat_coeffs[:, n_comp:], xyz, compute_derivative=True)
+            funcs = (comp_vals * feat_coeffs[:, :n_comp]).sum(dim=1) + poly_funcs
+            dfuncs = (comp_derivs * feat_coeffs[:, :n_comp]).sum(dim=1) + poly_dfuncs / stride
+
+        if ctx.needs_input_grad[1]:
+            ctx.save_for_backward(xyz, feat_ids, comp_vals, comp_derivs)
+        else:
+            ctx.save_for_backward(xyz, feat_ids, None, None)
         ctx.coeff_size = coeffs.size(0)
         ctx.stride = stride
+        ctx.n_poly = n_poly
         return funcs, dfuncs
 
     @staticmethod
     def backward(ctx, grad_funcs, grad_dfuncs):
-        xyz, feat_ids = ctx.saved_tensors
-        components = ctx.components
+        xyz, feat_ids, comp_vals, comp_derivs = ctx.saved_tensors
+        if comp_vals is None:
+            return None, None, None, None, None, None
 
-        grad_coeffs = []
         with torch.no_grad():
-            for ci, comp in enumerate(components):
-                cur_func = comp.evaluate(xyz)
-                cur_func_deriv = comp.evaluate_derivative(xyz) / ctx.stride
-                grad_coeffs.append(torch_scatter.scatter_sum(grad_funcs * cur_func + grad_dfuncs * cur_func_deriv,
-                                                             feat_ids, dim=0, dim_size=ctx.coeff_size))
-        return None, torch.cat(grad_coeffs, dim=1), None, None, None
+            mono_vals, mono_derivs = _evaluate_monomials(xyz, ctx.n_poly, compute_derivative=True)
+            grad_vals = grad_funcs[:, None, :] * torch.cat([comp_vals, mono_vals], dim=1) + \
+                        grad_dfuncs[:, None, :] * torch.cat([comp_derivs, mono_derivs / ctx.stride], dim=1)
+            grad_coeffs = torch_scatter.scatter_sum(grad_vals.view(grad_vals.size(0), -1),
+                                                    feat_ids, dim=0, dim_size=ctx.coeff_size)
+        return None, grad_coeffs, None, None, None, None
 
 
 class AdditiveBasis(BaseBasis):
@@ -168,86 +427,103 @@ class AdditiveBasis(BaseBasis):
 
         self.ff_integral = self._convert_parameter(ff_integral_dict, "ff_integral")
         self.f_integral = self._convert_parameter(f_integral_dict, "f_integral")
+        self.n_poly = self._get_polynomial_size(self.components)
+
+    @staticmethod
+    def _get_polynomial_size(components: List[AdditiveComponent]) -> int:
+        """
+        Length of the trailing Power(0), Power(1), ..., Power(n) run of the components.
+            These are evaluated together as one polynomial (with Horner's scheme) instead of one by one.
+        :param components: list of AdditiveComponent
+        :return: int. n+1, or 0 if the components do not end with such a run.
+        """
+        for start in range(len(components)):
+            if all(isinstance(comp, Power) and comp.power == p for p, comp in enumerate(components[start:])):
+                return len(components) - start
+        return 0
+
+    @staticmethod
+    def _get_cache_path(name: str) -> Tuple[bool, Path]:
+        """
+        Find the cached integral table, shipped with the package or computed into the home folder.
+        :param name: str, file name of the table
+        :return: whether the table exists, and its path.
+        """
+        package_path = Path(__file__).parent.parent / "data" / "additive_integrals"
+        cache_path = Path.home() / ".torch_spsr" / "additive_integrals"
+        if (package_path / name).exists():
+            return True, package_path / name
+        cache_path.mkdir(parents=True, exist_ok=True)
+        return (cache_path / name).exists(), cache_path / name
 
     def _get_integrals(self, n_multiples: int = 5) -> Tuple[Dict, Dict]:
         """
         Precompute the integrals mentioned in Appendix B.
         :param n_multiples, int is
         """
-        ff_integral_dict = {}
-        f_integral_dict = {}
-
-        def get_cache_path(name):
-            package_path = Path(__file__).parent.parent / "data" / "additive_integrals"
-            cache_path = Path.home() / ".torch_spsr" / "additive_integrals"
-            if (package_path / name).exists():
-                return True, package_path / name
-            cache_path.mkdir(parents=True, exist_ok=True)
-            return (cache_path / name).exists(), cache_path / name
+        ff_paths = {}
+        f_paths = {}
+        missing_tables = {}
 
         for (ai, ca), (bi, cb) in itertools.product(enumerate(self.components), repeat=2):
-            ni_exist, ni_path = get_cache_path(f"ff-{ca}-{cb}.npz")
-            if ni_exist:
-                data_dict = np.load(ni_path, allow_pickle=True)
-                ff_integral_dict[f"{ai},{bi}"] = dict(data_dict)
-                continue
-            print("Computing integral for pair", ca, cb)
-
-            x = sp.Symbol('x')
-            func_i = ca.symbolic(x)
-            func_j = cb.symbolic(x)
-            f_f_values = [[] for _ in range(n_multiples)]
-            df_df_values = [[] for _ in range(n_multiples)]
-            with Pool(24) as p:
-                m_dx = [(m, dx) for m in range(n_multiples)
-                        for dx in np.arange(-1.5 * (2 ** m) - 0.5, 1.5 * (2 ** m) + 1.5)]
-                for multiple, dx, val, d_val in tqdm.tqdm(p.imap(
-                    functools.partial(_integrate_ff, func_i=func_i, func_j=func_j, x=x), m_dx
-                ), total=len(m_dx)):
-                    f_f_values[multiple].append(float(val))
-                    df_df_values[multiple].append(float(d_val))
-            np.savez_compressed(ni_path, f_f=f_f_values, df_df=df_df_values)
-
-            return self._get_integrals()
+            ni_exist, ff_paths[f"{ai},{bi}"] = self._get_cache_path(f"ff-{ca}-{cb}.npz")
+            if not ni_exist:
+                missing_tables[ff_paths[f"{ai},{bi}"]] = (ca, cb)
 
         for (ai, ca) in enumerate(self.components):
-            ni_exist, ni_path = get_cache_path(f"f-{ca}.npz")
-            if ni_exist:
-                data_dict = np.load(ni_path, allow_pickle=True)
-                f_integral_dict[ai] = dict(data_dict)
-                continue
-            print("Computing integral", ca)
-
-            x = sp.Symbol('x')
-            func_i = ca.symbolic(x)
-
-            f_values = [[] for _ in range(n_multiples)]
-            df_values = [[] for _ in range(n_multiples)]
-            with Pool(24) as p:
-                m_ra = [(m, ra) for m in range(n_multiples)
-                        for ra in np.arange(-1.5 * (2 ** m), 1.5 * (2 ** m))]
-                for multiple, ra, val, d_val in tqdm.tqdm(p.imap(
-                    functools.partial(_integrate_f, func_i=func_i, x=x), m_ra
-                ), total=len(m_ra)):
-                    f_values[multiple].insert(0, float(val))
-                    df_values[multiple].insert(0, float(d_val))
-
-            f_inv_values = [[] for _ in range(n_multiples - 1)]
-            df_inv_values = [[] for _ in range(n_multiples - 1)]
-            with Pool(24) as p:
-                m_ra = [(m, ra) for m in range(1, n_multiples)
-                        for ra in np.arange(-(2 ** m) - 0.5, 1.5)]
-                for multiple, ra, val, d_val in tqdm.tqdm(p.imap(
-                    functools.partial(_integrate_f_inv, func_i=func_i, x=x), m_ra
-                ), total=len(m_ra)):
-                    f_inv_values[multiple - 1].insert(0, float(val))
-                    df_inv_values[multiple - 1].insert(0, float(d_val))
-
-            np.savez_compressed(ni_path, f=f_values, df=df_values, f_inv=f_inv_values, df_inv=df_inv_values)
-
-            return self._get_integrals()
+            ni_exist, f_paths[ai] = self._get_cache_path(f"f-{ca}.npz")
+            if not ni_exist:
+                missing_tables[f_paths[ai]] = (ca, )
+
+        if len(missing_tables) > 0:
+            self._precompute_integrals(missing_tables, n_multiples)
+
+        ff_integral_dict = {key: dict(np.load(path, allow_pickle=True)) for key, path in ff_paths.items()}
+        f_integral_dict = {key: dict(np.load(path, allow_pickle=True)) for key, path in f_paths.items()}
         return ff_integral_dict, f_integral_dict
 
+    @staticmethod
+    def _precompute_integrals(missing_tables: Dict[Path, Tuple], n_multiples: int) -> None:
+        """
+        Compute all the missing integral tables in one go and save them into the cache.
+            Piecewise polynomial components are integrated in closed form, the others with sympy on a process pool
+        sized to the available cores. Tables are locked during the computation.
+        :param missing_tables: dict from the table path to its components, (ca, cb) for ff and (ca, ) for f tables
+        :param n_multiples: int
+        """
+        with _lock_integral_tables(missing_tables.keys()):
+            # Tables might have been written by another process while we were waiting for the locks.
+            missing_tables = {path: comps for path, comps in missing_tables.items() if not path.exists()}
+
+            closed_jobs, sympy_jobs = [], []
+            n_remaining = {}
+            for path, comps in missing_tables.items():
+                table_jobs, closed_form = _get_integral_jobs(comps, n_multiples)
+                (closed_jobs if closed_form else sympy_jobs).extend([(path, group, job) for group, job in table_jobs])
+                n_remaining[path] = len(table_jobs)
+
+            table_results = {path: {} for path in missing_tables.keys()}
+
+            def collect(path, group, res):
+                table_results[path].setdefault(group, []).append(res)
+                n_remaining[path] -= 1
+                if n_remaining[path] == 0:
+                    _save_integral_table(path, table_results.pop(path), n_multiples)
+
+            if len(closed_jobs) > 0:
+                print(f"Computing {len(closed_jobs)} integrals in closed form")
+                for path, group, job in closed_jobs:
+                    collect(path, group, _run_integral_job(job))
+
+            if len(sympy_jobs) > 0:
+                n_processes = min(_get_n_processes(), len(sympy_jobs))
+                print(f"Computing {len(sympy_jobs)} integrals with sympy, using {n_processes} processes")
+                with Pool(n_processes) as p:
+                    sympy_res = p.imap(_run_integral_job, [job for _, _, job in sympy_jobs],
+                                       chunksize=max(len(sympy_jobs) // (n_processes * 8), 1))
+                    for (path, group, _), res in tqdm.tqdm(zip(sympy_jobs, sympy_res), total=len(sympy_jobs)):
+                        collect(path, group, res)
+
     def _convert_parameter(self, val, name):
         """
         Convert value into class torch parameters, so that device could be managed automatically.
@@ -299,7 +575,7 @@ class AdditiveBasis(BaseBasis):
         """
         assert feat_ids.size(0) == xyz.size(0), "Input sizes not equal!"
         coeffs = self.feature_to_coefficient(feat)
-        funcs = EvalFunc().apply(xyz, coeffs, feat_ids, self.components)
+        funcs = EvalFunc().apply(xyz, coeffs, feat_ids, self.components, self.n_poly)
         return funcs[:, 0] * funcs[:, 1] * funcs[:, 2]
 
     def evaluate_derivative(self, feat: torch.Tensor, xyz: torch.Tensor,
@@ -312,7 +588,7 @@ class AdditiveBasis(BaseBasis):
         :return: evaluated derivative: torch.Tensor (N, 3)
         """
         coeffs = self.feature_to_coefficient(feat)
-        funcs, dfuncs = EvalDerivFunc().apply(xyz, coeffs, feat_ids, self.components, stride)
+        funcs, dfuncs = EvalDerivFunc().apply(xyz, coeffs, feat_ids, self.components, stride, self.n_poly)
         return torch.stack([dfuncs[:, 0] * funcs[:, 1] * funcs[:, 2],
                             funcs[:, 0] * dfuncs[:, 1] * funcs[:, 2],
                             funcs[:, 0] * funcs[:, 1] * dfuncs[:, 2]], dim=1)
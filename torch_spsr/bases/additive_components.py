@@ -1,9 +1,20 @@
 import math
 import sympy as sp
 import torch
+from numpy.polynomial import Polynomial
 from abc import ABC, abstractmethod
 
 
+def multiply_pieces(pieces_a, pieces_b):
+    """
+    Product of two piecewise polynomials given as lists of (lb, ub, Polynomial), see
+        AdditiveComponent.piecewise_polynomial.
+    """
+    return [(max(lb_a, lb_b), min(ub_a, ub_b), poly_a * poly_b)
+            for lb_a, ub_a, poly_a in pieces_a for lb_b, ub_b, poly_b in pieces_b
+            if max(lb_a, lb_b) < min(ub_a, ub_b)]
+
+
 class AdditiveComponent(ABC):
     """
     Abstract base class for all elementary functions q_u (x)
@@ -46,6 +57,22 @@ class AdditiveComponent(ABC):
         """
         pass
 
+    def evaluate_with_derivative(self, xyz):
+        """
+        Evaluate the function and its gradient together, override to share the intermediate terms.
+        :param xyz: torch.Tensor, supposed to be arbitrary shape
+        :return: (torch.Tensor, torch.Tensor), function value and gradient, same shape as xyz
+        """
+        return self.evaluate(xyz), self.evaluate_derivative(xyz)
+
+    def piecewise_polynomial(self):
+        """
+        Describe the function as polynomial pieces, so that its integrals could be computed in closed form.
+        :return: list of (lb, ub, Polynomial), the function is zero outside all the [lb, ub) intervals.
+            None if the function is not piecewise polynomial.
+        """
+        return None
+
 
 class Product(AdditiveComponent):
     """
@@ -69,6 +96,18 @@ class Product(AdditiveComponent):
         return self.ca.evaluate(xyz) * self.cb.evaluate_derivative(xyz) + \
                self.ca.evaluate_derivative(xyz) * self.cb.evaluate(xyz)
 
+    def evaluate_with_derivative(self, xyz):
+        ca_val, ca_deriv = self.ca.evaluate_with_derivative(xyz)
+        cb_val, cb_deriv = self.cb.evaluate_with_derivative(xyz)
+        return ca_val * cb_val, ca_val * cb_deriv + ca_deriv * cb_val
+
+    def piecewise_polynomial(self):
+        pieces_a = self.ca.piecewise_polynomial()
+        pieces_b = self.cb.piecewise_polynomial()
+        if pieces_a is None or pieces_b is None:
+            return None
+        return multiply_pieces(pieces_a, pieces_b)
+
 
 class Power(AdditiveComponent):
     """
@@ -98,6 +137,17 @@ class Power(AdditiveComponent):
             return torch.ones_like(xyz)
         return self.power * (xyz ** (self.power - 1))
 
+    def evaluate_with_derivative(self, xyz):
+        if self.power <= 1:
+            return self.evaluate(xyz), self.evaluate_derivative(xyz)
+        pow_prev = xyz ** (self.power - 1)
+        return pow_prev * xyz, self.power * pow_prev
+
+    def piecewise_polynomial(self):
+        if self.power < 0 or int(self.power) != self.power:
+            return None
+        return [(-1.5, 1.5, Polynomial([0.0] * int(self.power) + [1.0]))]
+
 
 class Bezier(AdditiveComponent):
     """
@@ -130,6 +180,19 @@ class Bezier(AdditiveComponent):
         m3 = (xyz >= 0.5) & (xyz < 1.5)
         return m1 * b1 + m2 * b2 + m3 * b3
 
+    def evaluate_with_derivative(self, xyz):
+        m1 = (xyz >= -1.5) & (xyz < -0.5)
+        m2 = (xyz >= -0.5) & (xyz < 0.5)
+        m3 = (xyz >= 0.5) & (xyz < 1.5)
+        val = m1 * (xyz + 1.5) ** 2 + m2 * (-2 * (xyz ** 2) + 1.5) + m3 * (xyz - 1.5) ** 2
+        deriv = m1 * (2 * xyz + 3) + m2 * (-4 * xyz) + m3 * (2 * xyz - 3)
+        return val, deriv
+
+    def piecewise_polynomial(self):
+        return [(-1.5, -0.5, Polynomial([2.25, 3.0, 1.0])),
+                (-0.5, 0.5, Polynomial([1.5, 0.0, -2.0])),
+                (0.5, 1.5, Polynomial([2.25, -3.0, 1.0]))]
+
 
 class Sinusoid(AdditiveComponent):
     """
@@ -154,6 +217,10 @@ class Sinusoid(AdditiveComponent):
     def evaluate_derivative(self, xyz):
         return self.beta * torch.cos(self.beta * xyz + self.gamma)
 
+    def evaluate_with_derivative(self, xyz):
+        phase = self.beta * xyz + self.gamma
+        return torch.sin(phase), self.beta * torch.cos(phase)
+
 
 class SinPeaks(Sinusoid):
     def __init__(self, n_peaks):
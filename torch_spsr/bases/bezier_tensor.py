@@ -21,6 +21,14 @@ class BezierTensorBasis(BaseBasis):
         * We scale that up by 2 but this should not matter a lot.
     """
 
+    # Kinds of the packed integral table, in (const, integral) pairs as consumed by the integrate_* functions.
+    KIND_SHIFTED = 0        # SHIFTED_SELF_INTEGRAL, SHIFTED_DERIVATIVE_INTEGRAL
+    KIND_PARTIAL = 2        # DERIVATIVE_PARTIAL_INTEGRAL, PARTIAL_INTEGRAL
+    KIND_INV_PARTIAL = 4    # INV_DERIVATIVE_PARTIAL_INTEGRAL, INV_PARTIAL_INTEGRAL
+
+    # device -> packed integral table, shared by all instances.
+    device_tables = {}
+
     @classmethod
     def _initialize_constants(cls):
         ni_path = Path(__file__).parent.parent / "data" / "bezier_integrals.pkl"
@@ -31,6 +39,35 @@ class BezierTensorBasis(BaseBasis):
                 cls.SHIFTED_SELF_INTEGRAL, cls.SHIFTED_DERIVATIVE_INTEGRAL, \
                 cls.SHIFTED_SELF_DERIV_INTEGRAL, cls.INV_SHIFTED_SELF_DERIV_INTEGRAL = pickle.load(f)
 
+        # Pack the tables into a single (mult, pos, kind) tensor, padded with zeros. Positions are shifted by one,
+        #   so that clamping any out-of-range position to [0, n_pos) lands on a zero entry.
+        tables = [cls.SHIFTED_SELF_INTEGRAL, cls.SHIFTED_DERIVATIVE_INTEGRAL,
+                  cls.DERIVATIVE_PARTIAL_INTEGRAL, cls.PARTIAL_INTEGRAL,
+                  cls.INV_DERIVATIVE_PARTIAL_INTEGRAL, cls.INV_PARTIAL_INTEGRAL]
+        n_mult = max(len(table) for table in tables)
+        n_pos = max(len(mult_table) for table in tables for mult_table in table) + 2
+        cls.PACKED_INTEGRAL = torch.zeros((n_mult, n_pos, len(tables)), dtype=torch.float)
+        for kind, table in enumerate(tables):
+            for mult, mult_table in enumerate(table):
+                cls.PACKED_INTEGRAL[mult, 1:len(mult_table) + 1, kind] = torch.tensor(mult_table, dtype=torch.float)
+        cls.device_tables = {}
+
+    @classmethod
+    def _lookup_integrals(cls, mult: int, kind: int, pos: torch.Tensor):
+        """
+        Gather a (const, integral) pair of tables at once.
+        :param mult: int, log2 of the stride ratio
+        :param kind: int, one of KIND_*
+        :param pos: (N, 3) long positions in the tables, out-of-range positions give 0.
+        :return: (N, 3) const values, (N, 3) integral values
+        """
+        packed_table = cls.device_tables.get(pos.device, None)
+        if packed_table is None:
+            packed_table = cls.PACKED_INTEGRAL.to(pos.device)
+            cls.device_tables[pos.device] = packed_table
+        vals = packed_table[mult, :, kind:kind + 2][(pos + 1).clamp_(0, packed_table.size(1) - 1)]
+        return vals[..., 0], vals[..., 1]
+
     @classmethod
     def evaluate_single(cls, x: torch.Tensor):
         b1 = (x + 1.5) ** 2
@@ -96,15 +133,9 @@ class BezierTensorBasis(BaseBasis):
         abs_val = (rel_pos + mult * 3 / 2 + 0.5).round().long()
         mult = int(math.log2(mult))
 
-        invalid_range_val = ~torch.logical_and(abs_val >= 0, abs_val < len(self.SHIFTED_SELF_INTEGRAL[mult]))
-        abs_val.clamp_(min=0, max=len(self.SHIFTED_SELF_INTEGRAL[mult]) - 1)
-
-        const_val = torch.tensor(self.SHIFTED_SELF_INTEGRAL[mult],
-                                 dtype=torch.float, device=rel_pos.device)[abs_val] * source_stride
-        const_val[invalid_range_val] = 0.0
-        integral_val = torch.tensor(self.SHIFTED_DERIVATIVE_INTEGRAL[mult],
-                                    dtype=torch.float, device=rel_pos.device)[abs_val] / target_stride
-        integral_val[invalid_range_val] = 0.0
+        const_val, integral_val = self._lookup_integrals(mult, self.KIND_SHIFTED, abs_val)
+        const_val = const_val * source_stride
+        integral_val = integral_val / target_stride
         res = integral_val[:, 0] * const_val[:, 1] * const_val[:, 2] + \
             const_val[:, 0] * integral_val[:, 1] * const_val[:, 2] + \
             const_val[:, 0] * const_val[:, 1] * integral_val[:, 2]
@@ -126,18 +157,19 @@ class BezierTensorBasis(BaseBasis):
             mult = target_stride // data_stride
             abs_val = (rel_pos + (3 * mult - 1) / 2.).round().long()
             mult = int(math.log2(mult))
-            dpi, pi = self.DERIVATIVE_PARTIAL_INTEGRAL[mult], self.PARTIAL_INTEGRAL[mult]
+            kind = self.KIND_PARTIAL
             i_mult = data_stride / target_stride
         else:
             mult = data_stride // target_stride
             abs_val = (rel_pos * mult + mult / 2 + 0.5).round().long()
             mult = int(math.log2(mult)) - 1
-            dpi, pi = self.INV_DERIVATIVE_PARTIAL_INTEGRAL[mult], self.INV_PARTIAL_INTEGRAL[mult]
+            kind = self.KIND_INV_PARTIAL
             data_stride, target_stride = target_stride, data_stride
             i_mult = 1.0
 
-        const_val = torch.tensor(dpi, dtype=torch.float, device=rel_pos.device)[abs_val] * data_stride
-        integral_val = torch.tensor(pi, dtype=torch.float, device=rel_pos.device)[abs_val] * i_mult
+        const_val, integral_val = self._lookup_integrals(mult, kind, abs_val)
+        const_val = const_val * data_stride
+        integral_val = integral_val * i_mult
         res = data[:, 0] * integral_val[:, 0] * const_val[:, 1] * const_val[:, 2] + \
             data[:, 1] * const_val[:, 0] * integral_val[:, 1] * const_val[:, 2] + \
             data[:, 2] * const_val[:, 0] * const_val[:, 1] * integral_val[:, 2]
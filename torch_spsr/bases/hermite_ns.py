@@ -46,8 +46,12 @@ class AdditiveHermite(AdditiveBasis):
         :param feat: torch.Tensor (N, x) feature
         :return: torch.Tensor (N, 3*len(self.components)) coefficients (for x,y,z axis)
         """
+        # self.ns is kron(ns, I_3): apply the (K, n_degrees+1) null space per axis instead of the 3x larger matrix.
+        #   This gives the per-voxel polynomial coefficients, in ascending power order, x/y/z interleaved.
+        poly_feat = feat[:, self.n_acomp * 3:].reshape(feat.size(0), -1, 3)
+        poly_coeffs = torch.einsum('mka,kp->mpa', poly_feat, self.ns[0::3, 0::3])
         return torch.cat([
-            feat[:, :self.n_acomp * 3], feat[:, self.n_acomp * 3:] @ self.ns
+            feat[:, :self.n_acomp * 3], poly_coeffs.reshape(feat.size(0), -1)
         ], dim=1)
 
     def initialize_feature_value(self, feat: torch.Tensor) -> None:
@@ -5,26 +5,137 @@ import torch
 import torch_scatter
 
 from torch_spsr.ext import CuckooHashTable
-from .ops import torch_unique
+from .ops import torch_unique, morton_sort, morton_encode, morton_in_range
 from torch_spsr.bases.bezier_tensor import BezierTensorBasis
 
 
-def compute_density(xyz: torch.Tensor, voxel_size: float) -> torch.Tensor:
+def compute_density(xyz: torch.Tensor, voxel_size: float, chunk_size: int = None) -> torch.Tensor:
     """
     Kernel density estimation using Bezier Tensor.
     :param xyz: (N, 3) input point cloud.
     :param voxel_size: float, Smoothing kernel size.
+    :param chunk_size: int or None, budget of (point, neighbour) pairs processed at once, None for all at once.
     :return: (N, ) density. Unit is roughly proportional to pts/voxel.
     """
     from torch_spsr.core.hashtree import HashTree
 
     hash_tree = HashTree(xyz, voxel_size, 1)
-    hash_tree.build_encoder_hierarchy_dense(expand_range=2, uniform_density=True)
-    wd = hash_tree.splat_data(xyz, hash_tree.ENCODER, 0, check_corr=False)
+    hash_tree.build_encoder_hierarchy_dense(expand_range=2, uniform_density=True, chunk_size=chunk_size)
+    wd = hash_tree.splat_data(xyz, hash_tree.ENCODER, 0, check_corr=False, chunk_size=chunk_size)
     hash_tree.reflect_decoder_coords()
-    wd = hash_tree.evaluate_interpolated(xyz, BezierTensorBasis(), None, 0, wd)
 
-    return wd
+    basis = BezierTensorBasis()
+    if chunk_size is None:
+        return hash_tree.evaluate_interpolated(xyz, basis, None, 0, wd)
+    # Each point is evaluated independently, so slicing the queries does not change any result.
+    chunk_points = max(1, chunk_size // (basis.get_domain_range() ** 3))
+    return torch.cat([hash_tree.evaluate_interpolated(xyz[pts], basis, None, 0, wd)
+                      for pts in SparseFeatureHierarchy.point_chunks(xyz.size(0), chunk_points)], dim=0)
+
+
+class MortonSortedTable:
+    """
+    Voxel index with the same query interface as CuckooHashTable (for 3D coordinates), storing a sorted array of
+    packed 64-bit Morton keys and answering queries with a vectorized binary search.
+        Keys are collision-free for coordinates within [-2^20, 2^20) (queries outside are misses), the size is exact
+    (one key and one index per voxel) and the build is a single deterministic sort, at the price of O(log N) probes
+    per query instead of O(1).
+    """
+    def __init__(self, data: torch.Tensor):
+        """
+        :param data: (N, 3) integer coordinates within [-2^20, 2^20)
+        """
+        assert data.ndim == 2 and data.size(1) == 3, data.size()
+        assert torch.all(morton_in_range(data)).item(), "Coordinates exceed the range of Morton keys."
+        self.dim = 3
+        self.keys, self.vals = torch.sort(morton_encode(data), stable=True)
+
+    @property
+    def nbytes(self) -> int:
+        return self.keys.element_size() * self.keys.numel() + self.vals.element_size() * self.vals.numel()
+
+    def query(self, coords: torch.Tensor, offsets: torch.Tensor = None):
+        """
+        Compute the position of the queries coordinates, -1 if not found.
+        :param coords: (N, 3)
+        :param offsets: (K, 3)
+        :return: (K, N) if offsets is provided, otherwise (N,)
+        """
+        assert coords.size(1) == self.dim
+        query_keys = morton_encode(coords, offsets)
+        if self.keys.size(0) == 0 or query_keys.numel() == 0:
+            return torch.full(query_keys.size(), -1, dtype=torch.long, device=query_keys.device)
+        pos = torch.searchsorted(self.keys, query_keys.view(-1)).clamp_(max=self.keys.size(0) - 1)
+        # Out-of-range coordinates wrap onto other keys, they can never be stored so they are misses.
+        found = torch.logical_and(self.keys[pos] == query_keys.view(-1), morton_in_range(coords, offsets).view(-1))
+        res = torch.where(found, self.vals[pos], torch.full_like(pos, -1))
+        return res.view(query_keys.size())
+
+
+class NeighbourRings:
+    """
+    Neighbour map between two levels stored ring by ring (CSR-like): ring k holds the pairs found by the kernel
+    entries [(2k-1)^3, (2k+1)^3), i.e. the shell that range 2k+1 adds to range 2k-1.
+        The rings live back to back in buffers with spare capacity, so appending a ring does not copy the
+    previous ones, and any run of consecutive rings (in particular every smaller range) is a view.
+    """
+
+    def __init__(self, device):
+        self.device = device
+        self.n_rings = 0
+        # Cumulative number of pairs at the start of each ring, length n_rings + 1.
+        self.ring_ptr = [0]
+        self._src, self._tgt, self._nt, self._nbs = None, None, None, None
+
+    @property
+    def max_range(self) -> int:
+        return 2 * self.n_rings - 1
+
+    @staticmethod
+    def ring_kernel_ptr(ring: int) -> int:
+        """
+        :return: index of the first kernel entry (i.e. nbsizes entry) of the ring.
+        """
+        return 0 if ring == 0 else (2 * ring - 1) ** 3
+
+    @staticmethod
+    def _append(buffer: torch.Tensor, size: int, data: torch.Tensor):
+        if buffer is None or buffer.size(0) < size + data.size(0):
+            new_buffer = data.new_empty((max(2 * size, size + data.size(0)),) + tuple(data.size()[1:]))
+            if buffer is not None:
+                new_buffer[:size] = buffer[:size]
+            buffer = new_buffer
+        buffer[size:size + data.size(0)] = data
+        return buffer
+
+    def append(self, src: torch.Tensor, tgt: torch.Tensor, nt: torch.Tensor, nbs: torch.Tensor, n_rings: int):
+        """
+        Append n_rings consecutive rings whose pairs are ordered by kernel entry.
+        :param src, tgt, nt: pairs of the new rings
+        :param nbs: (n_kernel,) number of pairs per kernel entry of the new rings
+        """
+        n_pairs, n_kernel = self.ring_ptr[-1], self.ring_kernel_ptr(self.n_rings)
+        if n_rings > 1:
+            # Split the block at the inner ring boundaries.
+            kernel_ptr = torch.tensor([self.ring_kernel_ptr(self.n_rings + r) - n_kernel for r in range(1, n_rings)],
+                                      device=nbs.device)
+            self.ring_ptr += (n_pairs + torch.cumsum(nbs, dim=0)[kernel_ptr - 1]).tolist()
+        self.ring_ptr.append(n_pairs + src.size(0))
+        self._src = self._append(self._src, n_pairs, src)
+        self._tgt = self._append(self._tgt, n_pairs, tgt)
+        self._nt = self._append(self._nt, n_pairs, nt)
+        self._nbs = self._append(self._nbs, n_kernel, nbs)
+        self.n_rings += n_rings
+
+    def get(self, ring_start: int = 0, ring_end: int = None):
+        """
+        :return: views (src, tgt, nt, nbs) of the rings [ring_start, ring_end).
+        """
+        ring_end = self.n_rings if ring_end is None else ring_end
+        assert 0 <= ring_start <= ring_end <= self.n_rings
+        p0, p1 = self.ring_ptr[ring_start], self.ring_ptr[ring_end]
+        k0, k1 = self.ring_kernel_ptr(ring_start), self.ring_kernel_ptr(ring_end)
+        return self._src[p0:p1], self._tgt[p0:p1], self._nt[p0:p1], self._nbs[k0:k1]
 
 
 class NeighbourMaps:
@@ -38,31 +149,75 @@ class NeighbourMaps:
         self.cache = {}
         self.device = device
 
+    @staticmethod
+    def range_to_rings(target_range: int) -> int:
+        assert target_range % 2 == 1, "target_range must be odd."
+        return (target_range + 1) // 2
+
     def get_map(self, source_depth: int, target_depth: int, target_range: int, force_recompute: bool = False):
         """
         Given the query, return the existing part and also the part needed to be queried.
         :return: tuple (src-id, tgt-id, neighbour-types, nbsizes, ranges lacked [a,b] )
         """
-        if (source_depth, target_depth) in self.cache.keys():
-            if force_recompute:
-                del self.cache[(source_depth, target_depth)]
-                max_range, exist_src, exist_tgt, exist_nt, exist_nbs = -1, None, None, None, None
-            else:
-                max_range, exist_src, exist_tgt, exist_nt, exist_nbs = self.cache[(source_depth, target_depth)]
-        else:
-            max_range, exist_src, exist_tgt, exist_nt, exist_nbs = -1, None, None, None, None
-
-        if target_range == max_range:
-            return exist_src, exist_tgt, exist_nt, exist_nbs, None
-        elif target_range < max_range:
-            tr3 = target_range * target_range * target_range
-            n_query = torch.sum(exist_nbs[:tr3])
-            return exist_src[:n_query], exist_tgt[:n_query], exist_nt[:n_query], exist_nbs[:tr3], None
+        if force_recompute:
+            self.cache.pop((source_depth, target_depth), None)
+
+        rings = self.cache.get((source_depth, target_depth), None)
+        if rings is None:
+            return None, None, None, None, [1, target_range]
+
+        n_rings = self.range_to_rings(target_range)
+        if n_rings <= rings.n_rings:
+            return (*rings.get(0, n_rings), None)
         else:
-            return exist_src, exist_tgt, exist_nt, exist_nbs, [max_range + 2, target_range]
+            return (*rings.get(), [rings.max_range + 2, target_range])
+
+    def get_rings(self, source_depth: int, target_depth: int, ring_start: int, ring_end: int):
+        """
+        :return: views (src-id, tgt-id, neighbour-types, nbsizes) of the cached rings [ring_start, ring_end),
+            ring k being the kernel shell added by range 2k+1. None if these rings are not cached yet.
+        """
+        rings = self.cache.get((source_depth, target_depth), None)
+        if rings is None or ring_end > rings.n_rings:
+            return None
+        return rings.get(ring_start, ring_end)
+
+    def extend_map(self, source_depth: int, target_depth: int, target_range: int, res: list):
+        """
+        Append the rings computed for the range lacked by get_map (nothing cached before is copied).
+        :param res: [src-id, tgt-id, neighbour-types, nbsizes] of the new rings only.
+        """
+        rings = self.cache.setdefault((source_depth, target_depth), NeighbourRings(self.device))
+        rings.append(*res, n_rings=self.range_to_rings(target_range) - rings.n_rings)
+
+    def invalidate(self, depth: int):
+        """
+        Drop the maps from or to depth, e.g. after its coordinates changed.
+        """
+        self.cache = {k: v for k, v in self.cache.items() if depth not in k}
 
-    def update_map(self, source_depth: int, target_depth: int, target_range: int, res: list):
-        self.cache[(source_depth, target_depth)] = [target_range] + res
+    MAP_NAMES = ["src", "tgt", "nt", "nbs"]
+
+    def state_dict(self) -> dict:
+        """
+        :return: dict that maps from '{source_depth}_{target_depth}/{name}' to the cached tensors.
+        """
+        state = {}
+        for (source_depth, target_depth), rings in self.cache.items():
+            prefix = f"{source_depth}_{target_depth}"
+            state[f"{prefix}/range"] = torch.tensor(rings.max_range)
+            state.update({f"{prefix}/{name}": t for name, t in zip(self.MAP_NAMES, rings.get())})
+        return state
+
+    def load_state_dict(self, state: dict):
+        self.cache = {}
+        for key in state.keys():
+            if not key.endswith("/range"):
+                continue
+            prefix = key[:-len("/range")]
+            source_depth, target_depth = [int(t) for t in prefix.split("_")]
+            self.extend_map(source_depth, target_depth, int(state[key]), [
+                state[f"{prefix}/{name}"].to(self.device) for name in self.MAP_NAMES])
 
 
 class SparseFeatureHierarchy:
@@ -73,7 +228,10 @@ class SparseFeatureHierarchy:
     CONFORM_OFFSETS = [(0, 0, 0), (0, 0, 1), (0, 1, 0), (0, 1, 1),
                        (1, 0, 0), (1, 0, 1), (1, 1, 0), (1, 1, 1)]
 
-    def __init__(self, depth: int, voxel_size: float, device, range_kernel):
+    INDEX_TYPES = {"cuckoo": CuckooHashTable, "sorted": MortonSortedTable}
+
+    def __init__(self, depth: int, voxel_size: float, device, range_kernel, morton_order: bool = False,
+                 index_type: str = "cuckoo"):
         """
         Initialize the metadata of the hierarchy.
         :param depth: int, number of layers
@@ -81,21 +239,30 @@ class SparseFeatureHierarchy:
         :param device: torch.Device, device where the data structure should reside
         :param range_kernel: a helper function that specifies the relative offsets in the kernel.
             *Note*: The sequence in the kernel only has to be respected when conv=True in get_self_neighbours!
+        :param morton_order: if True, voxels of each level built by build_hierarchy_* are stored in Z-order,
+            so that neighbouring voxels get close indices. Coordinates given to update_coords are kept as is.
+        :param index_type: voxel index of each level, 'cuckoo' (CuckooHashTable) or 'sorted' (MortonSortedTable).
         """
         self._depth = depth
         self._voxel_size = voxel_size
         self._device = device
         self._range_kernel = range_kernel
+        self._morton_order = morton_order
+        assert index_type in self.INDEX_TYPES.keys(), f"Unknown index type {index_type}."
+        self._index_type = index_type
 
         # Conv-based include same-level
         self._conv_nmap = NeighbourMaps(self._device)
         # Region-based exclude same-level
         self._region_nmap = NeighbourMaps(self._device)
+        self._conform_mask = torch.tensor(self.CONFORM_OFFSETS, dtype=torch.bool, device=self._device)
+        # Conv-ready kernel maps: (source_depth, target_depth, kernel_size) -> (nbmaps, nbsizes)
+        self._conv_kmap = {}
 
         self._strides = [2 ** d for d in range(self.depth)]
         # List of torch.Tensor (Nx3)
         self._coords = [None for d in range(self.depth)]
-        self._hash_table: List[CuckooHashTable] = [None for d in range(self.depth)]
+        self._hash_table: List[Union[CuckooHashTable, MortonSortedTable]] = [None for d in range(self.depth)]
 
     @property
     def depth(self) -> int:
@@ -111,6 +278,14 @@ class SparseFeatureHierarchy:
         """
         return self._voxel_size
 
+    @property
+    def morton_order(self) -> bool:
+        return self._morton_order
+
+    @property
+    def index_type(self) -> str:
+        return self._index_type
+
     def get_stride(self, depth: int) -> int:
         """
         :return: the stride at depth. Usually this would be 2**depth
@@ -266,7 +441,7 @@ class SparseFeatureHierarchy:
         if lack_range is None:
             return recover_inv_op(exist_src, exist_tgt, exist_nt, exist_nbs)
 
-        # Only compute incremental part:
+        # Only compute incremental part (the new rings are appended to the cache without copying the old ones):
         neighbour_kernel = self._range_kernel()(target_range)
         starting_lap = max(0, lack_range[0] - 2)
         starting_lap = starting_lap ** 3
@@ -276,17 +451,29 @@ class SparseFeatureHierarchy:
             tree_coords[source_depth], tree_strides[source_depth], target_depth, neighbour_kernel, conv_based
         )
 
-        if exist_src is not None:
-            source_ids = torch.cat([exist_src, source_ids], dim=0)
-            target_ids = torch.cat([exist_tgt, target_ids], dim=0)
-            neighbour_types = torch.cat([exist_nt, neighbour_types], dim=0)
-            nbsizes = torch.cat([exist_nbs, nbsizes], dim=0)
-
         # Cache result for future use.
-        neighbour_maps.update_map(source_depth, target_depth, target_range,
+        neighbour_maps.extend_map(source_depth, target_depth, target_range,
                                   [source_ids, target_ids, neighbour_types, nbsizes])
 
-        return recover_inv_op(source_ids, target_ids, neighbour_types, nbsizes)
+        exist_src, exist_tgt, exist_nt, exist_nbs, _ = neighbour_maps.get_map(source_depth, target_depth, target_range)
+        return recover_inv_op(exist_src, exist_tgt, exist_nt, exist_nbs)
+
+    def get_conv_kernel_map(self, source_depth: int, target_depth: int, kernel_size: int):
+        """
+        Kernel map in the layout of the sparse convolution op, cached until the coordinates of either depth change.
+        :param source_depth: int, refer to get_self_neighbours (with conv_based=True)
+        :param target_depth: int
+        :param kernel_size: int, target_range of get_self_neighbours
+        :return: nbmaps (M, 2) contiguous int32 [tgt-id, src-id] pairs on the device,
+                 nbsizes (kernel_size^3, ) int32 on the host, as read by the convolution kernels.
+        """
+        kmap_key = (source_depth, target_depth, kernel_size)
+        if kmap_key not in self._conv_kmap.keys():
+            src_ids, tgt_ids, _, nbsizes = self.get_self_neighbours(
+                source_depth, target_depth, kernel_size, conv_based=True)
+            nbmaps = torch.stack([tgt_ids, src_ids], dim=1).int().contiguous()
+            self._conv_kmap[kmap_key] = (nbmaps, nbsizes.int().cpu().contiguous())
+        return self._conv_kmap[kmap_key]
 
     def evaluate_voxel_status(self, coords: torch.Tensor, depth: int):
         """
@@ -316,14 +503,27 @@ class SparseFeatureHierarchy:
 
         return status
 
-    def split_data(self, xyz: torch.Tensor, data_depth: int, data: torch.Tensor):
+    @staticmethod
+    def point_chunks(n_points: int, chunk_points: int):
+        """
+        :return: list of slices splitting range(n_points) into consecutive chunks of at most chunk_points.
+        """
+        return [slice(p, min(p + chunk_points, n_points)) for p in range(0, n_points, chunk_points)]
+
+    def split_data(self, xyz: torch.Tensor, data_depth: int, data: torch.Tensor, chunk_size: int = None):
         """
         Obtain the tri-linearly interpolated data located at xyz.
         :param xyz: torch.Tensor (N, 3)
         :param data_depth: int
         :param data: torch.Tensor (M, K), where K is feature dimension, and M = self.get_num_voxels(data_depth)
+        :param chunk_size: int or None, maximum number of (point, voxel) pairs processed at once.
+            Each point is interpolated independently, so the result does not depend on it.
         :return: (N, K) torch.Tensor
         """
+        if chunk_size is not None and xyz.size(0) * 8 > chunk_size:
+            return torch.cat([self.split_data(xyz[pts], data_depth, data)
+                              for pts in self.point_chunks(xyz.size(0), max(1, chunk_size // 8))], dim=0)
+
         tree_stride = self._strides[data_depth]
         assert data.size(0) == self._coords[data_depth].size(0), "Tree data does not agree on size."
 
@@ -335,7 +535,7 @@ class SparseFeatureHierarchy:
                                          dim_size=xyz.size(0))
 
     def splat_data(self, xyz: torch.Tensor, data_depth: int, data: torch.Tensor = None,
-                   check_corr: bool = True, return_nf_mask: bool = False):
+                   check_corr: bool = True, return_nf_mask: bool = False, chunk_size: int = None):
         """
         Splat data located at xyz to the tree voxels.
         :param xyz: torch.Tensor (N, 3)
@@ -343,6 +543,8 @@ class SparseFeatureHierarchy:
         :param data: torch.Tensor (N, K)
         :param check_corr: if True, check if data is fully supported by its 8 neighbours
         :param return_nf_mask: Legacy, do not use.
+        :param chunk_size: int or None, maximum number of (point, voxel) pairs processed at once. The
+            result is numerically equivalent to None (not bitwise on CUDA, whose scatter atomics are unordered).
         :return: (M, K) or (M,), where M = self.get_num_voxels(data_depth)
         """
         if data is not None:
@@ -350,6 +552,9 @@ class SparseFeatureHierarchy:
         else:
             data = 1
 
+        if chunk_size is not None and xyz.size(0) * 8 > chunk_size:
+            return self._splat_data_chunked(xyz, data_depth, data, check_corr, return_nf_mask, chunk_size)
+
         tree_stride = self._strides[data_depth]
         alpha_coords, alpha_data = self._trilinear_weights(xyz, tree_stride, data)
 
@@ -368,12 +573,84 @@ class SparseFeatureHierarchy:
             return splat_res, nb_sizes.reshape(8, -1).sum(0) < 4
         return splat_res
 
-    def build_hierarchy_dense(self, xyz: torch.Tensor, expand_range: int = 0):
+    def estimate_voxel_density(self, xyz: torch.Tensor, depth: int, chunk_size: int = None) -> torch.Tensor:
+        """
+        Approximate kernel density estimation: points are tri-linearly splatted onto the voxel grid of the given
+        depth and the resulting counts are interpolated back with the same weights.
+            The touched voxels are indexed by a temporary voxel index of this hierarchy's index type, no tree level is
+        built (the structure of this hierarchy is left untouched).
+        :param xyz: (N, 3) input point cloud.
+        :param depth: int, level whose voxels are used as smoothing kernel.
+        :param chunk_size: int or None, maximum number of (point, voxel) pairs processed at once.
+            The splatting weights are kept between the two passes when unchunked, and recomputed otherwise.
+        :return: (N, ) density. Unit is roughly proportional to pts/voxel, as compute_density.
+        """
+        if xyz.size(0) == 0:
+            return xyz.new_zeros((0, ))
+
+        tree_stride = self._strides[depth]
+        chunks = [(k, pts) for k in range(len(self.CONFORM_OFFSETS))
+                  for pts in self.point_chunks(xyz.size(0), chunk_size or xyz.size(0))]
+
+        def corner_weights(k, pts):
+            return self._trilinear_weights(xyz[pts], tree_stride, conform_ids=slice(k, k + 1))
+
+        # Pass 1: splat, reducing each chunk onto its own voxels before merging.
+        chunk_coords, chunk_counts, kept_weights = [], [], []
+        for k, pts in chunks:
+            alpha_coords, alpha_weight = corner_weights(k, pts)
+            if chunk_size is None:
+                kept_weights.append((alpha_coords, alpha_weight))
+            alpha_voxels, alpha_inv = torch_unique(alpha_coords, dim=0, return_inverse=True)
+            chunk_coords.append(alpha_voxels)
+            chunk_counts.append(torch_scatter.scatter_sum(alpha_weight, alpha_inv, dim=0,
+                                                          dim_size=alpha_voxels.size(0)))
+        voxel_coords, voxel_inv = torch_unique(torch.cat(chunk_coords, dim=0), dim=0, return_inverse=True)
+        voxel_count = torch_scatter.scatter_sum(torch.cat(chunk_counts, dim=0), voxel_inv, dim=0,
+                                                dim_size=voxel_coords.size(0))
+        voxel_index = self._build_index(voxel_coords)
+
+        # Pass 2: interpolate the counts back.
+        density = xyz.new_zeros((xyz.size(0), ))
+        for ci, (k, pts) in enumerate(chunks):
+            alpha_coords, alpha_weight = kept_weights[ci] if chunk_size is None else corner_weights(k, pts)
+            density[pts] += alpha_weight * voxel_count[voxel_index.query(alpha_coords)]
+        return density
+
+    def _splat_data_chunked(self, xyz: torch.Tensor, data_depth: int, data, check_corr: bool,
+                            return_nf_mask: bool, chunk_size: int):
+        # Visit the (offset, point) pairs in the same order as the unchunked path (offset-major) and accumulate
+        #   into one output buffer. The result is numerically equivalent to the unchunked path, but only bitwise
+        #   identical on CPU: on CUDA, scatter_sum adds with float atomics in an unspecified order (in both paths).
+        tree_stride = self._strides[data_depth]
+        splat_res, nb_sizes, n_found = None, [], 0
+        for k in range(len(self.CONFORM_OFFSETS)):
+            for pts in self.point_chunks(xyz.size(0), chunk_size):
+                alpha_coords, alpha_data = self._trilinear_weights(
+                    xyz[pts], tree_stride, data if isinstance(data, int) else data[pts], conform_ids=slice(k, k + 1))
+                alpha_source, alpha_target, _, chunk_nb_sizes = self.get_coords_neighbours(
+                    alpha_coords, tree_stride, data_depth, self._identity_kernel(), transposed=True)
+                alpha_data = alpha_data[alpha_source]
+                if splat_res is None:
+                    splat_res = alpha_data.new_zeros((self._coords[data_depth].size(0),) + alpha_data.size()[1:])
+                torch_scatter.scatter_sum(alpha_data, alpha_target, dim=0, out=splat_res)
+                nb_sizes.append(chunk_nb_sizes)
+                n_found += alpha_source.size(0)
+
+        if n_found < xyz.size(0) * 8 and check_corr:
+            print("Warning: Some grids that normal should be splatted onto is missing because expansion is too small. "
+                  f"# Should = {xyz.size(0) * 8}, Actual = {n_found}.")
+        if return_nf_mask:
+            return splat_res, torch.cat(nb_sizes, dim=0).reshape(8, -1).sum(0) < 4
+        return splat_res
+
+    def build_hierarchy_dense(self, xyz: torch.Tensor, expand_range: int = 0, chunk_size: int = None):
         """
         Rebuild the tree structure, based on current xyz, voxel_size and depth.
+        :param chunk_size: int or None, maximum number of (point, voxel) pairs quantized at once.
         """
         if expand_range == 2:
-            unique_coords = self._quantize_coords(xyz, 0)
+            unique_coords = self._quantize_coords(xyz, 0, chunk_size)
         else:
             coords = torch.div(xyz, self._voxel_size).floor().int()
             unique_coords = torch_unique(coords, dim=0)
@@ -426,7 +703,7 @@ class SparseFeatureHierarchy:
 
     def build_hierarchy_adaptive(self, xyz: torch.Tensor, xyz_density: torch.Tensor, log_base: float = 4.0,
                                  min_density: float = 8.0,
-                                 limit_adaptive_depth: int = 100) -> torch.Tensor:
+                                 limit_adaptive_depth: int = 100, chunk_size: int = None) -> torch.Tensor:
         """
         Build the hierarchy by first determine the integer level of each point (based on xyz_density, log_base and
         min_density), then splat the points onto the tree structure.
@@ -435,6 +712,7 @@ class SparseFeatureHierarchy:
         :param log_base: float
         :param min_density: float, minimum density in each voxel. If exceed, go to coarser level.
         :param limit_adaptive_depth: int. Maximum adaptive number of levels.
+        :param chunk_size: int or None, maximum number of (point, voxel) pairs quantized at once.
         :return torch.Tensor long. (N, ) level that the point lies in.
         """
         # Compute expected depth.
@@ -448,7 +726,7 @@ class SparseFeatureHierarchy:
         self._coords = []
         for d in range(self.depth):
             depth_samples = xyz[xyz_depth <= d]
-            coords = self._quantize_coords(depth_samples, d)
+            coords = self._quantize_coords(depth_samples, d, chunk_size)
             # if depth_samples.size(0) == 0:
             #     print(f"-- disregard level {d} due to insufficient samples!")
             self._coords.append(coords)
@@ -456,6 +734,24 @@ class SparseFeatureHierarchy:
         self._update_hash_table()
         return xyz_depth
 
+    def state_dict(self) -> dict:
+        """
+        :return: dict of tensors with the coordinates of each (non-empty) level and the neighbour map caches.
+            Hash tables are not included, they are rebuilt by load_state_dict.
+        """
+        state = {f"coords/{d}": coords for d, coords in enumerate(self._coords) if coords is not None}
+        state.update({f"conv_nmap/{k}": v for k, v in self._conv_nmap.state_dict().items()})
+        state.update({f"region_nmap/{k}": v for k, v in self._region_nmap.state_dict().items()})
+        return state
+
+    def load_state_dict(self, state: dict):
+        self._coords = [state[f"coords/{d}"].to(self._device) if f"coords/{d}" in state.keys() else None
+                        for d in range(self.depth)]
+        self._hash_table = [self._build_index(coords) if coords is not None else None for coords in self._coords]
+        self._conv_kmap = {}
+        for prefix, nmap in [("conv_nmap/", self._conv_nmap), ("region_nmap/", self._region_nmap)]:
+            nmap.load_state_dict({k[len(prefix):]: v for k, v in state.items() if k.startswith(prefix)})
+
     def update_coords(self, depth: int, coords: Union[torch.Tensor, None]):
         """
         Update the structure of the tree. This is mainly used during decoder's structure building stage.
@@ -469,25 +765,47 @@ class SparseFeatureHierarchy:
             coords = torch.zeros((0, 3), dtype=torch.int32, device=self._device)
         assert coords.ndim == 2 and coords.size(1) == 3, coords.size()
         self._coords[depth] = coords
-        self._hash_table[depth] = CuckooHashTable(data=self._coords[depth])
+        self._hash_table[depth] = self._build_index(self._coords[depth])
+        # Cached maps involving this level are no longer valid.
+        self._conv_nmap.invalidate(depth)
+        self._region_nmap.invalidate(depth)
+        self._conv_kmap = {k: v for k, v in self._conv_kmap.items() if depth not in k[:2]}
 
     def _identity_kernel(self):
         return torch.tensor([[0, 0, 0]], dtype=torch.int32, device=self._device)
 
-    def _quantize_coords(self, xyz: torch.Tensor, data_depth: int):
+    def _quantize_coords(self, xyz: torch.Tensor, data_depth: int, chunk_size: int = None):
         # Note this is just splat_data with NEW_BRANCH.
+        if chunk_size is not None and xyz.size(0) * 8 > chunk_size:
+            # Unique coordinates come out sorted, so de-duplicating per chunk first gives the same result.
+            return torch_unique(torch.cat([self._quantize_coords(xyz[pts], data_depth)
+                                           for pts in self.point_chunks(xyz.size(0), max(1, chunk_size // 8))],
+                                          dim=0), dim=0)
         tree_stride = self._strides[data_depth]
         alpha_coords, _ = self._trilinear_weights(xyz, tree_stride)
         alpha_coords = torch_unique(alpha_coords, dim=0)
         return alpha_coords
 
+    def _build_index(self, coords: torch.Tensor):
+        return self.INDEX_TYPES[self._index_type](data=coords)
+
     def _update_hash_table(self):
         for d in range(self.depth):
-            self._hash_table[d] = CuckooHashTable(data=self._coords[d])
+            if self._morton_order:
+                self._coords[d], _ = morton_sort(self._coords[d])
+            self._hash_table[d] = self._build_index(self._coords[d])
             assert self._hash_table[d].dim == 3
+        self._conv_kmap = {}
 
     def _trilinear_weights(self, xyz: torch.Tensor, tree_stride: int, xyz_data: torch.Tensor = 1,
-                           compute_grad: bool = False):
+                           compute_grad: bool = False, conform_ids: slice = slice(None)):
+        """
+        Splat xyz onto the 8 voxels around it, all offsets at once.
+        :param conform_ids: subset of CONFORM_OFFSETS to compute, all (K = 8) by default.
+        :return: alpha_coords (KN, 3) int, alpha_data (KN, ...) weights times xyz_data,
+            and if compute_grad, (KN, 3) gradient of the weights w.r.t. xyz.
+            Rows are ordered by offset first, i.e. row k * N + i is point i with the k-th offset.
+        """
         # Gradient is alpha_data w.r.t. xyz.
         q_coords = xyz / self._voxel_size
         d_coords = (q_coords / tree_stride).floor() * tree_stride
@@ -495,36 +813,27 @@ class SparseFeatureHierarchy:
         oct_sign = torch.sign(rel_coords)
         oct_local = torch.abs(rel_coords) / tree_stride
 
-        alpha_coords = []
-        alpha_data = []
-        grad_alpha_data = []
-        for nx, ny, nz in self.CONFORM_OFFSETS:
-            alpha_coords.append((d_coords + torch.stack([nx * oct_sign[:, 0],
-                                                         ny * oct_sign[:, 1],
-                                                         nz * oct_sign[:, 2]],
-                                                        dim=1) * tree_stride).int())
-            alpha_x = oct_local[:, 0] if nx == 1 else 1 - oct_local[:, 0]
-            alpha_y = oct_local[:, 1] if ny == 1 else 1 - oct_local[:, 1]
-            alpha_z = oct_local[:, 2] if nz == 1 else 1 - oct_local[:, 2]
-            alpha_os = alpha_x * alpha_y * alpha_z
-
-            if compute_grad:
-                assert xyz_data == 1, "Not supported!"
-                d_alpha_x = (oct_sign[:, 0] if nx == 1 else -oct_sign[:, 0]) / (self._voxel_size * tree_stride)
-                d_alpha_y = (oct_sign[:, 1] if ny == 1 else -oct_sign[:, 1]) / (self._voxel_size * tree_stride)
-                d_alpha_z = (oct_sign[:, 2] if nz == 1 else -oct_sign[:, 2]) / (self._voxel_size * tree_stride)
-                grad_alpha_data.append(torch.stack([
-                    d_alpha_x * alpha_y * alpha_z,
-                    alpha_x * d_alpha_y * alpha_z,
-                    alpha_x * alpha_y * d_alpha_z
-                ], dim=1))
-
-            alpha_data.append(alpha_os * xyz_data if isinstance(xyz_data, int) or xyz_data.ndim == 1 else
-                              alpha_os[:, None] * xyz_data)
-        alpha_coords = torch.cat(alpha_coords, dim=0)
-        alpha_data = torch.cat(alpha_data, dim=0)
+        # (8, N, 3) broadcasts: offsets are either 0 or 1 (towards oct_sign) along each axis.
+        conform_mask = self._conform_mask.to(xyz.device)[conform_ids, None, :]
+        alpha_coords = (d_coords + conform_mask * oct_sign * tree_stride).int().view(-1, 3)
+        alpha = torch.where(conform_mask, oct_local, 1 - oct_local)
+        alpha_x, alpha_y, alpha_z = alpha.unbind(dim=2)
+        alpha_os = alpha_x * alpha_y * alpha_z
+
+        if isinstance(xyz_data, int) or xyz_data.ndim == 1:
+            alpha_data = (alpha_os * xyz_data).view(-1)
+        else:
+            alpha_data = (alpha_os[..., None] * xyz_data).view(-1, *xyz_data.size()[1:])
 
         if compute_grad:
-            return alpha_coords, alpha_data, torch.cat(grad_alpha_data, dim=0)
+            assert xyz_data == 1, "Not supported!"
+            d_alpha = torch.where(conform_mask, oct_sign, -oct_sign) / (self._voxel_size * tree_stride)
+            d_alpha_x, d_alpha_y, d_alpha_z = d_alpha.unbind(dim=2)
+            grad_alpha_data = torch.stack([
+                d_alpha_x * alpha_y * alpha_z,
+                alpha_x * d_alpha_y * alpha_z,
+                alpha_x * alpha_y * d_alpha_z
+            ], dim=2).view(-1, 3)
+            return alpha_coords, alpha_data, grad_alpha_data
 
         return alpha_coords, alpha_data
\ No newline at end of file
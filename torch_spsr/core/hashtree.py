@@ -7,6 +7,7 @@ import torch_scatter
 from typing import Union
 from enum import Enum
 from torch_spsr.core._hash_backend import SparseFeatureHierarchy, compute_density
+from torch_spsr.core.ops import save_tensor_dict, load_tensor_dict, load_tensor_dict_meta
 
 
 class VoxelStatus(Enum):
@@ -34,14 +35,19 @@ class HashTree:
     DECODER = 1
     DECODER_TMP = 2
 
-    def __init__(self, xyz: torch.Tensor, voxel_size: float, depth: int):
+    def __init__(self, xyz: torch.Tensor, voxel_size: float, depth: int, morton_order: bool = False,
+                 index_type: str = "cuckoo"):
         """
         Build an octree structure, and each layer is indexed as a sparse hash table.
-            This only deal with a single instance (batch size = 1)
+            This deals with a single instance (batch size = 1), use HashTree.from_batch to pack several instances.
         :param xyz: [N, 3]
         :param voxel_size: size of the voxel to discrete points
         :param depth: octree depth. [0] is the bottom,
             [-1] is pseudo-root (highest level, may contain multiple nodes but at least one.)
+        :param morton_order: keep the voxels of each built level in Z-order for better memory locality.
+        :param index_type: voxel index of each level, 'cuckoo' hash table or 'sorted' Morton keys
+            (collision-free for voxel coordinates within [-2^20, 2^20), suited for static trees that are queried
+            many times).
         """
         self.xyz = xyz
         self.xyz_depth = None
@@ -49,10 +55,177 @@ class HashTree:
         self.device = self.xyz.device
         self.is_reflected = False
 
+        # Batch packing, refer to HashTree.from_batch
+        self.batch_size = 1
+        self.batch_origin = 0.0
+        self.batch_spacing = 0.0
+        self.xyz_batch_ids = None
+
         range_kernel_func = weakref.WeakMethod(self.get_range_kernel)
-        self._enc_branch = SparseFeatureHierarchy(depth, voxel_size, self.device, range_kernel_func)
-        self._dec_branch = SparseFeatureHierarchy(depth, voxel_size, self.device, range_kernel_func)
-        self._dec_tmp_branch = SparseFeatureHierarchy(depth, voxel_size, self.device, range_kernel_func)
+        self._enc_branch, self._dec_branch, self._dec_tmp_branch = [
+            SparseFeatureHierarchy(depth, voxel_size, self.device, range_kernel_func, morton_order, index_type)
+            for _ in range(3)]
+
+    @classmethod
+    def from_batch(cls, xyz_list: list, voxel_size: float, depth: int, margin: int = 8, batch_spacing: float = None,
+                   **kwargs):
+        """
+        Pack several instances into one tree, the batch coordinate being folded into x:
+            instance b is translated by b * batch_spacing along x. The spacing is a multiple of the coarsest voxel
+        size and leaves a gap of at least margin coarsest voxels between instances, so every level quantizes each
+        instance exactly as its own tree would and no neighbourhood (splatting, convolution kernels, basis
+        supports) crosses instances. All tree operations, the sparse U-Net and the solver (whose system becomes
+        block-diagonal) hence run on the packed batch unchanged.
+        :param xyz_list: list of (N_b, 3) points of each instance
+        :param margin: int, gap between instances in voxels of the coarsest level.
+        :param batch_spacing: float, if set, use this spacing (see HashTree.get_batch_spacing) instead of the one
+            of xyz_list, so that trees of the same instances (e.g. input and GT) share one packed frame.
+        :param kwargs: other arguments of HashTree.__init__
+        """
+        x_min = min(xyz[:, 0].min().item() for xyz in xyz_list)
+        x_max = max(xyz[:, 0].max().item() for xyz in xyz_list)
+
+        min_spacing = cls.get_batch_spacing(xyz_list, voxel_size, depth, margin)
+        if batch_spacing is None:
+            batch_spacing = min_spacing
+        assert batch_spacing >= min_spacing, "Batch spacing is too small to separate the instances!"
+        batch_offsets = cls._make_batch_offsets(len(xyz_list), batch_spacing, xyz_list[0])
+        hash_tree = cls(torch.cat([xyz + batch_offsets[b] for b, xyz in enumerate(xyz_list)], dim=0),
+                        voxel_size, depth, **kwargs)
+        hash_tree.batch_size = len(xyz_list)
+        hash_tree.batch_origin = (x_min + x_max) / 2.
+        hash_tree.batch_spacing = batch_spacing
+        hash_tree.xyz_batch_ids = cls.get_list_batch_ids(xyz_list)
+        return hash_tree
+
+    @staticmethod
+    def get_batch_spacing(xyz_list: list, voxel_size: float, depth: int, margin: int = 8) -> float:
+        """
+        :return: the spacing HashTree.from_batch uses to pack xyz_list, pass the spacing of all point sets of
+            the instances to pack them into the same frame.
+        """
+        coarsest_size = voxel_size * 2 ** (depth - 1)
+        x_min = min(xyz[:, 0].min().item() for xyz in xyz_list)
+        x_max = max(xyz[:, 0].max().item() for xyz in xyz_list)
+        return float(np.ceil((x_max - x_min) / coarsest_size + margin) * coarsest_size)
+
+    @staticmethod
+    def get_list_batch_ids(xyz_list: list) -> torch.Tensor:
+        """
+        :param xyz_list: list of (N_b, 3) positions of each instance, as given to pack_xyz
+        :return: (sum N_b, ) long, instance of each packed position, exact unlike get_batch_ids.
+        """
+        n_points = torch.tensor([xyz.size(0) for xyz in xyz_list], dtype=torch.long, device=xyz_list[0].device)
+        return torch.repeat_interleave(torch.arange(len(xyz_list), device=n_points.device), n_points)
+
+    @staticmethod
+    def _make_batch_offsets(batch_size: int, batch_spacing: float, like: torch.Tensor):
+        batch_offsets = like.new_zeros((batch_size, 3))
+        batch_offsets[:, 0] = torch.arange(batch_size, device=like.device) * batch_spacing
+        return batch_offsets
+
+    @property
+    def batch_offsets(self) -> torch.Tensor:
+        """
+        :return: (B, 3) translation applied to each instance.
+        """
+        return self._make_batch_offsets(self.batch_size, self.batch_spacing, self.xyz)
+
+    def pack_xyz(self, xyz_list: list) -> torch.Tensor:
+        """
+        Bring positions of each instance (e.g. query or supervision points) into the packed frame of the tree.
+        :param xyz_list: list of (N_b, 3), of length batch_size
+        :return: (sum N_b, 3)
+        """
+        assert len(xyz_list) == self.batch_size
+        batch_offsets = self.batch_offsets
+        return torch.cat([xyz + batch_offsets[b] for b, xyz in enumerate(xyz_list)], dim=0)
+
+    def unpack_xyz(self, xyz: torch.Tensor):
+        """
+        Inverse of pack_xyz.
+        :param xyz: (N, 3) positions in the packed frame
+        :return: (N, 3) positions in the frame of their instance, (N, ) long instance ids
+        """
+        batch_ids = self.get_batch_ids(xyz)
+        return xyz - self.batch_offsets[batch_ids], batch_ids
+
+    def get_batch_ids(self, xyz: torch.Tensor) -> torch.Tensor:
+        """
+        Recover the instance of arbitrary positions from their location, prefer get_list_batch_ids for positions
+            that were packed from per-instance lists.
+        :param xyz: (N, 3) positions in the packed frame
+        :return: (N, ) long, instance each position belongs to.
+        """
+        if self.batch_size == 1:
+            return torch.zeros((xyz.size(0), ), dtype=torch.long, device=xyz.device)
+        batch_ids = torch.round((xyz[:, 0] - self.batch_origin) / self.batch_spacing)
+        return batch_ids.long().clamp_(0, self.batch_size - 1)
+
+    def get_voxel_batch_ids(self, branch: int, depth: int) -> torch.Tensor:
+        """
+        :return: (M, ) long, instance each voxel of branch at depth belongs to.
+        """
+        return self.get_batch_ids(self.get_voxel_centers(depth, branch))
+
+    def save(self, path, extra_meta: dict = None):
+        """
+        Save a snapshot of the tree (points, per-point depth and density, coordinates of all branches and
+        the neighbour map caches) into a flat binary file, see HashTree.load.
+        :param extra_meta: json-serializable dict stored along, could be read back by HashTree.load_meta.
+        """
+        branches = [self._enc_branch] if self.is_reflected else [self._enc_branch, self._dec_branch,
+                                                                 self._dec_tmp_branch]
+        tensors = {"xyz": self.xyz}
+        if self.xyz_batch_ids is not None:
+            tensors["xyz_batch_ids"] = self.xyz_batch_ids
+        if self.xyz_depth is not None:
+            tensors["xyz_depth"] = self.xyz_depth
+        if self.xyz_density is not None:
+            tensors["xyz_density"] = self.xyz_density
+        for branch_idx, branch in enumerate(branches):
+            tensors.update({f"branch{branch_idx}/{k}": v for k, v in branch.state_dict().items()})
+        save_tensor_dict(path, tensors, {
+            "depth": self.depth, "voxel_size": self.voxel_size, "is_reflected": self.is_reflected,
+            "morton_order": self.morton_order, "index_type": self._enc_branch.index_type,
+            "batch_size": self.batch_size, "batch_origin": self.batch_origin, "batch_spacing": self.batch_spacing,
+            "extra": extra_meta or {}})
+
+    @staticmethod
+    def load_meta(path) -> dict:
+        """
+        :return: the extra_meta given to HashTree.save, only the file header is read.
+        """
+        return load_tensor_dict_meta(path).get("extra", {})
+
+    @classmethod
+    def load(cls, path, device: Union[str, torch.device] = "cuda"):
+        """
+        Load a tree saved by HashTree.save. The file is memory-mapped, only the cuckoo hash tables are rebuilt.
+        :param device: device where the tree should reside.
+        """
+        tensors, meta = load_tensor_dict(path)
+        hash_tree = cls(tensors["xyz"].to(device), voxel_size=meta["voxel_size"], depth=meta["depth"],
+                        morton_order=meta.get("morton_order", False),
+                        index_type=meta.get("index_type", "cuckoo"))
+        hash_tree.batch_size = meta.get("batch_size", 1)
+        hash_tree.batch_origin = meta.get("batch_origin", 0.0)
+        hash_tree.batch_spacing = meta.get("batch_spacing", 0.0)
+        if "xyz_batch_ids" in tensors.keys():
+            hash_tree.xyz_batch_ids = tensors["xyz_batch_ids"].to(device)
+        if "xyz_depth" in tensors.keys():
+            hash_tree.xyz_depth = tensors["xyz_depth"].to(device)
+        if "xyz_density" in tensors.keys():
+            hash_tree.xyz_density = tensors["xyz_density"].to(device)
+
+        branches = [hash_tree._enc_branch, hash_tree._dec_branch, hash_tree._dec_tmp_branch]
+        if meta["is_reflected"]:
+            hash_tree.reflect_decoder_coords()
+            branches = branches[:1]
+        for branch_idx, branch in enumerate(branches):
+            prefix = f"branch{branch_idx}/"
+            branch.load_state_dict({k[len(prefix):]: v for k, v in tensors.items() if k.startswith(prefix)})
+        return hash_tree
 
     def reflect_decoder_coords(self):
         """
@@ -75,6 +248,10 @@ class HashTree:
         """
         return self._enc_branch.depth
 
+    @property
+    def morton_order(self) -> bool:
+        return self._enc_branch.morton_order
+
     def get_coords(self, branch: int, depth: int) -> torch.Tensor:
         """
         :return: the bottom-left-lower coordinates at depth.
@@ -102,16 +279,23 @@ class HashTree:
     # Cache the kernel, so this will not change across machines.
     KERNEL_CACHE_PATH = Path(__file__).parent.parent / "data" / "kernel.npz"
     cached_kernels = None
+    # (device, n_range) -> kernel tensor, shared by all trees. Returned tensors should not be modified in-place.
+    device_kernels = {}
 
-    def get_range_kernel(self, n_range):
-        assert n_range % 2 == 1, "target_range must be odd."
-
-        if HashTree.cached_kernels is None:
-            data = np.load(HashTree.KERNEL_CACHE_PATH)
-            HashTree.cached_kernels = data['kernel']
+    @classmethod
+    def _load_cached_kernels(cls):
+        if cls.cached_kernels is None:
+            with np.load(cls.KERNEL_CACHE_PATH) as data:
+                cls.cached_kernels = data['kernel']
+        return cls.cached_kernels
 
-        kernel = torch.tensor(HashTree.cached_kernels.copy()[:n_range ** 3],
-                              dtype=torch.int, device=self.device)
+    def get_range_kernel(self, n_range):
+        kernel_key = (self.device, n_range)
+        kernel = HashTree.device_kernels.get(kernel_key, None)
+        if kernel is None:
+            assert n_range % 2 == 1, "target_range must be odd."
+            kernel = torch.tensor(self._load_cached_kernels()[:n_range ** 3], dtype=torch.int, device=self.device)
+            HashTree.device_kernels[kernel_key] = kernel
         return kernel
 
     def _get_branch(self, branch: int):
@@ -153,6 +337,12 @@ class HashTree:
         """
         return self._get_branch(branch).get_self_neighbours(source_depth, target_depth, target_range, conv_based)
 
+    def get_conv_kernel_map(self, source_depth: int, target_depth: int, kernel_size: int, branch: int):
+        """
+        Please refer to _hash_backend.SparseFeatureHierarchy.get_conv_kernel_map
+        """
+        return self._get_branch(branch).get_conv_kernel_map(source_depth, target_depth, kernel_size)
+
     def evaluate_interpolated(self, query_pos: torch.Tensor, basis, basis_feat: Union[torch.Tensor, None],
                               feat_depth: int, feat: torch.Tensor, compute_mask: bool = False,
                               compute_grad: bool = False):
@@ -174,9 +364,15 @@ class HashTree:
         if compute_grad:
             query_val = basis.evaluate_derivative(feat=basis_feat, xyz=query_coords, feat_ids=tgt_ids,
                                                   stride=dec_stride)
-            query_val = query_val * feat[tgt_ids, None]
+            if feat.ndim == 2:
+                # Multiple solutions (N, R) gives gradients of (K, 3, R)
+                query_val = query_val.unsqueeze(-1) * feat[tgt_ids].unsqueeze(1)
+            else:
+                query_val = query_val * feat[tgt_ids, None]
         else:
             query_val = basis.evaluate(feat=basis_feat, xyz=query_coords, feat_ids=tgt_ids)
+            if feat.ndim == 2:
+                query_val = query_val.unsqueeze(-1)
             query_val = query_val * feat[tgt_ids]
 
         # This automatically set non-supported chi to 0.
@@ -236,34 +432,55 @@ class HashTree:
         stat += self._dec_branch.__repr__()
         return stat
 
+    DENSITY_ESTIMATORS = ["bezier", "voxel"]
+
+    def compute_xyz_density(self, density_depth: int, density_estimator: str = "bezier", chunk_size: int = None):
+        """
+        Estimate the point density at self.xyz.
+        :param density_depth: tree depth whose voxel size is used as the smoothing kernel size.
+        :param density_estimator: 'bezier': kernel density estimation with a Bezier tensor basis on a temporary tree
+            (compute_density); 'voxel': trilinear-smoothed voxel counts computed on the encoder branch
+            (SparseFeatureHierarchy.estimate_voxel_density), faster but with a narrower kernel.
+        :param chunk_size: int or None, maximum number of (point, voxel) pairs processed at once.
+        :return: (N, ) density
+        """
+        enc_stride = self._enc_branch.get_stride(density_depth)
+        if density_estimator == "bezier":
+            xyz_density = compute_density(self.xyz, enc_stride * self.voxel_size, chunk_size)
+        elif density_estimator == "voxel":
+            xyz_density = self._enc_branch.estimate_voxel_density(self.xyz, density_depth, chunk_size)
+        else:
+            raise NotImplementedError
+        return xyz_density / (enc_stride ** 2)
+
     def build_encoder_hierarchy_dense(self, expand_range: int = 0, density_depth: int = 2,
-                                      uniform_density: bool = False):
+                                      uniform_density: bool = False, chunk_size: int = None,
+                                      density_estimator: str = "bezier"):
         """
         Rebuild the tree structure, based on current xyz, voxel_size and depth.
+        :param chunk_size: int or None, maximum number of (point, voxel) pairs processed at once.
+        :param density_estimator: str, refer to compute_xyz_density
         """
         if uniform_density:
             self.xyz_density = torch.ones((self.xyz.size(0),), device=self.device)
         else:
-            enc_stride = self._enc_branch.get_stride(density_depth)
-            self.xyz_density = compute_density(
-                self.xyz, enc_stride * self.voxel_size) / (enc_stride ** 2)
-        self._enc_branch.build_hierarchy_dense(self.xyz, expand_range=expand_range)
+            self.xyz_density = self.compute_xyz_density(density_depth, density_estimator, chunk_size)
+        self._enc_branch.build_hierarchy_dense(self.xyz, expand_range=expand_range, chunk_size=chunk_size)
         self.xyz_depth = torch.zeros((self.xyz.size(0),), device=self.device, dtype=torch.int)
 
     def build_hierarchy_subdivide(self, subdivide_policy, expand: bool = False, density_depth: int = 2,
-                                  limit_adaptive_depth: int = 100,
+                                  limit_adaptive_depth: int = 100, density_estimator: str = "bezier",
                                   **policy_kwargs):
         """
         Build a hierarchy, based on subdivision policy
         """
-        enc_stride = self._enc_branch.get_stride(density_depth)
-        self.xyz_density = compute_density(
-            self.xyz, enc_stride * self.voxel_size) / (enc_stride ** 2)
+        self.xyz_density = self.compute_xyz_density(density_depth, density_estimator)
         self.xyz_depth = self._enc_branch.build_hierarchy_subdivide(
             self.xyz, subdivide_policy, expand, limit_adaptive_depth, **policy_kwargs)
 
     def build_encoder_hierarchy_adaptive(self, density_depth: int = 2, log_base: float = 4.0, min_density: float = 8.0,
-                                         uniform_density: bool = False, limit_adaptive_depth: int = 100):
+                                         uniform_density: bool = False, limit_adaptive_depth: int = 100,
+                                         chunk_size: int = None, density_estimator: str = "bezier"):
         """
         Build the hierarchy by first determine the integer level of each point (based on xyz_density, log_base and
         min_density), then splat the points onto the tree structure.
@@ -272,6 +489,9 @@ class HashTree:
         :param log_base: float
         :param min_density: float, minimum density in each voxel. If exceed, go to coarser level.
         :param limit_adaptive_depth: int. Maximum adaptive number of levels.
+        :param chunk_size: int or None, maximum number of (point, voxel) pairs processed at once by density
+            estimation and quantization, bounding the working set for very large inputs. None for all at once.
+        :param density_estimator: str, refer to compute_xyz_density
         :return torch.Tensor long. (N, ) level that the point lies in.
         """
         if uniform_density:
@@ -279,25 +499,25 @@ class HashTree:
             assert log_base == 4.0 and min_density == 8.0 and limit_adaptive_depth == 100
             self.xyz_density = torch.ones((self.xyz.size(0),), device=self.device) * 1e6
         else:
-            enc_stride = self._enc_branch.get_stride(density_depth)
-            self.xyz_density = compute_density(
-                self.xyz, enc_stride * self.voxel_size) / (enc_stride ** 2)
+            self.xyz_density = self.compute_xyz_density(density_depth, density_estimator, chunk_size)
         self.xyz_depth = self._enc_branch.build_hierarchy_adaptive(
-            self.xyz, self.xyz_density, log_base, min_density, limit_adaptive_depth)
+            self.xyz, self.xyz_density, log_base, min_density, limit_adaptive_depth, chunk_size)
 
-    def split_data(self, xyz: torch.Tensor, branch: int, data_depth: int, data: torch.Tensor):
+    def split_data(self, xyz: torch.Tensor, branch: int, data_depth: int, data: torch.Tensor,
+                   chunk_size: int = None):
         """
         Obtain the tri-linearly interpolated data located at xyz.
         :param branch: int
         :param xyz: torch.Tensor (N, 3)
         :param data_depth: int
         :param data: torch.Tensor (M, K), where K is feature dimension, and M = self.get_num_voxels(data_depth)
+        :param chunk_size: int or None, maximum number of (point, voxel) pairs processed at once.
         :return: (N, K) torch.Tensor
         """
-        return self._get_branch(branch).split_data(xyz, data_depth, data)
+        return self._get_branch(branch).split_data(xyz, data_depth, data, chunk_size)
 
     def splat_data(self, xyz: torch.Tensor, branch: int, data_depth: int, data: torch.Tensor = None,
-                   check_corr: bool = True, return_nf_mask: bool = False):
+                   check_corr: bool = True, return_nf_mask: bool = False, chunk_size: int = None):
         """
         Splat data located at xyz to the tree voxels.
         :param branch: int
@@ -306,6 +526,7 @@ class HashTree:
         :param data: torch.Tensor (N, K)
         :param check_corr: if True, check if data is fully supported by its 8 neighbours
         :param return_nf_mask: Legacy, do not use.
+        :param chunk_size: int or None, maximum number of (point, voxel) pairs processed at once.
         :return: (M, K) or (M,), where M = self.get_num_voxels(data_depth)
         """
-        return self._get_branch(branch).splat_data(xyz, data_depth, data, check_corr, return_nf_mask)
+        return self._get_branch(branch).splat_data(xyz, data_depth, data, check_corr, return_nf_mask, chunk_size)
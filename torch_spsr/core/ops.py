@@ -1,6 +1,9 @@
 import functools
+import json
+import os
 import weakref
 
+import numpy as np
 import torch
 import torch_scatter
 from torch_spsr.ext import marching_cubes, sparse_op
@@ -127,6 +130,80 @@ def torch_unique(input: torch.Tensor, sorted: bool = False, return_inverse: bool
     return res
 
 
+# Morton keys hold 21 bits per axis, coordinates are shifted so that [-2^20, 2^20) is representable.
+MORTON_BITS = 21
+MORTON_OFFSET = 1 << (MORTON_BITS - 1)
+
+
+def _morton_spread(x: torch.Tensor) -> torch.Tensor:
+    x = x & 0x1fffff
+    x = (x | (x << 32)) & 0x1f00000000ffff
+    x = (x | (x << 16)) & 0x1f0000ff0000ff
+    x = (x | (x << 8)) & 0x100f00f00f00f00f
+    x = (x | (x << 4)) & 0x10c30c30c30c30c3
+    x = (x | (x << 2)) & 0x1249249249249249
+    return x
+
+
+def _morton_compact(x: torch.Tensor) -> torch.Tensor:
+    x = x & 0x1249249249249249
+    x = (x ^ (x >> 2)) & 0x10c30c30c30c30c3
+    x = (x ^ (x >> 4)) & 0x100f00f00f00f00f
+    x = (x ^ (x >> 8)) & 0x1f0000ff0000ff
+    x = (x ^ (x >> 16)) & 0x1f00000000ffff
+    x = (x ^ (x >> 32)) & 0x1fffff
+    return x
+
+
+def morton_in_range(coords: torch.Tensor, offsets: torch.Tensor = None) -> torch.Tensor:
+    """
+    :param coords: (N, 3) integer coordinates
+    :param offsets: (K, 3) offsets to be added to coordinates
+    :return: (N, ) bool, or (K, N) if offsets is provided, whether the coordinates are within [-2^20, 2^20).
+    """
+    coords = coords.long()
+    if offsets is not None:
+        coords = coords.unsqueeze(0) + offsets.long().unsqueeze(1)
+    return torch.all(torch.logical_and(coords >= -MORTON_OFFSET, coords < MORTON_OFFSET), dim=-1)
+
+
+def morton_encode(coords: torch.Tensor, offsets: torch.Tensor = None) -> torch.Tensor:
+    """
+    Interleave the bits of integer coordinates into Z-order (Morton) keys.
+    :param coords: (N, 3) integer coordinates within [-2^20, 2^20)
+    :param offsets: (K, 3) offsets to be added to coordinates
+    :return: (N, ) int64 non-negative keys, or (K, N) if offsets is provided.
+        Sorting the keys gives the Z-order of the coordinates. Coordinates out of range wrap around and alias
+    other keys, use morton_in_range to exclude them.
+    """
+    keys = None
+    for axis in range(3):
+        axis_coords = coords[:, axis].long() + MORTON_OFFSET
+        if offsets is not None:
+            axis_coords = axis_coords.unsqueeze(0) + offsets[:, axis].long().unsqueeze(1)
+        axis_keys = _morton_spread(axis_coords) << axis
+        keys = axis_keys if keys is None else keys | axis_keys
+    return keys
+
+
+def morton_decode(keys: torch.Tensor) -> torch.Tensor:
+    """
+    Inverse of morton_encode.
+    :param keys: (N, ) int64
+    :return: (N, 3) int32 coordinates
+    """
+    return torch.stack([_morton_compact(keys >> axis) for axis in range(3)], dim=1).int() - MORTON_OFFSET
+
+
+def morton_sort(coords: torch.Tensor):
+    """
+    :param coords: (N, 3) integer coordinates
+    :return: (coords in Z-order, permutation such that sorted = coords[permutation])
+    """
+    permutation = torch.argsort(morton_encode(coords))
+    return coords[permutation], permutation
+
+
 def lru_cache_class(*lru_args, **lru_kwargs):
     def decorator(func):
         @functools.wraps(func)
@@ -143,3 +220,70 @@ def lru_cache_class(*lru_args, **lru_kwargs):
             return cached_method(*args, **kwargs)
         return wrapped_func
     return decorator
+
+
+_TENSOR_DICT_MAGIC = b"SPSRTD01"
+_TENSOR_DICT_ALIGN = 64
+
+
+def save_tensor_dict(path, tensors: dict, meta: dict = None):
+    """
+    Save tensors into a single flat binary file (a json header followed by raw, aligned buffers),
+    which could be memory-mapped by load_tensor_dict. The file is written atomically.
+    :param path: output file path
+    :param tensors: dict that maps from str to torch.Tensor
+    :param meta: json-serializable dict of extra information
+    """
+    header, buffers, offset = {}, [], 0
+    for name, tensor in tensors.items():
+        array = np.ascontiguousarray(tensor.detach().cpu().numpy())
+        header[name] = [array.dtype.str, list(array.shape), offset, array.nbytes]
+        buffers.append(array)
+        offset += (array.nbytes + _TENSOR_DICT_ALIGN - 1) // _TENSOR_DICT_ALIGN * _TENSOR_DICT_ALIGN
+    header = json.dumps({"meta": meta or {}, "tensors": header}).encode('utf-8')
+    data_start = len(_TENSOR_DICT_MAGIC) + 8 + len(header)
+    data_start = (data_start + _TENSOR_DICT_ALIGN - 1) // _TENSOR_DICT_ALIGN * _TENSOR_DICT_ALIGN
+
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, 'wb') as f:
+        f.write(_TENSOR_DICT_MAGIC)
+        f.write(len(header).to_bytes(8, 'little'))
+        f.write(header)
+        f.write(b"\0" * (data_start - f.tell()))
+        for array in buffers:
+            f.write(array.tobytes())
+            f.write(b"\0" * (-array.nbytes % _TENSOR_DICT_ALIGN))
+    os.replace(tmp_path, path)
+
+
+def _read_tensor_dict_header(path):
+    with open(path, 'rb') as f:
+        assert f.read(len(_TENSOR_DICT_MAGIC)) == _TENSOR_DICT_MAGIC, f"{path} is not a tensor dict file."
+        header = json.loads(f.read(int.from_bytes(f.read(8), 'little')).decode('utf-8'))
+        data_start = f.tell()
+    data_start = (data_start + _TENSOR_DICT_ALIGN - 1) // _TENSOR_DICT_ALIGN * _TENSOR_DICT_ALIGN
+    return header, data_start
+
+
+def load_tensor_dict_meta(path) -> dict:
+    """
+    Only read the meta dict of a file written by save_tensor_dict, without touching the tensors.
+    """
+    return _read_tensor_dict_header(path)[0]["meta"]
+
+
+def load_tensor_dict(path, device=None):
+    """
+    Load the file written by save_tensor_dict. The file is memory-mapped (copy-on-write), so tensors kept on
+    the CPU are only paged in when accessed.
+    :return: (dict of torch.Tensor, meta dict)
+    """
+    header, data_start = _read_tensor_dict_header(path)
+
+    mm = np.memmap(path, dtype=np.uint8, mode='c')
+    tensors = {}
+    for name, (dtype, shape, offset, nbytes) in header["tensors"].items():
+        array = mm[data_start + offset: data_start + offset + nbytes].view(np.dtype(dtype)).reshape(shape)
+        tensor = torch.from_numpy(array)
+        tensors[name] = tensor.to(device) if device is not None else tensor
+    return tensors, header["meta"]
@@ -1,3 +1,4 @@
+from collections import OrderedDict
 from typing import Union
 
 import torch
@@ -7,7 +8,7 @@ from torch_spsr.core.hashtree import HashTree, VoxelStatus
 from torch_spsr.bases.abc import BaseBasis
 from torch_spsr.core.ops import screened_multiplication, marching_cubes_op, marching_cubes, torch_unique
 from torch_spsr.ext import CuckooHashTable
-from torch_spsr.core.solver import solve_sparse
+from torch_spsr.core.solver import solve_sparse, SolverTelemetry
 
 
 class ScreeningData:
@@ -21,6 +22,74 @@ class ScreeningData:
         self.nb_sizes = nb_sizes
 
 
+class SolutionCache:
+    """
+    Solutions of previous solves, indexed by a user-given key (e.g. the shape name), so that the solver could be
+    warm-started when the same shape is visited again.
+        Solutions are stored together with their voxel coordinates, and are transferred to the new tree by
+    coordinate look-up, because the (predicted) tree structure could change between two visits.
+    """
+    def __init__(self, max_entries: int = 1024, max_bytes: int = 1024 * 1024 * 1024):
+        """
+        :param max_entries: maximum number of keys kept.
+        :param max_bytes: maximum total size of the stored coordinates and solutions.
+            Entries are kept in host memory (pinned if they come from a GPU), so this does not consume device memory.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.cur_bytes = 0
+        self.entries = OrderedDict()    # key -> {depth: (coords, solution)}
+
+    @staticmethod
+    def _to_host(tensor: torch.Tensor) -> torch.Tensor:
+        tensor = tensor.detach()
+        if not tensor.is_cuda:
+            return tensor
+        host_tensor = torch.empty(tensor.size(), dtype=tensor.dtype, pin_memory=True)
+        host_tensor.copy_(tensor)
+        return host_tensor
+
+    @staticmethod
+    def _entry_bytes(entry: dict) -> int:
+        return sum([t.element_size() * t.numel() for tensors in entry.values() for t in tensors])
+
+    def store(self, key, hash_tree: HashTree, branch: int, solutions: dict):
+        if key in self.entries.keys():
+            self.cur_bytes -= self._entry_bytes(self.entries.pop(key))
+        entry = {
+            d: (self._to_host(hash_tree.get_coords(branch, d)), self._to_host(sol)) for d, sol in solutions.items()
+        }
+        self.entries[key] = entry
+        self.cur_bytes += self._entry_bytes(entry)
+        while len(self.entries) > 1 and (len(self.entries) > self.max_entries or self.cur_bytes > self.max_bytes):
+            _, evicted = self.entries.popitem(last=False)
+            self.cur_bytes -= self._entry_bytes(evicted)
+
+    def fetch(self, key, hash_tree: HashTree, branch: int) -> dict:
+        """
+        :return: dict that maps from depth to the initial guess on the current tree, empty if key is never stored.
+        """
+        if key not in self.entries.keys():
+            return {}
+        self.entries.move_to_end(key)
+
+        initial_guess = {}
+        for d, (old_coords, old_solution) in self.entries[key].items():
+            if d >= hash_tree.depth or old_coords.size(0) == 0:
+                continue
+            new_coords = hash_tree.get_coords(branch, d)
+            if new_coords.size(0) == 0:
+                continue
+            old_coords = old_coords.to(new_coords.device, non_blocking=True)
+            old_solution = old_solution.to(new_coords.device, non_blocking=True)
+            old_ids = CuckooHashTable(data=old_coords).query(new_coords)
+            exist_mask = old_ids != -1
+            guess = old_solution.new_zeros((new_coords.size(0), ) + old_solution.shape[1:])
+            guess[exist_mask] = old_solution[old_ids[exist_mask]]
+            initial_guess[d] = guess
+        return initial_guess
+
+
 class Reconstructor:
     def __init__(self, hash_tree: HashTree, basis: BaseBasis, feat: dict = None):
         """
@@ -77,12 +146,14 @@ class Reconstructor:
 
     def solve_multigrid(self, start_depth, end_depth, normal_data: dict,
                         screen_alpha: Union[float, torch.Tensor] = 0.0, screen_xyz: torch.Tensor = None,
-                        screen_delta: Union[float, torch.Tensor] = 0.1,
-                        solver: str = "pcg", verbose: bool = True):
+                        screen_delta: Union[float, list, torch.Tensor] = 0.1,
+                        solver: str = "pcg", verbose: bool = True, initial_guess: dict = None,
+                        symmetric_storage: bool = False, telemetry: SolverTelemetry = None):
         """
             Build and solve the linear system L alpha = d, using our coarse-to-fine solver.
-        Note that the full V-cycle is not supported in this repo. Normal is however not smoothed
-        because empirically we've found no difference.
+        Normal is however not smoothed because empirically we've found no difference.
+            With the 'mg' or 'mgpcg' solvers, the system over all levels is instead assembled (with the
+        inter-level couplings in both directions) and solved as a whole using multigrid cycles over the tree.
             The energy function defined in our paper is solver within a truncated domain, with
         explicit dirichlet constraints that the boundary evaluates to 0. We choose not to eliminate
         such constraints because that will introduce many heterogeneous integral computations on
@@ -93,8 +164,17 @@ class Reconstructor:
         :param screen_alpha: float or Tensor. Weight of the screening term
         :param screen_xyz: None or Tensor. positional constraints to the system.
         :param screen_delta: float or Tensor. Target scalar value as described in the paper.
-        :param solver: you can choose from 'cholmod' or 'pcg' or 'mixed'.
+            A list of R floats, or a Tensor of (N_pts, R), solves R systems that share the same LHS at once,
+            and the solutions become (N_vx, R).
+        :param solver: you can choose from 'cholmod' or 'pcg' or 'mixed' or 'refine' (mixed-precision refinement),
+            or 'mg' / 'mgpcg' for the full multigrid.
+            Options are appended as '@key=value', e.g. 'mgpcg@gamma=2@n_smooth=3@tol=1e-6'.
         :param verbose: Output debug information during solve.
+        :param initial_guess: dictionary that maps from depth to the initial guess of the iterative solvers,
+            e.g. the solution of a previous visit obtained from SolutionCache.fetch.
+        :param symmetric_storage: assemble and store only the upper triangle of the (symmetric) LHS of each level.
+        :param telemetry: if provided, one record per level (assembly/screening time, size, iterations, residuals,
+            fallback decisions and peak memory) is appended to it.
         """
         if isinstance(screen_alpha, torch.Tensor):
             assert screen_xyz is not None, "Must provide points to be screened."
@@ -103,22 +183,57 @@ class Reconstructor:
         else:
             should_screen = screen_alpha > 0.0
 
+        # Multiple screening targets share the same LHS, so they are solved together as columns of the RHS.
+        n_rhs = 0
+        if should_screen and isinstance(screen_delta, (list, tuple)):
+            screen_delta = torch.tensor(screen_delta, dtype=torch.float32, device=screen_xyz.device)
+            screen_delta = screen_delta.unsqueeze(0).expand(screen_xyz.size(0), -1)
+        if should_screen and isinstance(screen_delta, torch.Tensor) and screen_delta.ndim == 2:
+            n_rhs = screen_delta.size(1)
+            if isinstance(screen_alpha, torch.Tensor):
+                screen_alpha_rhs = screen_alpha.unsqueeze(-1)
+            else:
+                screen_alpha_rhs = screen_alpha
+
         self.solutions = {}
         neighbour_range = 2 * self.basis.get_domain_range() - 1
 
+        # (d, dd) -> (src_ids, tgt_ids, values) and d -> rhs, for solving all levels at once.
+        full_system = solver.split("@")[0] in ["mg", "mgpcg"]
+        system_blocks, system_rhs = {}, {}
+
+        # Sizes could change if the guess is from a different tree.
+        if initial_guess is None:
+            initial_guess = {}
+        initial_guess = {
+            d: x0.detach() for d, x0 in initial_guess.items()
+            if d < self.hash_tree.depth and x0.size(0) == self.hash_tree.get_coords_size(self.branch, d)
+        }
+        if n_rhs > 0:
+            initial_guess = {
+                d: x0.unsqueeze(1).repeat(1, n_rhs) if x0.ndim == 1 else x0 for d, x0 in initial_guess.items()
+                if x0.ndim == 1 or x0.size(1) == n_rhs
+            }
+
         # Basis pre-evaluation for screening term.
-        screen_data = {}
+        screen_data, screen_time = {}, {}
         if should_screen:
             base_coords = screen_xyz / self.hash_tree.voxel_size - 0.5
             for d in range(end_depth, start_depth + 1):
+                if telemetry is not None:
+                    screen_start = telemetry.now(self.hash_tree.device)
                 pts_ids, vx_ids, tgt_offsets, nb_sizes = self.hash_tree.get_neighbours_data(
                     base_coords, 1, d, self.hash_tree.get_range_kernel(self.basis.get_domain_range()),
                     self.branch, transposed=True)
                 query_coords = -tgt_offsets / self.hash_tree.get_stride(self.branch, d)
                 query_val = self.basis.evaluate(feat=self.grid_features[d], xyz=query_coords, feat_ids=vx_ids)
                 screen_data[d] = ScreeningData(pts_ids, vx_ids, query_val, nb_sizes)
+                if telemetry is not None:
+                    screen_time[d] = telemetry.now(self.hash_tree.device) - screen_start
 
         for d in range(start_depth, end_depth - 1, -1):
+            if telemetry is not None:
+                telemetry.begin(self.hash_tree.device, level=d, screening_time=screen_time.get(d, 0.0))
             screen_factor = (1 / 4.) ** d
 
             # Build RHS:
@@ -140,13 +255,19 @@ class Reconstructor:
                     partial_sums, tree_ids, dim=0, dim_size=self.hash_tree.get_coords_size(self.branch, d))
 
             if should_screen:
-                if isinstance(screen_alpha, torch.Tensor) or isinstance(screen_delta, torch.Tensor):
+                screen_val = screen_data[d].values
+                if n_rhs > 0:
+                    mult = (screen_delta * screen_alpha_rhs)[screen_data[d].pts_ids]
+                    screen_val = screen_val.unsqueeze(-1)
+                    if isinstance(rhs_val, torch.Tensor):
+                        rhs_val = rhs_val.unsqueeze(-1)
+                elif isinstance(screen_alpha, torch.Tensor) or isinstance(screen_delta, torch.Tensor):
                     mult = (screen_delta * screen_alpha)[screen_data[d].pts_ids]
                 else:
                     mult = screen_alpha * screen_delta
-                rhs_val += screen_factor * torch_scatter.scatter_sum(
-                    screen_data[d].values * mult,
-                    screen_data[d].vx_ids, dim_size=self.hash_tree.get_coords_size(self.branch, d)
+                rhs_val = rhs_val + screen_factor * torch_scatter.scatter_sum(
+                    screen_val * mult,
+                    screen_data[d].vx_ids, dim=0, dim_size=self.hash_tree.get_coords_size(self.branch, d)
                 )
 
             # Correction:
@@ -163,12 +284,20 @@ class Reconstructor:
                 if should_screen:
                     a_d_dd_val = a_d_dd_val + screen_factor * self._evaluate_screening_term(
                         screen_data[d], screen_data[dd], src_ids, tgt_ids, screen_alpha)
+                if full_system:
+                    system_blocks[(d, dd)] = (src_ids, tgt_ids, a_d_dd_val)
+                    continue
+                if n_rhs > 0:
+                    a_d_dd_val = a_d_dd_val.unsqueeze(-1)
                 rhs_val -= torch_scatter.scatter_sum(self.solutions[dd][tgt_ids] * a_d_dd_val,
-                                                     src_ids, dim_size=rhs_val.size(0))
+                                                     src_ids, dim=0, dim_size=rhs_val.size(0))
 
             # Build LHS:
             src_ids, tgt_ids, rel_pos, _ = self.hash_tree.get_neighbours(d, d, target_range=neighbour_range,
                                                                          branch=self.branch)
+            if symmetric_storage:
+                upper_mask = src_ids <= tgt_ids
+                src_ids, tgt_ids, rel_pos = src_ids[upper_mask], tgt_ids[upper_mask], rel_pos[upper_mask]
             lhs_val = self.basis.integrate_deriv_deriv_product(
                 source_feat=self.grid_features[d],
                 target_feat=self.grid_features[d],
@@ -181,17 +310,74 @@ class Reconstructor:
                 lhs_val = lhs_val + screen_factor * self._evaluate_screening_term(
                     screen_data[d], screen_data[d], src_ids, tgt_ids, screen_alpha)
 
+            if telemetry is not None:
+                telemetry.lap("assembly_time")
+
+            if full_system:
+                system_blocks[(d, d)] = (src_ids, tgt_ids, lhs_val)
+                system_rhs[d] = rhs_val
+                if telemetry is not None:
+                    telemetry.current.update(n_unknowns=rhs_val.size(0), nnz=src_ids.size(0))
+                    telemetry.end()
+                continue
+
             if solver == "mixed":
                 cur_solver = "mixed" if d == end_depth else "cholmod"
             else:
                 cur_solver = solver
-            self.solutions[d] = solve_sparse(src_ids, tgt_ids, lhs_val, rhs_val, cur_solver)
-
             # Dump residual for comparison
-            if verbose:
-                residual = torch_scatter.scatter_sum(self.solutions[d][tgt_ids] * lhs_val, src_ids,
-                                                     dim_size=rhs_val.size(0)) - rhs_val
-                print(f"Solving complete at level {d}, residual = {torch.linalg.norm(residual).item()}.")
+            self.solutions[d] = solve_sparse(
+                src_ids, tgt_ids, lhs_val, rhs_val, cur_solver,
+                verbose_str=f"Solving complete at level {d}, residual = {{residual}}." if verbose else None,
+                x0=initial_guess.get(d, None), symmetric=symmetric_storage,
+                stats=telemetry.current if telemetry is not None else None)
+            if telemetry is not None:
+                telemetry.end()
+
+        if full_system:
+            self._solve_full_system(system_blocks, system_rhs, solver, verbose, initial_guess, symmetric_storage,
+                                    telemetry)
+
+    def _solve_full_system(self, system_blocks: dict, system_rhs: dict, solver: str, verbose: bool,
+                           initial_guess: dict, symmetric_storage: bool = False, telemetry: SolverTelemetry = None):
+        """
+        Stack the per-level systems into a single block matrix (finest level first) and solve it at once.
+        :param system_blocks: (d, dd) -> (src_ids, tgt_ids, values), d <= dd. Off-diagonal blocks are mirrored,
+            unless symmetric_storage is set, in which case they already form the upper triangle together with
+            the (upper triangular) diagonal blocks.
+        :param system_rhs: d -> rhs
+        :param initial_guess: d -> x0, levels not provided start from zero.
+        :param telemetry: if provided, the solve is recorded with level 'all'.
+        """
+        if telemetry is not None:
+            telemetry.begin(self.hash_tree.device, level="all")
+        depths = sorted(system_rhs.keys())
+        block_sizes = [system_rhs[d].size(0) for d in depths]
+        offsets = dict(zip(depths, np.cumsum([0] + block_sizes[:-1]).tolist()))
+
+        a_i, a_j, a_x = [], [], []
+        for (d, dd), (src_ids, tgt_ids, val) in system_blocks.items():
+            a_i.append(src_ids + offsets[d])
+            a_j.append(tgt_ids + offsets[dd])
+            a_x.append(val)
+            if d != dd and not symmetric_storage:
+                a_i.append(tgt_ids + offsets[dd])
+                a_j.append(src_ids + offsets[d])
+                a_x.append(val)
+
+        x0 = None
+        if len(initial_guess) > 0:
+            x0 = torch.cat([initial_guess.get(d, torch.zeros_like(system_rhs[d])) for d in depths])
+
+        solution = solve_sparse(
+            torch.cat(a_i), torch.cat(a_j), torch.cat(a_x), torch.cat([system_rhs[d] for d in depths]), solver,
+            verbose_str="Multigrid solve complete in {time:.3f}s, residual = {residual}." if verbose else None,
+            block_sizes=block_sizes, x0=x0, symmetric=symmetric_storage,
+            stats=telemetry.current if telemetry is not None else None)
+        if telemetry is not None:
+            telemetry.end()
+        for d in depths:
+            self.solutions[d] = solution[offsets[d]: offsets[d] + system_rhs[d].size(0)]
 
     def evaluate_raw_chi(self, xyz: torch.Tensor, compute_mask: bool = False,
                          compute_grad: bool = False, depths: list = None):
@@ -201,7 +387,7 @@ class Reconstructor:
         :param compute_grad: whether to compute gradient of the field
         :param xyz: torch.Tensor (N x 3). metric-space positions
         :param compute_mask: bool for debugging purpose
-        :return: (N,) chi value.
+        :return: (N,) chi value, or (N, R) if multiple screening targets are solved.
         """
         assert len(self.solutions) > 0, "Please run solver before evaluation."
 
@@ -228,11 +414,25 @@ class Reconstructor:
         if self.fixed_level_set is not None:
             return self.fixed_level_set
         sdf_surface = self.evaluate_raw_chi(self.hash_tree.xyz)
+        if self.hash_tree.batch_size > 1:
+            # One level set per instance of a packed batch: (B, ) or (B, R)
+            batch_ids, batch_size = self.hash_tree.xyz_batch_ids, self.hash_tree.batch_size
+            if self.sample_weight is None:
+                print("Warning: Sample weight not set.")
+                return torch_scatter.scatter_mean(sdf_surface, batch_ids, dim=0, dim_size=batch_size)
+            sample_weight = self.sample_weight
+            if sdf_surface.ndim == 2:
+                sample_weight = sample_weight.unsqueeze(-1)
+            return torch_scatter.scatter_sum(sdf_surface * sample_weight, batch_ids, dim=0, dim_size=batch_size) / \
+                torch_scatter.scatter_sum(sample_weight, batch_ids, dim=0, dim_size=batch_size)
         if self.sample_weight is None:
             print("Warning: Sample weight not set.")
-            return torch.mean(sdf_surface)
+            return torch.mean(sdf_surface, dim=0)
         else:
-            return torch.sum(sdf_surface * self.sample_weight) / torch.sum(self.sample_weight)
+            sample_weight = self.sample_weight
+            if sdf_surface.ndim == 2:
+                sample_weight = sample_weight.unsqueeze(-1)
+            return torch.sum(sdf_surface * sample_weight, dim=0) / torch.sum(sample_weight, dim=0)
 
     def evaluate_chi(self, xyz: torch.Tensor, compute_mask: bool = False, max_points: int = -1, depths: list = None):
         """
@@ -246,8 +446,15 @@ class Reconstructor:
 
         for xyz in xyz_chunks:
             sdf_val = self.evaluate_raw_chi(xyz, compute_mask=compute_mask, depths=depths)
+            if self.fixed_level_set is None and self.hash_tree.batch_size > 1:
+                # Shift by the level set of the instance each position belongs to.
+                chunk_mean_chi = mean_chi[self.hash_tree.get_batch_ids(xyz)]
+                sdf_val = (sdf_val[0] - chunk_mean_chi, sdf_val[1]) if compute_mask else sdf_val - chunk_mean_chi
             sdf_val_chunks.append(sdf_val)
 
+        if self.fixed_level_set is None and self.hash_tree.batch_size > 1:
+            mean_chi = 0.0
+
         if compute_mask:
             return torch.cat([t[0] for t in sdf_val_chunks]) - mean_chi, torch.cat([t[1] for t in sdf_val_chunks])
 
@@ -1,18 +1,140 @@
+import json
 import time
 import torch
 import torch_scatter
 import functools
+import numpy as np
+from collections import OrderedDict
 
 from omegaconf import OmegaConf
 from torch_spsr.core import ops
 from torch_spsr.ext import sparse_solve
 
 
+class SparsityPattern:
+    """
+    Structure-only part of a sparse matrix (i.e. everything that does not depend on a_x), which can be shared
+    among all matrices with the same (a_i, a_j, dim).
+    """
+    def __init__(self, a_i: torch.Tensor, a_j: torch.Tensor, dim_i: int, dim_j: int):
+        self.a_i = a_i
+        self.a_j = a_j
+        self.dim_i = dim_i
+        self.dim_j = dim_j
+
+        # Compress row:
+        device = a_i.device
+        a_p = torch_scatter.scatter_sum(
+            torch.ones((a_i.size(0)), dtype=torch.long, device=device), a_i, dim_size=dim_i)
+        self.csr_p = torch.cat([torch.zeros((1,), dtype=torch.long, device=device), torch.cumsum(a_p, dim=0)])
+        # Order columns:
+        self.csr_seq = torch.argsort(a_i)
+        self.csr_j = a_j[self.csr_seq]
+
+        # Symbolic analysis of the direct solver, computed on first use.
+        self.symbolic_factor = None
+        # Fill-reducing ordering of the multi-RHS CUDA direct solver, computed on first use.
+        self.cuda_ordering = None
+        self._fingerprint = None
+
+    @property
+    def nbytes(self) -> int:
+        tensors = [self.a_i, self.a_j, self.csr_p, self.csr_seq, self.csr_j] + list(self.cuda_ordering or [])
+        return sum([t.element_size() * t.numel() for t in tensors])
+
+    @staticmethod
+    def compute_fingerprint(a_i: torch.Tensor, a_j: torch.Tensor, dim_j: int) -> tuple:
+        """
+        Order-dependent hash of the pattern computed on its device, only the result is transferred to the host.
+            Each entry is mixed with its position (multiply-xorshift, wrapping around in int64) before the two
+        sums, so that the hash is not linear in the indices. It is only used to filter candidates, see
+        SparsityPattern.matches.
+        """
+        pos = torch.arange(1, a_i.size(0) + 1, dtype=torch.long, device=a_i.device)
+        mixed = (a_i.long() * dim_j + a_j.long()) * 0x1E3779B97F4A7C15 + pos * 0x632BE59BD9B4E019
+        mixed = mixed ^ (mixed >> 31)
+        mixed = mixed * 0x2545F4914F6CDD1D
+        mixed = mixed ^ (mixed >> 29)
+        return tuple(torch.stack([mixed.sum(), (mixed * (pos | 1)).sum()]).tolist())
+
+    @property
+    def fingerprint(self) -> tuple:
+        if self._fingerprint is None:
+            self._fingerprint = self.compute_fingerprint(self.a_i, self.a_j, self.dim_j)
+        return self._fingerprint
+
+    def matches(self, a_i: torch.Tensor, a_j: torch.Tensor) -> bool:
+        """
+        Exact comparison of the pattern, fingerprints could collide.
+        """
+        return torch.equal(self.a_i, a_i) and torch.equal(self.a_j, a_j)
+
+
+class SparsityPatternCache:
+    """
+    LRU cache of SparsityPattern keyed by the sparsity pattern of the matrix, so that repeated solves on the
+    same tree structure skip the CSR ordering and the symbolic factorization.
+        Patterns are first looked up by host-side metadata (device, dimensions, nnz, block sizes), which needs no
+    device synchronization. Only if patterns share the metadata, the candidates are filtered by a fingerprint
+    computed on the device (see SparsityPattern.compute_fingerprint) and a hit is confirmed by an exact comparison.
+        Each device has its own budget: its entries are evicted (least recently used first) once their total size
+    exceeds max_bytes.
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.cur_bytes = {}             # device -> bytes
+        self.entries = OrderedDict()    # (metadata, serial) -> SparsityPattern
+        self._serial = 0
+
+    @staticmethod
+    def _get_meta(a_i: torch.Tensor, dim_i: int, dim_j: int, block_inds: list = None):
+        return str(a_i.device), dim_i, dim_j, a_i.size(0), tuple(block_inds) if block_inds is not None else None
+
+    def get(self, a_i: torch.Tensor, a_j: torch.Tensor, dim_i: int, dim_j: int,
+            block_inds: list = None) -> SparsityPattern:
+        """
+        :param block_inds: block partition of the matrix if any, only used to tell patterns apart cheaply.
+        :return: the cached pattern if (a_i, a_j, dim) has been seen before, otherwise a newly inserted one.
+        """
+        meta = self._get_meta(a_i, dim_i, dim_j, block_inds)
+        candidates = [key for key in self.entries.keys() if key[0] == meta]
+        fingerprint = None
+        if len(candidates) > 0:
+            fingerprint = SparsityPattern.compute_fingerprint(a_i, a_j, dim_j)
+            for key in candidates:
+                if self.entries[key].fingerprint == fingerprint and self.entries[key].matches(a_i, a_j):
+                    self.entries.move_to_end(key)
+                    return self.entries[key]
+
+        pattern = SparsityPattern(a_i, a_j, dim_i, dim_j)
+        pattern._fingerprint = fingerprint
+        device = meta[0]
+        self.entries[(meta, self._serial)] = pattern
+        self._serial += 1
+        self.cur_bytes[device] = self.cur_bytes.get(device, 0) + pattern.nbytes
+        device_keys = [key for key in self.entries.keys() if key[0][0] == device]
+        for key in device_keys[:-1]:
+            if self.cur_bytes[device] <= self.max_bytes:
+                break
+            self.cur_bytes[device] -= self.entries.pop(key).nbytes
+        return pattern
+
+    def clear(self):
+        self.entries.clear()
+        self.cur_bytes = {}
+
+
+# Shared by all solves, adjust max_bytes (per device) to control the memory kept alive by the cache.
+pattern_cache = SparsityPatternCache(max_bytes=512 * 1024 * 1024)
+
+
 class SparseMatrixStorage:
     """
     Cache is used to store factorizations and block decompositions
         So don't alter the members after they are initialized!
     """
+    symmetric = False
+
     def __init__(self, a_i, a_j, a_x, dim: int, dim_j: int = None):
         self.a_i = a_i.detach()
         self.a_j = a_j.detach()
@@ -27,7 +149,8 @@ class SparseMatrixStorage:
         self.block_inds = None
 
     def __matmul__(self, res):
-        return torch_scatter.scatter_sum(res[self.a_j] * self.a_x, self.a_i, dim_size=self.dim_i)
+        # Row-wise CSR product, without the nnz-sized temporary and the atomics of a gather + scatter.
+        return self.csr_tensor(res.dtype) @ res
 
     @property
     def shape(self):
@@ -37,15 +160,80 @@ class SparseMatrixStorage:
     def from_dict(cls, data: dict, dim: int, dim_j: int = None):
         return SparseMatrixStorage(data["i"], data["j"], data["x"], dim, dim_j)
 
+    def set_block_partition(self, block_sizes: list):
+        """
+        Partition the (square) matrix into n_blocks x n_blocks blocks, e.g. one block per tree level.
+        :param block_sizes: list of int, sizes of the consecutive diagonal blocks.
+        """
+        assert sum(block_sizes) == self.dim_i == self.dim_j, "Block sizes do not agree with matrix size."
+        self.n_blocks = len(block_sizes)
+        self.block_inds = [0] + np.cumsum(block_sizes).tolist()
+        self.sub_blocks = {}
+
+    def get_block_size(self, bi: int) -> int:
+        return self.block_inds[bi + 1] - self.block_inds[bi]
+
+    def get_block(self, bi: int, bj: int = None):
+        """
+        :param bi: row block index
+        :param bj: column block index, if None, then the whole block-row (with global column indices) is returned.
+        :return: SparseMatrixStorage
+        """
+        if (bi, bj) not in self.sub_blocks.keys():
+            i_start, i_end = self.block_inds[bi], self.block_inds[bi + 1]
+            block_mask = torch.logical_and(self.a_i >= i_start, self.a_i < i_end)
+            if bj is None:
+                j_start, dim_j = 0, self.dim_j
+            else:
+                j_start, j_end = self.block_inds[bj], self.block_inds[bj + 1]
+                block_mask = torch.logical_and(block_mask, torch.logical_and(self.a_j >= j_start, self.a_j < j_end))
+                dim_j = j_end - j_start
+            self.sub_blocks[(bi, bj)] = SparseMatrixStorage(
+                self.a_i[block_mask] - i_start, self.a_j[block_mask] - j_start, self.a_x[block_mask],
+                i_end - i_start, dim_j)
+        return self.sub_blocks[(bi, bj)]
+
+    def full(self):
+        """
+        :return: storage with all the entries of the matrix, needed by solvers that do not exploit symmetry.
+        """
+        return self
+
+    def value_grad(self, grad_b: torch.Tensor, x: torch.Tensor):
+        """
+        Gradient w.r.t. a_x of the solution x = A^-1 b, given the adjoint solution grad_b = A^-T grad_x.
+        """
+        grad_a_x = -grad_b[self.a_i] * x[self.a_j]
+        if grad_a_x.ndim == 2:
+            # All right-hand sides share the same matrix.
+            grad_a_x = grad_a_x.sum(1)
+        return grad_a_x
+
+    @ops.lru_cache_class(maxsize=None)
+    def l1_diagonal(self):
+        """
+        :return: (N, ) row-wise sum of absolute values. Using this as a Jacobi smoother converges for any SPD matrix.
+        """
+        return torch_scatter.scatter_sum(self.a_x.abs(), self.a_i, dim_size=self.dim_i)
+
+    @ops.lru_cache_class(maxsize=None)
+    def pattern(self) -> SparsityPattern:
+        return pattern_cache.get(self.a_i, self.a_j, self.dim_i, self.dim_j, self.block_inds)
+
     @ops.lru_cache_class(maxsize=None)
     def csr(self):      # --> compressed_row (long), col (long), value (float)
-        # Compress row:
-        a_p = torch_scatter.scatter_sum(
-            torch.ones((self.a_i.size(0)), dtype=torch.long, device=self.device), self.a_i, dim_size=self.dim_i)
-        a_p = torch.cat([torch.zeros((1,), dtype=torch.long, device=self.device), torch.cumsum(a_p, dim=0)])
-        # Order columns and data:
-        csr_seq = torch.argsort(self.a_i)
-        return a_p, self.a_j[csr_seq], self.a_x[csr_seq]
+        pattern = self.pattern()
+        return pattern.csr_p, pattern.csr_j, self.a_x[pattern.csr_seq]
+
+    @ops.lru_cache_class(maxsize=None)
+    def csr_tensor(self, dtype: torch.dtype = None):
+        """
+        :return: torch.sparse_csr_tensor built from csr(), kept alive so that repeated products reuse it.
+        """
+        csr_p, csr_j, csr_x = self.csr()
+        if dtype is not None:
+            csr_x = csr_x.to(dtype)
+        return torch.sparse_csr_tensor(csr_p, csr_j, csr_x, size=self.shape)
 
     @ops.lru_cache_class(maxsize=None)
     def csc(self):      # --> compressed_col (long), row (long), value (float)
@@ -57,6 +245,94 @@ class SparseMatrixStorage:
         csc_seq = torch.argsort(self.a_j)
         return a_p, self.a_i[csc_seq], self.a_x[csc_seq]
 
+    @ops.lru_cache_class(maxsize=None)
+    def scipy_csr(self):
+        """
+        :return: scipy.sparse.csr_matrix (float64) copy of this matrix on the host, used by the CPU solvers.
+        """
+        import scipy.sparse
+        a_p, a_j, a_x = self.csr()
+        return scipy.sparse.csr_matrix(
+            (a_x.detach().cpu().double().numpy(), a_j.cpu().numpy(), a_p.cpu().numpy()), shape=self.shape)
+
+    @ops.lru_cache_class(maxsize=None)
+    def cpu_factor(self):
+        """
+        Numeric factorization used by the CPU direct solver. This is cached on the instance so that
+        the adjoint solve in Solver.backward does not re-factorize.
+        :return: a function mapping a float64 numpy right-hand side to the solution.
+        """
+        a_csc = self.scipy_csr().tocsc()
+        pattern = self.pattern()
+
+        try:
+            from sksparse.cholmod import analyze, CholmodNotPositiveDefiniteError
+        except ImportError:
+            analyze = None
+
+        if analyze is not None:
+            # Symbolic analysis is shared with all matrices of the same sparsity pattern.
+            if pattern.symbolic_factor is None:
+                pattern.symbolic_factor = analyze(a_csc)
+            try:
+                return pattern.symbolic_factor.cholesky(a_csc)
+            except CholmodNotPositiveDefiniteError:
+                pass
+
+        # SuperLU restricted to symmetric pivoting: the column ordering is computed on A^T + A (i.e. the pattern of
+        #   the symmetric matrix) and diagonal pivots are preferred, so it behaves as an LDL^T of the SPD system.
+        import scipy.sparse.linalg
+        return scipy.sparse.linalg.splu(a_csc, permc_spec="MMD_AT_PLUS_A", diag_pivot_thresh=0.0,
+                                        options={"SymmetricMode": True}).solve
+
+    @ops.lru_cache_class(maxsize=None)
+    def cuda_factor(self):
+        """
+        Numeric Cholesky factorization used by the CUDA direct solver, cached on the instance so that repeated
+        solves (multiple right-hand sides, the coarsest level of every multigrid cycle) do not re-factorize.
+            The low-level cusolver API does not reorder, so the matrix is permuted by a fill-reducing ordering first,
+        which only depends on the sparsity pattern and is therefore cached together with it.
+        :return: a function mapping a (N, ) or (N, R) cuda right-hand side to the solution.
+        """
+        pattern = self.pattern()
+        if pattern.cuda_ordering is None:
+            n = self.dim_i
+            csr_p, csr_j = pattern.csr_p, pattern.csr_j
+            perm = sparse_solve.reorder_symamd(csr_p.int().cpu().contiguous(), csr_j.int().cpu().contiguous())
+            perm = perm.to(self.device).long()
+            inv_perm = torch.empty_like(perm)
+            inv_perm[perm] = torch.arange(n, dtype=torch.long, device=self.device)
+            # Entry (i, j) of A goes to (inv_perm[i], inv_perm[j]) of P A P^T.
+            perm_i = inv_perm[torch.repeat_interleave(torch.arange(n, device=self.device), csr_p[1:] - csr_p[:-1])]
+            perm_j = inv_perm[csr_j]
+            perm_seq = torch.argsort(perm_i * n + perm_j)
+            perm_p = torch.cat([torch.zeros((1,), dtype=torch.long, device=self.device),
+                                torch.cumsum(torch.bincount(perm_i, minlength=n), dim=0)])
+            pattern.cuda_ordering = (perm, inv_perm, perm_p.int().contiguous(), perm_j[perm_seq].int().contiguous(),
+                                     perm_seq)
+
+        perm, inv_perm, perm_p, perm_j, perm_seq = pattern.cuda_ordering
+        perm_x = self.csr()[2][perm_seq].float().contiguous()
+        try:
+            factor = sparse_solve.CholeskyFactor(perm_p, perm_j, perm_x, 1.0e-6)
+        except RuntimeError:
+            torch.cuda.empty_cache()
+            factor = sparse_solve.CholeskyFactor(perm_p, perm_j, perm_x, 1.0e-6)
+
+        def solve(b: torch.Tensor):
+            perm_b = b[perm].reshape(b.size(0), -1).t().float().contiguous()
+            x = factor.solve(perm_b).t()[inv_perm].to(b.dtype)
+            return x.reshape(b.shape)
+
+        return solve
+
+    @ops.lru_cache_class(maxsize=None)
+    def inv_l1_diagonal(self):
+        """
+        :return: (N, ) inverse of l1_diagonal, as applied by the l1-Jacobi smoother.
+        """
+        return 1.0 / self.l1_diagonal()
+
     @ops.lru_cache_class(maxsize=None)
     def diagonal(self):
         assert self.dim_i == self.dim_j
@@ -73,15 +349,202 @@ class SparseMatrixStorage:
             torch.stack([self.a_i, self.a_j], dim=0), self.a_x, (self.dim_i, self.dim_j)).to_dense()
 
 
+class SymmetricSparseMatrixStorage(SparseMatrixStorage):
+    """
+    Symmetric matrix of which only the upper triangle (a_i <= a_j) is stored, halving the memory of the COO/CSR
+    arrays and of the integrals that build them.
+        Products apply the upper triangle row-wise and once more through its transpose (a CSC view of the same
+    buffers). Blocks are extracted from the upper triangle directly, only the CUDA direct solver needs the whole
+    matrix and goes through full(), built on demand.
+    """
+    symmetric = True
+
+    def __init__(self, a_i, a_j, a_x, dim: int):
+        super().__init__(a_i, a_j, a_x, dim)
+
+    def __matmul__(self, res):
+        # U x + U^T x - D x, the diagonal is contained in both products.
+        a_upper = self.csr_tensor(res.dtype)
+        res_2d = res[:, None] if res.ndim == 1 else res
+        res_2d = a_upper @ res_2d + a_upper.t() @ res_2d - self.diagonal().to(res.dtype)[:, None] * res_2d
+        return res_2d[:, 0] if res.ndim == 1 else res_2d
+
+    @ops.lru_cache_class(maxsize=None)
+    def strict_upper(self):
+        strict_mask = self.a_i != self.a_j
+        return self.a_i[strict_mask], self.a_j[strict_mask], self.a_x[strict_mask]
+
+    @ops.lru_cache_class(maxsize=None)
+    def full(self):
+        strict_i, strict_j, strict_x = self.strict_upper()
+        full_mat = SparseMatrixStorage(
+            torch.cat([self.a_i, strict_j]), torch.cat([self.a_j, strict_i]), torch.cat([self.a_x, strict_x]),
+            self.dim_i)
+        if self.block_inds is not None:
+            full_mat.set_block_partition(np.diff(self.block_inds).tolist())
+        return full_mat
+
+    def value_grad(self, grad_b: torch.Tensor, x: torch.Tensor):
+        # Each off-diagonal value stands for both (i, j) and (j, i).
+        grad_a_x = -grad_b[self.a_i] * x[self.a_j] - grad_b[self.a_j] * x[self.a_i]
+        if grad_a_x.ndim == 2:
+            grad_a_x = grad_a_x.sum(1)
+        return torch.where(self.a_i == self.a_j, 0.5 * grad_a_x, grad_a_x)
+
+    def get_block(self, bi: int, bj: int = None):
+        """
+        Same as SparseMatrixStorage.get_block, extracted from the upper triangle: diagonal blocks are symmetric
+        storages again, other blocks (and block-rows) gather the upper entries in their rows and the mirrored strict
+        upper entries in their columns.
+        """
+        if (bi, bj) not in self.sub_blocks.keys():
+            i_start, i_end = self.block_inds[bi], self.block_inds[bi + 1]
+            in_rows = torch.logical_and(self.a_i >= i_start, self.a_i < i_end)
+            in_cols = torch.logical_and(self.a_j >= i_start, self.a_j < i_end)
+            if bj == bi:
+                block_mask = torch.logical_and(in_rows, in_cols)
+                self.sub_blocks[(bi, bj)] = SymmetricSparseMatrixStorage(
+                    self.a_i[block_mask] - i_start, self.a_j[block_mask] - i_start, self.a_x[block_mask],
+                    i_end - i_start)
+                return self.sub_blocks[(bi, bj)]
+
+            if bj is None:
+                j_start, dim_j = 0, self.dim_j
+                row_mask = in_rows
+                col_mask = torch.logical_and(in_cols, self.a_i != self.a_j)
+            else:
+                j_start, j_end = self.block_inds[bj], self.block_inds[bj + 1]
+                row_mask = torch.logical_and(in_rows, torch.logical_and(self.a_j >= j_start, self.a_j < j_end))
+                col_mask = torch.logical_and(in_cols, torch.logical_and(self.a_i >= j_start, self.a_i < j_end))
+                dim_j = j_end - j_start
+            self.sub_blocks[(bi, bj)] = SparseMatrixStorage(
+                torch.cat([self.a_i[row_mask], self.a_j[col_mask]]) - i_start,
+                torch.cat([self.a_j[row_mask], self.a_i[col_mask]]) - j_start,
+                torch.cat([self.a_x[row_mask], self.a_x[col_mask]]), i_end - i_start, dim_j)
+        return self.sub_blocks[(bi, bj)]
+
+    @ops.lru_cache_class(maxsize=None)
+    def l1_diagonal(self):
+        strict_i, strict_j, strict_x = self.strict_upper()
+        return torch_scatter.scatter_sum(self.a_x.abs(), self.a_i, dim_size=self.dim_i) + \
+            torch_scatter.scatter_sum(strict_x.abs(), strict_j, dim_size=self.dim_i)
+
+    # Do not call the (cached) methods of the base class here: lru_cache_class binds the cache to the instance
+    #   under the method name, so the base cache would replace this one after the first call.
+    @ops.lru_cache_class(maxsize=None)
+    def scipy_csr(self):
+        import scipy.sparse
+        a_p, a_j, a_x = self.csr()
+        a_upper = scipy.sparse.csr_matrix(
+            (a_x.detach().cpu().double().numpy(), a_j.cpu().numpy(), a_p.cpu().numpy()), shape=self.shape)
+        return (a_upper + a_upper.T - scipy.sparse.diags(a_upper.diagonal())).tocsr()
+
+    @ops.lru_cache_class(maxsize=None)
+    def dense(self):
+        a_upper = torch.sparse_coo_tensor(
+            torch.stack([self.a_i, self.a_j], dim=0), self.a_x, (self.dim_i, self.dim_j)).to_dense()
+        return a_upper + a_upper.t() - torch.diag(torch.diagonal(a_upper))
+
+
+class SolverTelemetry:
+    """
+    Structured records of the linear solves, one dict per solve (i.e. one per level of the cascadic solver).
+        Depending on the solver, a record contains: level, assembly_time, solve_time, n_unknowns, n_rhs, nnz,
+    iterations, residual_history, residual, fast_residual and fallback (solve_mixed), memory statistics (CUDA only,
+    see below), and 'backward' with the same statistics for the adjoint solve once backward() has run.
+        Records only hold python values, so they could be dumped with to_json() or write_tensorboard().
+    Timings synchronize the device, so only pass a telemetry object when you need it.
+        Memory statistics are measured against a baseline taken in begin(): 'memory_increase' is the memory still
+    allocated at the end, and 'peak_memory_increase' how much the device-wide peak grew, which is 0 if an earlier
+    peak was higher. Set reset_peak_memory to get the exact 'peak_memory' of each level instead, at the price of
+    resetting the peak statistics of the device that other code (e.g. profilers) might rely on.
+    :param callback: function called with each record once it is finished.
+    :param reset_peak_memory: reset the peak memory statistics of the device at the beginning of each record.
+    """
+    def __init__(self, callback=None, reset_peak_memory: bool = False):
+        self.records = []
+        self.callback = callback
+        self.reset_peak_memory = reset_peak_memory
+        self.current = None
+        self._device = None
+        self._lap_time = None
+        self._base_memory = None
+        self._base_peak_memory = None
+
+    @staticmethod
+    def now(device: torch.device) -> float:
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        return time.perf_counter()
+
+    def begin(self, device: torch.device, **info) -> dict:
+        """
+        Start a new record (e.g. before the assembly of a level), the memory is measured from here.
+        :return: the record, to be passed to solve_sparse as 'stats'.
+        """
+        if device.type == 'cuda':
+            if self.reset_peak_memory:
+                torch.cuda.reset_peak_memory_stats(device)
+            self._base_memory = torch.cuda.memory_allocated(device)
+            self._base_peak_memory = torch.cuda.max_memory_allocated(device)
+        self.current = dict(info)
+        self.records.append(self.current)
+        self._device = device
+        self._lap_time = self.now(device)
+        return self.current
+
+    def lap(self, key: str):
+        """
+        Store the time elapsed since begin() or the last lap() into the current record.
+        """
+        cur_time = self.now(self._device)
+        self.current[key] = cur_time - self._lap_time
+        self._lap_time = cur_time
+
+    def end(self):
+        if self._device.type == 'cuda':
+            peak_memory = torch.cuda.max_memory_allocated(self._device)
+            self.current["memory_increase"] = torch.cuda.memory_allocated(self._device) - self._base_memory
+            self.current["peak_memory_increase"] = peak_memory - self._base_peak_memory
+            if self.reset_peak_memory:
+                self.current["peak_memory"] = peak_memory
+        if self.callback is not None:
+            self.callback(self.current)
+        self.current = None
+
+    def clear(self):
+        self.records = []
+
+    def to_json(self, path: str = None, **kwargs) -> str:
+        json_str = json.dumps(self.records, **kwargs)
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(json_str)
+        return json_str
+
+    def write_tensorboard(self, writer, global_step: int = None, prefix: str = "solver"):
+        """
+        Write all scalar statistics as '{prefix}/level_{level}/{key}', nested records (backward) are flattened.
+        :param writer: torch.utils.tensorboard.SummaryWriter (or anything with an add_scalar method)
+        """
+        for record_idx, record in enumerate(self.records):
+            tag = f"{prefix}/level_{record.get('level', record_idx)}"
+            scalars = [(k, v) for k, v in record.items() if not isinstance(v, dict)]
+            scalars += [(f"{k}_{kk}", vv) for k, v in record.items() if isinstance(v, dict) for kk, vv in v.items()]
+            for key, value in scalars:
+                if isinstance(value, (bool, int, float)):
+                    writer.add_scalar(f"{tag}/{key}", float(value), global_step)
+
+
 class Solver(torch.autograd.Function):
     """
     Differentiable linear solver class
     """
     @staticmethod
     def forward(ctx, a: SparseMatrixStorage, a_x: torch.Tensor, b: torch.Tensor,
-                forward_solver, backward_solver):
+                forward_solver, backward_solver, x0: torch.Tensor = None):
         with torch.no_grad():
-            x = forward_solver(a=a, b=b.detach())
+            x = forward_solver(a=a, b=b.detach(), x0=x0)
 
         ctx.save_for_backward(x, b)
         ctx.a = a
@@ -94,62 +557,112 @@ class Solver(torch.autograd.Function):
         a = ctx.a
         with torch.no_grad():
             grad_b = ctx.backward_solver(a, grad_x)
-            grad_a_x = -grad_b[a.a_i] * x[a.a_j]
-        return None, grad_a_x, grad_b, None, None
+            grad_a_x = a.value_grad(grad_b, x)
+        return None, grad_a_x, grad_b, None, None, None
 
 
 def solve_sparse(a_i: torch.Tensor, a_j: torch.Tensor, a_x: torch.Tensor, b: torch.Tensor,
-                 solver_type: str, verbose_str: str = None):
+                 solver_type: str, verbose_str: str = None, block_sizes: list = None, x0: torch.Tensor = None,
+                 symmetric: bool = False, stats: dict = None):
     """
     Solve a sparse linear system in a differentiable manner: Ax = b
     :param a_i: COO row indices of A
     :param a_j: COO col indices of A
     :param a_x: COO values of A
-    :param b: right hand side.
+    :param b: right hand side, (N, ) or (N, R) to solve R systems sharing the same matrix at once.
     :param solver_type: name of the solver
     :param verbose_str:
+    :param block_sizes: list of int, level partition of the unknowns (finest first), needed by 'mg' and 'mgpcg'.
+    :param x0: initial guess for the iterative solvers (ignored by the direct solver), not differentiated.
+    :param symmetric: whether A is symmetric and (a_i, a_j, a_x) only contains its upper triangle (a_i <= a_j).
+    :param stats: dict to be filled with the statistics of this solve, e.g. a record from SolverTelemetry.begin.
     :return: x: Tensor
     """
-    if verbose_str is not None:
-        torch.cuda.synchronize()
+    if verbose_str is not None or stats is not None:
+        if b.is_cuda:
+            torch.cuda.synchronize()
         start_time = time.perf_counter()
 
-    a_mat = SparseMatrixStorage(a_i, a_j, a_x, dim=b.size(0))
+    backward_stats = None
+    if stats is not None:
+        backward_stats = {}
+        stats.update(solver=solver_type, n_unknowns=b.size(0), n_rhs=b.size(1) if b.ndim == 2 else 1,
+                     nnz=a_i.size(0), symmetric=symmetric, backward=backward_stats)
+
+    if symmetric:
+        a_mat = SymmetricSparseMatrixStorage(a_i, a_j, a_x, dim=b.size(0))
+    else:
+        a_mat = SparseMatrixStorage(a_i, a_j, a_x, dim=b.size(0))
+    if block_sizes is not None:
+        a_mat.set_block_partition(block_sizes)
     solver_type, pcg_conf = _parse_solver_type(solver_type)
 
     if solver_type == "pcg":
         func = functools.partial(solve_pcg, pcg_conf=pcg_conf)
-        res = Solver.apply(a_mat, a_x, b, func, func)
+        res = Solver.apply(a_mat, a_x, b, functools.partial(func, stats=stats),
+                           functools.partial(func, stats=backward_stats), x0)
 
     elif solver_type == "mixed":
         solver_forward = functools.partial(
             solve_mixed,
             fast_solver=functools.partial(solve_pcg, pcg_conf={'maxiter': 1000, 'tol': 1.0e-4}),
-            fallback_solver=solve_cholmod, tol=1.0e-2, name="forward")
-        solver_backward = solve_cholmod
-        res = Solver.apply(a_mat, a_x, b, solver_forward, solver_backward)
+            fallback_solver=solve_cholmod, tol=1.0e-2, name="forward", stats=stats)
+        solver_backward = functools.partial(solve_cholmod, stats=backward_stats)
+        res = Solver.apply(a_mat, a_x, b, solver_forward, solver_backward, x0)
 
     elif solver_type == "cholmod":
-        res = Solver.apply(a_mat, a_x, b, solve_cholmod, solve_cholmod)
+        res = Solver.apply(a_mat, a_x, b, functools.partial(solve_cholmod, stats=stats),
+                           functools.partial(solve_cholmod, stats=backward_stats))
+
+    elif solver_type == "refine":
+        func = functools.partial(solve_refine, refine_conf=pcg_conf)
+        res = Solver.apply(a_mat, a_x, b, functools.partial(func, stats=stats),
+                           functools.partial(func, stats=backward_stats), x0)
+
+    elif solver_type == "mg":
+        assert block_sizes is not None, "Multigrid solver needs the level partition."
+        func = functools.partial(solve_mg, mg_conf=pcg_conf)
+        res = Solver.apply(a_mat, a_x, b, functools.partial(func, stats=stats),
+                           functools.partial(func, stats=backward_stats), x0)
+
+    elif solver_type == "mgpcg":
+        assert block_sizes is not None, "Multigrid solver needs the level partition."
+        func = functools.partial(solve_mgpcg, mg_conf=pcg_conf)
+        res = Solver.apply(a_mat, a_x, b, functools.partial(func, stats=stats),
+                           functools.partial(func, stats=backward_stats), x0)
 
     else:
         raise NotImplementedError
 
-    if verbose_str is not None:
-        torch.cuda.synchronize()
+    if verbose_str is not None or stats is not None:
+        if b.is_cuda:
+            torch.cuda.synchronize()
         elapsed_time = time.perf_counter() - start_time
         with torch.no_grad():
             residual = torch.linalg.norm(a_mat @ res - b).item()
-        print(verbose_str.format(time=elapsed_time, residual=residual))
+        if verbose_str is not None:
+            print(verbose_str.format(time=elapsed_time, residual=residual))
+        if stats is not None:
+            stats.update(solve_time=elapsed_time, residual=residual)
 
     return res
 
 
-def solve_cholmod(a: SparseMatrixStorage, b: torch.Tensor):
+def solve_cholmod(a: SparseMatrixStorage, b: torch.Tensor, x0: torch.Tensor = None, stats: dict = None):
+    if stats is not None:
+        stats["direct"] = True
+
     if b.size(0) == 0:
         return torch.zeros_like(b)
 
-    a_p, a_j, a_x = a.csr()
+    if not b.is_cuda:
+        return _solve_direct_cpu(a, b)
+
+    if b.ndim == 2:
+        # cusolverSpScsrlsvchol only accepts a single right-hand side and would re-factorize for each column.
+        return a.full().cuda_factor()(b)
+
+    a_p, a_j, a_x = a.full().csr()
     a_p = a_p.int().contiguous()
     a_j = a_j.int().contiguous()
     a_x = a_x.float().contiguous()
@@ -165,12 +678,16 @@ def solve_cholmod(a: SparseMatrixStorage, b: torch.Tensor):
 
 
 def solve_mixed(a: SparseMatrixStorage, b: torch.Tensor,
-                fast_solver, fallback_solver, tol: float = 0.01, name: str = None):
+                fast_solver, fallback_solver, tol: float = 0.01, name: str = None, x0: torch.Tensor = None,
+                stats: dict = None):
     if b.size(0) == 0:
         return torch.zeros_like(b)
 
-    solution = fast_solver(a, b)
-    fast_residual = torch.linalg.norm(a @ solution - b).item()
+    solution = fast_solver(a, b, x0=x0, stats=stats)
+    # Worst column decides for multiple right-hand sides.
+    fast_residual = torch.linalg.norm(a @ solution - b, dim=0).max().item()
+    if stats is not None:
+        stats.update(fast_residual=fast_residual, fallback=fast_residual > tol)
     if fast_residual > tol:
         solution = fallback_solver(a, b)
 
@@ -186,17 +703,265 @@ def _parse_solver_type(solver_type: str):
     return solver_specs[0], solver_configs
 
 
-def solve_pcg(a: SparseMatrixStorage, b: torch.Tensor, pcg_conf):
+def solve_pcg(a: SparseMatrixStorage, b: torch.Tensor, pcg_conf, x0: torch.Tensor = None, stats: dict = None):
     inv_diag_a = 1.0 / a.diagonal()
     csr_p, csr_j, csr_x = a.csr()
     max_iter = pcg_conf.get("maxiter", -1)
-
-    res, cg_iter = sparse_solve.solve_pcg_diag(
-        csr_p.int(), csr_j.int(), csr_x, b, inv_diag_a,
-        pcg_conf.get("tol", 1.0e-5), max_iter, pcg_conf.get("res_fix", False)
-    )
+    tol = pcg_conf.get("tol", 1.0e-5)
+
+    # The CUDA kernel needs all the entries, symmetric storage is kept compact by using the PyTorch path instead.
+    if not b.is_cuda or b.ndim == 2 or a.symmetric:
+        res, cg_iter = _solve_pcg_diag_torch(
+            a, b, inv_diag_a, tol, max_iter, pcg_conf.get("res_fix", False), x0,
+            history=stats.setdefault("residual_history", []) if stats is not None else None
+        )
+    elif x0 is None:
+        res, cg_iter = sparse_solve.solve_pcg_diag(
+            csr_p.int(), csr_j.int(), csr_x, b, inv_diag_a, tol, max_iter, pcg_conf.get("res_fix", False)
+        )
+    else:
+        # The CUDA kernel always starts from zero, so solve for the correction A dx = b - A x0 instead,
+        #   with the tolerance rescaled so that the stopping criterion is still relative to |b|.
+        b_norm = torch.linalg.norm(b).item()
+        b_res = b - a @ x0
+        b_res_norm = torch.linalg.norm(b_res).item()
+        if b_res_norm <= tol * b_norm:
+            res, cg_iter = x0.clone(), 0
+        else:
+            res, cg_iter = sparse_solve.solve_pcg_diag(
+                csr_p.int(), csr_j.int(), csr_x, b_res, inv_diag_a,
+                tol * b_norm / b_res_norm, max_iter, pcg_conf.get("res_fix", False)
+            )
+            res = res + x0
 
     if pcg_conf.get("verbose", False):
         print("PCG Iteration ended in", cg_iter)
+    if stats is not None:
+        stats["iterations"] = cg_iter
+
+    return res
+
+
+def solve_refine(a: SparseMatrixStorage, b: torch.Tensor, refine_conf, x0: torch.Tensor = None,
+                 stats: dict = None):
+    """
+    Mixed-precision iterative refinement: the solution and the residual r = b - Ax are accumulated in float64,
+    while each correction A dx = r is solved by a loose diagonal PCG in float32.
+        Options (in the solver_type string): tol / maxiter for the outer loop, inner_tol / inner_maxiter for PCG,
+    and spmv_dtype for the products inside PCG, e.g. "refine@tol=1e-9@spmv_dtype='bfloat16'" (bfloat16
+    sparse products need a recent GPU).
+    """
+    if b.size(0) == 0:
+        return torch.zeros_like(b)
+
+    tol = refine_conf.get("tol", 1.0e-9)
+    max_iter = refine_conf.get("maxiter", 20)
+    inner_tol = refine_conf.get("inner_tol", 1.0e-3)
+    inner_max_iter = refine_conf.get("inner_maxiter", 1000)
+    spmv_dtype = getattr(torch, refine_conf.get("spmv_dtype", "float32"))
+
+    inv_diag_a = (1.0 / a.diagonal()).float()
+
+    def low_matvec(v):
+        return (a @ v.to(spmv_dtype)).float()
+
+    b_64 = b.double()
+    x = torch.zeros_like(b_64) if x0 is None else x0.double()
+    atol = tol * torch.linalg.norm(b_64, dim=0)
+    history = stats.setdefault("residual_history", []) if stats is not None else []
+    inner_iters = stats.setdefault("inner_iterations", []) if stats is not None else []
+
+    refine_iter = 0
+    while True:
+        r = b_64 - a @ x
+        r_norm = torch.linalg.norm(r, dim=0)
+        history.append(r_norm.tolist())
+        if refine_iter >= max_iter or not torch.any(r_norm > atol).item():
+            break
+        # Normalize so that the correction stays in the range of the low precision.
+        r_scale = torch.clamp(r_norm, min=torch.finfo(torch.float64).tiny)
+        dx, cg_iter = _solve_pcg_generic(low_matvec, (r / r_scale).float(), lambda v: inv_diag_a[:, None] * v,
+                                         inner_tol, inner_max_iter)
+        x += dx.double() * r_scale
+        inner_iters.append(cg_iter)
+        refine_iter += 1
+
+    if refine_conf.get("verbose", False):
+        print("Refinement ended in", refine_iter, "with PCG iterations", inner_iters)
+    if stats is not None:
+        stats["iterations"] = refine_iter
+
+    return x.to(b.dtype)
+
+
+def _solve_pcg_diag_torch(a: SparseMatrixStorage, b: torch.Tensor,
+                          inv_diag_a: torch.Tensor, tol: float, max_iter: int, res_fix: bool,
+                          x0: torch.Tensor = None, history: list = None):
+    """
+    Counterpart of sparse_solve.solve_pcg_diag (csrc/sparse_solve/solve_pcg.cu) in pure PyTorch, with the same
+    stopping criterion (|r| <= tol * |b|) and the same periodic residual re-computation when res_fix is set.
+        Used on the CPU, and for multiple right-hand sides (N, R) which the CUDA kernel does not support.
+    :return: (x, number of iterations)
+    """
+    return _solve_pcg_generic(lambda v: a @ v, b, lambda r: inv_diag_a[:, None] * r,
+                              tol, max_iter, res_fix, x0, history)
+
+
+def _solve_pcg_generic(matvec, b: torch.Tensor, precond, tol: float, max_iter: int, res_fix: bool = False,
+                       x0: torch.Tensor = None, history: list = None):
+    """
+    Preconditioned conjugate gradient with arbitrary operators, following the structure of solve_pcg.cu.
+        For (N, R) right-hand sides, every column runs its own CG recurrence (and stops on its own), while the
+    matrix is only applied once per iteration for all columns.
+    :param matvec: function V -> A V, V is (N, R)
+    :param precond: function R -> M^-1 R, R is (N, R), M must be symmetric positive definite.
+    :param x0: initial guess, zero if not provided.
+    :param history: if provided, residual norms (one float or one list per column) are appended every iteration.
+    :return: (x, number of iterations)
+    """
+    single_rhs = b.ndim == 1
+    if single_rhs:
+        b = b[:, None]
+        x0 = x0[:, None] if x0 is not None else None
+
+    n = b.size(0)
+    sqrt_n = int(np.ceil(np.sqrt(n)))
+    atol = tol * torch.linalg.norm(b, dim=0)
+
+    if x0 is None:
+        x = torch.zeros_like(b)
+        r = b.clone()
+    else:
+        x = x0.clone()
+        r = b - matvec(x)
+    p = None
+    rho = torch.zeros_like(atol)
+    cg_iter = 0
+    r_norm = torch.linalg.norm(r, dim=0)
+    active = r_norm > atol
+    if history is not None:
+        history.append(r_norm.item() if single_rhs else r_norm.tolist())
+    while (max_iter < 0 or cg_iter < max_iter) and active.any().item():
+        z = precond(r)
+        rho_1, rho = rho, torch.sum(r * z, dim=0)
+        if p is None:
+            p = z
+        else:
+            p = z + torch.where(active, rho / rho_1, torch.zeros_like(rho)) * p
+        a_p = matvec(p)
+        alpha = torch.where(active, rho / torch.sum(p * a_p, dim=0), torch.zeros_like(rho))
+        x += alpha * p
+        if (cg_iter + 1) % sqrt_n == 0 and res_fix:
+            r = b - matvec(x)
+        else:
+            r -= alpha * a_p
+        cg_iter += 1
+        r_norm = torch.linalg.norm(r, dim=0)
+        active = r_norm > atol
+        if history is not None:
+            history.append(r_norm.item() if single_rhs else r_norm.tolist())
+
+    if single_rhs:
+        x = x[:, 0]
+
+    return x, cg_iter
+
+
+def _solve_direct_cpu(a: SparseMatrixStorage, b: torch.Tensor):
+    """
+    Host counterpart of sparse_solve.solve_cusparse. Uses the sparse Cholesky factorization from CHOLMOD
+    (scikit-sparse) when it is installed, and falls back to SuperLU from scipy in symmetric mode otherwise, or if
+    the matrix is not numerically positive definite.
+    """
+    x = a.cpu_factor()(b.detach().double().numpy())
+    return torch.from_numpy(x).to(b.dtype)
+
+
+def _mg_cycle(a: SparseMatrixStorage, b: torch.Tensor, x: torch.Tensor, level: int, mg_conf):
+    """
+    One multigrid cycle over the hierarchical basis, starting at block 'level' (block 0 is the finest level).
+        Unlike a nested grid hierarchy, the bases of all levels co-exist, so the inter-level couplings
+    A[fine, coarse] (built from the cross-level neighbour maps) act as restriction, and their transposes as
+    prolongation. Smoothing is l1-Jacobi so that the cycle stays symmetric and can be used in PCG.
+        x is updated in-place.
+    """
+    n_smooth, gamma = mg_conf.get("n_smooth", 2), mg_conf.get("gamma", 1)
+    l_start, l_end = a.block_inds[level], a.block_inds[level + 1]
+
+    def smooth():
+        if l_end == l_start:
+            return
+        block_row = a.get_block(level)
+        inv_l1_diag = a.get_block(level, level).inv_l1_diagonal()
+        if b.ndim == 2:
+            inv_l1_diag = inv_l1_diag[:, None]
+        for _ in range(n_smooth):
+            x[l_start:l_end] += inv_l1_diag * (b[l_start:l_end] - block_row @ x)
+
+    if level == a.n_blocks - 1:
+        # Coarsest level: exact solve, with a factorization that is cached on the block and reused by every cycle.
+        if l_end > l_start:
+            residual = b[l_start:l_end] - a.get_block(level) @ x
+            coarse_block = a.get_block(level, level)
+            if residual.is_cuda:
+                x[l_start:l_end] += coarse_block.full().cuda_factor()(residual)
+            else:
+                x[l_start:l_end] += _solve_direct_cpu(coarse_block, residual)
+        return
+
+    smooth()
+    for _ in range(gamma):
+        _mg_cycle(a, b, x, level + 1, mg_conf)
+    smooth()
+
+
+def solve_mg(a: SparseMatrixStorage, b: torch.Tensor, mg_conf, x0: torch.Tensor = None, stats: dict = None):
+    """
+    Stationary multigrid iterations (V-cycle for gamma=1, W-cycle for gamma=2) on a block-partitioned matrix.
+    """
+    if b.size(0) == 0:
+        return torch.zeros_like(b)
+
+    atol = mg_conf.get("tol", 1.0e-5) * torch.linalg.norm(b).item()
+    max_iter = mg_conf.get("maxiter", 100)
+
+    x = torch.zeros_like(b) if x0 is None else x0.clone()
+    history = stats.setdefault("residual_history", []) if stats is not None else []
+    mg_iter = 0
+    while mg_iter < max_iter:
+        history.append(torch.linalg.norm(b - a @ x).item())
+        if history[-1] <= atol:
+            break
+        _mg_cycle(a, b, x, 0, mg_conf)
+        mg_iter += 1
+
+    if mg_conf.get("verbose", False):
+        print("Multigrid iteration ended in", mg_iter)
+    if stats is not None:
+        stats["iterations"] = mg_iter
+
+    return x
+
+
+def solve_mgpcg(a: SparseMatrixStorage, b: torch.Tensor, mg_conf, x0: torch.Tensor = None, stats: dict = None):
+    """
+    Conjugate gradient on a block-partitioned matrix, preconditioned by one multigrid cycle.
+    """
+    if b.size(0) == 0:
+        return torch.zeros_like(b)
+
+    def mg_precond(r):
+        z = torch.zeros_like(r)
+        _mg_cycle(a, r, z, 0, mg_conf)
+        return z
+
+    res, cg_iter = _solve_pcg_generic(
+        lambda v: a @ v, b, mg_precond, mg_conf.get("tol", 1.0e-5), mg_conf.get("maxiter", -1), x0=x0,
+        history=stats.setdefault("residual_history", []) if stats is not None else None)
+
+    if mg_conf.get("verbose", False):
+        print("MG-PCG Iteration ended in", cg_iter)
+    if stats is not None:
+        stats["iterations"] = cg_iter
 
     return res
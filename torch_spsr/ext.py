@@ -7,14 +7,70 @@ sparse_op = _sparse_op
 marching_cubes = _marching_cubes
 sparse_solve = _sparse_solve
 
-# Initialize cusolver for future usages
-sparse_solve.init_cusolver()
+# Initialize cusolver for future usages (CPU-only nodes will not have a device to bind to)
+if torch.cuda.is_available():
+    sparse_solve.init_cusolver()
+
+
+# 64-bit FNV-1a constants, identical to the ones used in csrc/common/hashmap_cuda.cu
+#   (the offset basis is stored as its two's complement so that it fits into int64)
+_FNV_OFFSET_BASIS = 14695981039346656037 - (1 << 64)
+_FNV_PRIME = 1099511628211
+
+
+def _fnv_hash_cpu(coords: torch.Tensor) -> torch.Tensor:
+    """
+    CPU counterpart of _common.hash_cuda. Integer overflow wraps around in int64 arithmetic, so the
+    result is bitwise identical to the CUDA kernel that works on uint64.
+    :param coords: (..., D) int or long tensor
+    :return: (..., ) int64 tensor
+    """
+    coords = coords.long() & 0xFFFFFFFF
+    hash_val = torch.full(coords.shape[:-1], _FNV_OFFSET_BASIS, dtype=torch.int64, device=coords.device)
+    for j in range(coords.size(-1)):
+        hash_val = (hash_val ^ coords[..., j]) * _FNV_PRIME
+    # Logical (instead of arithmetic) right shift of the top 4 bits.
+    return ((hash_val >> 60) & 0xF) ^ (hash_val & 0xFFFFFFFFFFFFFFF)
+
+
+def _kernel_hash_cpu(coords: torch.Tensor, offsets: torch.Tensor) -> torch.Tensor:
+    """
+    CPU counterpart of _common.kernel_hash_cuda.
+    :param coords: (N, 3) or (N, 4), the 4th column (e.g. batch index) is not offset.
+    :param offsets: (K, 3)
+    :return: (K, N) int64 tensor
+    """
+    coords = coords.long()
+    kernel_coords = coords.unsqueeze(0).repeat(offsets.size(0), 1, 1)
+    kernel_coords[:, :, :3] += offsets.long().unsqueeze(1)
+    return _fnv_hash_cpu(kernel_coords)
+
+
+class CPUHashLookupData:
+    """
+    Host-side replacement of _common.HashLookupData.
+        Keys are kept sorted so that a batch of queries is a single vectorized binary search.
+    """
+    def __init__(self, hash_target: torch.Tensor):
+        self.keys, self.vals = torch.sort(hash_target, stable=True)
+
+    def query(self, hash_query: torch.Tensor) -> torch.Tensor:
+        """
+        :param hash_query: (N, ) int64
+        :return: (N, ) int64, index into the original hash_target, -1 if not found.
+        """
+        if self.keys.size(0) == 0:
+            return torch.full_like(hash_query, -1)
+        pos = torch.searchsorted(self.keys, hash_query).clamp_(max=self.keys.size(0) - 1)
+        return torch.where(self.keys[pos] == hash_query, self.vals[pos], torch.full_like(pos, -1))
 
 
 class CuckooHashTable:
     """
     Cuckoo Hash Table for fast positional queries.
     Code is adapted from https://github.com/mit-han-lab/torchsparse
+        If the data lives on the CPU, a sorted-key table (CPUHashLookupData) with the same query semantics is
+    used instead of the CUDA cuckoo table.
     """
     def __init__(self, data: torch.Tensor = None, hashed_data: torch.Tensor = None, enlarged: bool = False):
         """
@@ -25,11 +81,15 @@ class CuckooHashTable:
         if data is not None:
             self.dim = data.size(1)
             assert data.size(0) > 0
-            source_hash = _common.hash_cuda(data.contiguous())
+            source_hash = self._sphash(data)
         else:
             self.dim = -1   # Never equals me.
             source_hash = hashed_data
-        self.object = _common.build_hash_table(source_hash, torch.tensor([]), enlarged)
+        self.is_cuda = source_hash.is_cuda
+        if self.is_cuda:
+            self.object = _common.build_hash_table(source_hash, torch.tensor([]), enlarged)
+        else:
+            self.object = CPUHashLookupData(source_hash)
 
     @classmethod
     def _sphash(cls, coords: torch.Tensor, offsets=None) -> torch.Tensor:     # Int64
@@ -37,7 +97,7 @@ class CuckooHashTable:
         Compute the hash value of coords + offsets.
         :param coords: (N, 3)
         :param offsets: (K, 3) offsets to be added to coordinates
-        :return: (N, K) if offsets is provided, otherwise (N,)
+        :return: (K, N) if offsets is provided, otherwise (N,)
         """
         assert coords.dtype in [torch.int, torch.long], coords.dtype
         coords = coords.contiguous()
@@ -45,6 +105,8 @@ class CuckooHashTable:
             assert coords.ndim == 2 and coords.shape[1] in [2, 3, 4], coords.shape
             if coords.size(0) == 0:
                 return torch.empty((coords.size(0), ), dtype=torch.int64, device=coords.device)
+            if not coords.is_cuda:
+                return _fnv_hash_cpu(coords)
             return _common.hash_cuda(coords)
         else:
             assert offsets.dtype == torch.int, offsets.dtype
@@ -53,6 +115,8 @@ class CuckooHashTable:
             if coords.size(0) == 0 or offsets.size(0) == 0:
                 return torch.empty((offsets.size(0), coords.size(0)), dtype=torch.int64, device=coords.device)
             offsets = offsets.contiguous()
+            if not coords.is_cuda:
+                return _kernel_hash_cpu(coords, offsets)
             return _common.kernel_hash_cuda(coords, offsets)
 
     def query(self, coords, offsets=None):
@@ -60,7 +124,7 @@ class CuckooHashTable:
         Compute the position of the queries coordinates, -1 if not found.
         :param coords: (N, 3)
         :param offsets: (K, 3)
-        :return: (N, K) if offsets is provided, otherwise (N,)
+        :return: (K, N) if offsets is provided, otherwise (N,)
         """
         assert coords.size(1) == self.dim
         hashed_query = self._sphash(coords, offsets)
@@ -69,8 +133,8 @@ class CuckooHashTable:
     def query_hashed(self, hashed_query: torch.Tensor):
         """
         Query the values with hashed query.
-        :param hashed_query: (N, ) or (N, K)
-        :return: (N, ) or (N, K)
+        :param hashed_query: (N, ) or (K, N)
+        :return: (N, ) or (K, N)
         """
         sizes = hashed_query.size()
         hashed_query = hashed_query.view(-1)
@@ -78,7 +142,70 @@ class CuckooHashTable:
         if hashed_query.size(0) == 0:
             return torch.zeros(sizes, dtype=torch.int64, device=hashed_query.device) - 1
 
+        if not self.is_cuda:
+            return self.object.query(hashed_query.contiguous()).view(*sizes)
+
         output = _common.hash_table_query(self.object, hashed_query.contiguous())
         output = (output - 1).view(*sizes)
 
         return output
+
+
+# Max. number of (pair, axis, component, component) table entries gathered at once by the CPU DDI kernels.
+_DDI_CPU_CHUNK = 1 << 22
+
+
+def _ddi_cpu_chunks(n_pairs: int, n_components: int):
+    chunk_pairs = max(1, _DDI_CPU_CHUNK // (3 * n_components * n_components))
+    return [slice(p, min(p + chunk_pairs, n_pairs)) for p in range(0, n_pairs, chunk_pairs)]
+
+
+def _ddi_cpu_unpack(expanded: torch.Tensor, n_components: int) -> torch.Tensor:
+    # (N, 3C) with index c * 3 + v -> (N, 3, C)
+    return expanded.reshape(expanded.size(0), n_components, 3).transpose(1, 2)
+
+
+def ddi_forward_cpu(source_expanded: torch.Tensor, target_expanded: torch.Tensor, rel_pos: torch.Tensor,
+                    f_f_i: torch.Tensor, df_df_i: torch.Tensor):
+    """
+    CPU counterpart of _integration.ddi_forward, for each pair n and axis v:
+        p[n, v] = sum_{s, t} source[n, s * 3 + v] * target[n, t * 3 + v] * f_f_i[s, t, rel_pos[n, v]],
+    and q likewise with df_df_i.
+    :param source_expanded: (N, 3C) per-pair coefficients of the source basis
+    :param target_expanded: (N, 3C) per-pair coefficients of the target basis
+    :param rel_pos: (N, 3) long, position in the integral tables
+    :param f_f_i: (C, C, L) integral table of function products
+    :param df_df_i: (C, C, L) integral table of derivative products
+    :return: p_mats (N, 3), q_mats (N, 3)
+    """
+    n_components = f_f_i.size(0)
+    ff_table, dd_table = f_f_i.permute(2, 0, 1), df_df_i.permute(2, 0, 1)
+    p_mats = source_expanded.new_zeros((source_expanded.size(0), 3))
+    q_mats = source_expanded.new_zeros((source_expanded.size(0), 3))
+    for pairs in _ddi_cpu_chunks(source_expanded.size(0), n_components):
+        source = _ddi_cpu_unpack(source_expanded[pairs], n_components)
+        target = _ddi_cpu_unpack(target_expanded[pairs], n_components)
+        st = source.unsqueeze(-1) * target.unsqueeze(-2)        # (n, 3, C, C)
+        p_mats[pairs] = torch.sum(st * ff_table[rel_pos[pairs]], dim=(2, 3))
+        q_mats[pairs] = torch.sum(st * dd_table[rel_pos[pairs]], dim=(2, 3))
+    return p_mats, q_mats
+
+
+def ddi_backward_cpu(source_expanded: torch.Tensor, target_expanded: torch.Tensor, rel_pos: torch.Tensor,
+                     f_f_i: torch.Tensor, df_df_i: torch.Tensor, grad_p: torch.Tensor, grad_q: torch.Tensor):
+    """
+    CPU counterpart of _integration.ddi_backward.
+    :return: grad_s (N, 3C), grad_t (N, 3C), gradients w.r.t. source_expanded and target_expanded.
+    """
+    n_components = f_f_i.size(0)
+    ff_table, dd_table = f_f_i.permute(2, 0, 1), df_df_i.permute(2, 0, 1)
+    grad_s = torch.zeros_like(source_expanded)
+    grad_t = torch.zeros_like(target_expanded)
+    for pairs in _ddi_cpu_chunks(source_expanded.size(0), n_components):
+        source = _ddi_cpu_unpack(source_expanded[pairs], n_components)
+        target = _ddi_cpu_unpack(target_expanded[pairs], n_components)
+        grad_st = grad_p[pairs, :, None, None] * ff_table[rel_pos[pairs]] + \
+            grad_q[pairs, :, None, None] * dd_table[rel_pos[pairs]]     # (n, 3, C, C)
+        grad_s[pairs] = torch.einsum('nvst,nvt->nsv', grad_st, target).reshape(-1, 3 * n_components)
+        grad_t[pairs] = torch.einsum('nvst,nvs->ntv', grad_st, source).reshape(-1, 3 * n_components)
+    return grad_s, grad_t